@@ -0,0 +1,277 @@
+# Logic analyzer with a pre-trigger window, using PIO and DMA.
+#
+# A sampler state machine reads pin_count pins per cycle with in_(pins, n)
+# and autopush, and a DMA channel moves the words into a ring buffer.
+# A second state machine on the same PIO compares a group of pins with
+# the trigger pattern. When it matches, the trigger state machine pushes
+# a word, and two DMA channels pause the ring channel and start another
+# channel at the same write position, which takes the post-trigger
+# samples and stops. So the CPU is not involved until the capture is
+# finished, and the ring holds the samples before and after the trigger.
+
+import array
+import time
+import rp2
+import rp2_util
+
+DMA_BASE = const(0x50000000)
+PIO0_BASE = const(0x50200000)
+PIO1_BASE = const(0x50300000)
+PIO_RXF0 = const(0x20)
+TREQ_PERMANENT = const(0x3f)
+DMA_WRITE_ADDR = const(0x04)  # register offsets of a DMA channel
+DMA_CTRL_ALIAS = const(0x10)
+DMA_WRITE_ADDR_TRIG = const(0x2c)  # alias 2
+
+#
+# The PIO programs, made for the number of pins, which is coded into
+# the in_() instruction. They are kept, such that instances with the same
+# number of pins share them.
+#
+_programs = {}
+
+def _sampler(pin_count):
+    key = ("sampler", pin_count)
+    if key not in _programs:
+        @rp2.asm_pio(
+            in_shiftdir=rp2.PIO.SHIFT_RIGHT,
+            autopush=True,
+            push_thresh=32
+        )
+        def sampler():
+            wrap_target()
+            in_(pins, pin_count)    # one sample per cycle
+            wrap()
+
+        _programs[key] = sampler
+    return _programs[key]
+
+def _trigger(pin_count):
+    key = ("trigger", pin_count)
+    if key not in _programs:
+        @rp2.asm_pio(
+            in_shiftdir=rp2.PIO.SHIFT_LEFT,
+            autopush=False,
+            autopull=False
+        )
+        def trigger():
+            pull()                  # get the pattern
+            mov(y, osr)
+            pull()                  # get the word for the DMA, keep it in osr
+
+            label("idle")           # wait until the pattern is absent
+            mov(isr, null)
+            in_(pins, pin_count)
+            mov(x, isr)
+            jmp(x_not_y, "armed")
+            jmp("idle")
+
+            label("armed")          # wait for the pattern
+            mov(isr, null)
+            in_(pins, pin_count)
+            mov(x, isr)
+            jmp(x_not_y, "armed")
+
+            mov(isr, osr)           # tell the DMA
+            push(noblock)
+            label("end")
+            jmp("end")
+
+        _programs[key] = trigger
+    return _programs[key]
+
+#
+# Assemble a DMA control word for 32 bit transfers without increment:
+# channel to chain to, TREQ
+#
+def _dma_ctrl(chain_to, treq):
+    return ((1 << 21) | (treq << 15) | (chain_to << 11) | (2 << 2) |
+            (1 << 1) | 1)  # IRQ_QUIET, HIGH_PRIORITY, EN
+
+
+class LogicAnalyzer:
+    # pin_base: the first pin to sample, pin_count: the number of pins,
+    # one of 1, 2, 4, 8, 16 or 32. freq: the sample rate, up to
+    # machine.freq(). samples: the size of the ring in samples. It must
+    # result in a power of 2 words of up to 8192 words.
+    def __init__(self, pin_base, pin_count=8, freq=1_000_000, samples=8192, pio=None):
+        if pin_count not in (1, 2, 4, 8, 16, 32):
+            raise ValueError("pin_count must be 1, 2, 4, 8, 16 or 32")
+        self.pin_base = pin_base
+        self.pin_count = pin_count
+        self.freq = freq
+        self.per_word = 32 // pin_count  # samples per word
+        self.words = samples // self.per_word
+        self.ring = rp2_util.dma_ring_buffer("I", self.words)
+        self.sampler = _sampler(pin_count)
+        self.sm_nr = rp2_util.sm_claim(self.sampler, pio=pio)
+        self.pio = self.sm_nr // 4
+        self.sm = rp2.StateMachine(self.sm_nr, self.sampler, freq=freq, in_base=pin_base)
+        self.trig_nr = None
+        self.trig_sm = None
+        self.chans = [rp2_util.dma_claim() for _ in range(4)]  # ring, post, pause, start
+        self.regs = array.array("I", bytearray(16))
+        self.data = None
+        self.trigger = None
+
+    # Return the state machines and the DMA channels
+    def deinit(self):
+        self._stop()
+        rp2_util.sm_release(self.sm_nr)
+        if self.trig_nr is not None:
+            rp2_util.sm_release(self.trig_nr)
+        for chan in self.chans:
+            rp2_util.dma_release(chan)
+        self.chans = []
+        self.trig_nr = None
+
+    def _stop(self):
+        rp2_util.sm_enable_mask(self.pio, 1 << (self.sm_nr % 4), 0)
+        if self.trig_nr is not None:
+            rp2_util.sm_enable_mask(self.pio, 1 << (self.trig_nr % 4), 0)
+        for chan in self.chans:
+            rp2_util.dma_abort(chan)
+
+    def _trigger_sm(self, trigger_pin, trigger_count):
+        if self.trig_nr is not None:
+            rp2_util.sm_release(self.trig_nr)
+            self.trig_nr = None
+        program = _trigger(trigger_count)
+        self.trig_nr = rp2_util.sm_claim(program, pio=self.pio)
+        self.trig_sm = rp2.StateMachine(self.trig_nr, program, in_base=trigger_pin)
+
+    # Capture the samples around the moment, when the trigger_count pins
+    # starting at trigger_pin change to pattern, with bit 0 of pattern
+    # for trigger_pin. post is the number of samples after the trigger,
+    # by default half of the ring. Returns the index of the trigger sample
+    # in self.data, which holds the samples in order. If the pattern does
+    # not occur within timeout_ms, the last samples are returned, and
+    # the trigger index is None.
+    def capture(self, trigger_pin, pattern, trigger_count=1, post=None, timeout_ms=1000):
+        if post is None:
+            post = self.words * self.per_word // 2
+        post_words = max(1, min(self.words, (post + self.per_word - 1) // self.per_word))
+        ring_chan, post_chan, pause_chan, start_chan = self.chans
+        self._trigger_sm(trigger_pin, trigger_count)
+        sm_nr, trig_nr = self.sm_nr, self.trig_nr
+        base = PIO0_BASE if self.pio == 0 else PIO1_BASE
+
+        self.sm.active(0)
+        self.sm.restart()
+        rp2_util.sm_fifo_join(sm_nr, 1)  # 8 words RX FIFO, which clears it
+        self.trig_sm.restart()
+        ring_ctrl = rp2_util.sm_dma_get_ring(ring_chan, sm_nr, self.ring, self.words)
+        self.trig_sm.put(pattern & ((1 << trigger_count) - 1))
+        self.trig_sm.put(ring_ctrl & ~1)  # the pause word: EN cleared
+        # the post-trigger channel, continuing the ring at the write
+        # address written by the start channel
+        regs = self.regs
+        regs[0] = base + PIO_RXF0 + (sm_nr % 4) * 4
+        regs[1] = rp2_util.dma_write_addr(ring_chan)  # replaced at the trigger
+        regs[2] = post_words
+        regs[3] = (ring_ctrl & ~(0xf << 11)) | (post_chan << 11)
+        rp2_util.dma_config(post_chan, regs)
+        # the pause channel, waiting for the word of the trigger
+        regs[0] = base + PIO_RXF0 + (trig_nr % 4) * 4
+        regs[1] = DMA_BASE + ring_chan * 0x40 + DMA_CTRL_ALIAS
+        regs[2] = 1
+        regs[3] = _dma_ctrl(start_chan, (trig_nr % 4) + (4 if trig_nr < 4 else 12))
+        rp2_util.dma_config(pause_chan, regs)
+        # the start channel, copying the write address of the ring channel
+        regs[0] = DMA_BASE + ring_chan * 0x40 + DMA_WRITE_ADDR
+        regs[1] = DMA_BASE + post_chan * 0x40 + DMA_WRITE_ADDR_TRIG
+        regs[2] = 1
+        regs[3] = _dma_ctrl(start_chan, TREQ_PERMANENT)
+        rp2_util.dma_config(start_chan, regs)
+        rp2_util.dma_trigger(pause_chan)
+        rp2_util.sm_enable_mask(self.pio, (1 << (sm_nr % 4)) | (1 << (trig_nr % 4)), 1)
+
+        start = time.ticks_ms()
+        triggered = False
+        while time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
+            # the post channel has started and taken all its samples
+            if rp2_util.dma_transfer_count(pause_chan) == 0 and \
+                    not rp2_util.dma_busy(start_chan) and \
+                    rp2_util.dma_transfer_count(post_chan) == 0 and \
+                    not rp2_util.dma_busy(post_chan):
+                triggered = True
+                break
+        # read the transfer count before the abort clears it
+        rp2_util.sm_enable_mask(self.pio, (1 << (sm_nr % 4)) | (1 << (trig_nr % 4)), 0)
+        pre_words = (0xffffffff - rp2_util.dma_transfer_count(ring_chan)) & 0xffffffff
+        self._stop()
+        if triggered:
+            total = pre_words + post_words
+        else:
+            total = pre_words
+        data = array.array("I", bytearray(4 * min(total, self.words)))
+        mv = memoryview(data)
+        if total <= self.words:
+            mv[:] = self.ring[:total]
+            trigger_word = pre_words
+        else:
+            end = total % self.words
+            mv[:self.words - end] = self.ring[end:]
+            mv[self.words - end:] = self.ring[:end]
+            trigger_word = self.words - post_words
+        self.data = data
+        self.trigger = None
+        if triggered:
+            self.trigger = self._find_trigger(trigger_word * self.per_word,
+                                              trigger_pin, trigger_count, pattern)
+        return self.trigger
+
+    # The trigger state machine sees the pattern a few cycles late, and
+    # the pause of the ring channel moves the split by up to a word. So
+    # look for the change to the pattern in the samples around the split,
+    # if the trigger pins are sampled.
+    def _find_trigger(self, split, trigger_pin, trigger_count, pattern):
+        shift = trigger_pin - self.pin_base
+        if shift < 0 or shift + trigger_count > self.pin_count:
+            return split
+        mask = ((1 << trigger_count) - 1) << shift
+        pattern = (pattern << shift) & mask
+        first = max(1, split - 2 * self.per_word - 8)
+        last = min(len(self), split + 2 * self.per_word)
+        for i in range(last - 1, first - 1, -1):
+            if self[i] & mask == pattern and self[i - 1] & mask != pattern:
+                return i
+        return split
+
+    # The number of samples captured
+    def __len__(self):
+        return 0 if self.data is None else len(self.data) * self.per_word
+
+    # The pin levels of sample i as integer, with bit 0 for pin_base
+    def __getitem__(self, i):
+        word = self.data[i // self.per_word]
+        if self.pin_count == 32:
+            return word
+        return (word >> ((i % self.per_word) * self.pin_count)) & ((1 << self.pin_count) - 1)
+
+    # Write the capture as Value Change Dump, which can be viewed on the
+    # host e.g. with GTKWave or PulseView. stream is a file opened for
+    # writing, names an optional list of signal names.
+    def export_vcd(self, stream, names=None):
+        n = self.pin_count
+        if names is None:
+            names = ["GP{}".format(self.pin_base + i) for i in range(n)]
+        ids = [chr(33 + i) for i in range(n)]
+        stream.write("$timescale 1 ps $end\n$scope module logic $end\n")
+        for i in range(n):
+            stream.write("$var wire 1 {} {} $end\n".format(ids[i], names[i]))
+        stream.write("$upscope $end\n$enddefinitions $end\n")
+        if self.trigger is not None:
+            stream.write("$comment trigger at sample {} $end\n".format(self.trigger))
+        period = 1_000_000_000_000 // self.freq
+        last = None
+        for i in range(len(self)):
+            value = self[i]
+            if value != last:
+                changed = (1 << n) - 1 if last is None else value ^ last
+                stream.write("#{}\n".format(i * period))
+                for bit in range(n):
+                    if changed >> bit & 1:
+                        stream.write("{}{}\n".format(value >> bit & 1, ids[bit]))
+                last = value
+        stream.write("#{}\n".format(len(self) * period))
@@ -0,0 +1,253 @@
+# Protocol decoders for the pulse durations captured by Pulses.
+# The decoders take the durations chunk by chunk, as they are returned
+# by Pulses.read_stream() or stored by Pulses.get_pulses(), and return
+# the frames as soon as they are complete. So a frame is available a
+# few pulses after its end, and not just when a buffer is full.
+#
+# The timing of a protocol is given by a table of the nominal durations
+# of its symbols in µs. At instantiation, the table is converted into
+# ranges of ticks of the state machine frequency with a tolerance, and
+# a duration is matched by comparing it against these ranges.
+
+#
+# The base class of the decoders. Subclasses define TIMING, the table
+# of symbol durations in µs, and the methods reset() and pulse().
+# freq is the sm_freq of the Pulses instance, active the level of a
+# mark, and tolerance the allowed deviation in percent.
+#
+class Decoder:
+    NAME = ""
+    TIMING = {}
+    TOLERANCE = 25  # percent
+
+    def __init__(self, freq=1_000_000, active=0, tolerance=None):
+        if tolerance is None:
+            tolerance = self.TOLERANCE
+        self.ranges = {}
+        for name, us in self.TIMING.items():
+            self.ranges[name] = (us * (100 - tolerance) * freq // 100_000_000,
+                                 us * (100 + tolerance) * freq // 100_000_000)
+        self.active = active
+        self.level = active
+        self.frames = []
+        self.errors = 0  # frames dropped for a wrong check value
+        self.reset()
+
+    # Set the level of the next duration and drop a partial frame.
+    # Call it with the start level returned by get_pulses() or
+    # start_stream() before feeding the durations.
+    def start(self, level):
+        self.level = level
+        self.reset()
+
+    # Return the first of names, whose range contains duration, or None.
+    def match(self, duration, *names):
+        for name in names:
+            low, high = self.ranges[name]
+            if low <= duration <= high:
+                return name
+        return None
+
+    # Decode a chunk of durations and return the list of frames
+    # completed by it.
+    def feed(self, durations):
+        for duration in durations:
+            self.pulse(self.level == self.active, duration)
+            self.level ^= 1
+        frames = self.frames
+        self.frames = []
+        return frames
+
+    # Called with the state of the decoder to be cleared
+    def reset(self):
+        pass
+
+    # Called for each duration: mark is True for the active level
+    def pulse(self, mark, duration):
+        pass
+
+#
+# NEC IR protocol: A leader of 9 ms mark and 4.5 ms space, then 32 bits
+# LSB first, each as 560 µs mark and 560 µs or 1690 µs space for 0 or 1,
+# and a final mark. Frames are (address, command, repeat). The address
+# has 16 bits if its second byte is not the inverse of the first one.
+# A repeat code with 2.25 ms space repeats the last frame with repeat True.
+#
+class NEC(Decoder):
+    NAME = "NEC"
+    TIMING = {"leader": 9000, "space": 4500, "repeat": 2250,
+              "mark": 560, "zero": 560, "one": 1690}
+
+    def reset(self):
+        self.state = 0  # 0: idle, 1: leader, 2: bit mark, 3: bit space, 4: repeat
+        self.nbits = 0
+        self.value = 0
+
+    def pulse(self, mark, duration):
+        state = self.state
+        self.state = 0
+        if mark:
+            if self.match(duration, "leader"):
+                self.state = 1
+            elif state == 2 and self.match(duration, "mark"):
+                if self.nbits < 32:
+                    self.state = 3
+                else:
+                    self._frame()
+            elif state == 4 and self.match(duration, "mark") and self.nbits == 32:
+                self.frames.append(self._decode() + (True,))
+        elif state == 1:
+            symbol = self.match(duration, "space", "repeat")
+            if symbol == "space":
+                self.nbits = 0
+                self.value = 0
+                self.state = 2
+            elif symbol == "repeat":
+                self.state = 4
+        elif state == 3:
+            symbol = self.match(duration, "zero", "one")
+            if symbol is not None:
+                if symbol == "one":
+                    self.value |= 1 << self.nbits
+                self.nbits += 1
+                self.state = 2
+
+    def _decode(self):
+        value = self.value
+        address = value & 0xffff
+        if (address >> 8) ^ (address & 0xff) == 0xff:
+            address &= 0xff
+        return (address, (value >> 16) & 0xff)
+
+    def _frame(self):
+        if (self.value >> 24) ^ ((self.value >> 16) & 0xff) == 0xff:
+            self.frames.append(self._decode() + (False,))
+        else:
+            self.errors += 1
+            self.nbits = 0  # no repeats of a bad frame
+
+#
+# Philips RC5 IR protocol: 14 bits of 1.778 ms, MSB first, Manchester
+# coded, with 1 as space followed by mark. The durations are split into
+# half bits of 889 µs. Frames are (address, command, toggle), with the
+# inverted second start bit as bit 6 of the command (RC5X).
+#
+class RC5(Decoder):
+    NAME = "RC5"
+    TIMING = {"half": 889, "full": 1778}
+
+    def reset(self):
+        self.halves = []
+
+    def pulse(self, mark, duration):
+        symbol = self.match(duration, "half", "full")
+        if symbol is None:
+            self.halves = []
+            return
+        halves = self.halves
+        if not halves:
+            if not mark:
+                return  # idle, a frame starts with a mark
+            halves.append(0)  # the space half of the first start bit
+        halves.append(mark)
+        if symbol == "full":
+            halves.append(mark)
+        # the last bit is known with its first half, if that is a mark
+        if len(halves) >= 28 or (len(halves) == 27 and halves[26]):
+            self._frame(halves[:28])
+            self.halves = []
+
+    def _frame(self, halves):
+        if len(halves) == 27:
+            halves.append(0)
+        value = 0
+        for i in range(0, 28, 2):
+            if halves[i] == halves[i + 1]:
+                self.errors += 1
+                return
+            value = (value << 1) | halves[i + 1]
+        command = (value & 0x3f) | ((~value >> 6) & 0x40)
+        self.frames.append(((value >> 6) & 0x1f, command, (value >> 11) & 1))
+
+#
+# DHT22 sensor: a response of 80 µs low and 80 µs high, then 40 bits
+# MSB first, each as 50 µs low and 26 µs or 70 µs high for 0 or 1. The
+# last byte is the checksum. Frames are (humidity, temperature) in %
+# and °C. The mark is the low level, so active is 0.
+#
+class DHT22(Decoder):
+    NAME = "DHT22"
+    TIMING = {"response": 80, "low": 50, "zero": 26, "one": 70}
+    TOLERANCE = 40
+
+    def reset(self):
+        self.state = 0  # 0: idle, 1: response, 2: bit low, 3: bit high
+        self.nbits = 0
+        self.value = 0
+
+    def pulse(self, mark, duration):
+        state = self.state
+        self.state = 0
+        if mark:
+            if state == 2 and self.match(duration, "low"):
+                self.state = 3
+            elif self.match(duration, "response"):
+                self.state = 1
+        elif state == 1 and self.match(duration, "response"):
+            self.nbits = 0
+            self.value = 0
+            self.state = 2
+        elif state == 3:
+            symbol = self.match(duration, "zero", "one")
+            if symbol is not None:
+                self.value = (self.value << 1) | (symbol == "one")
+                self.nbits += 1
+                if self.nbits < 40:
+                    self.state = 2
+                else:
+                    self._frame()
+
+    def _frame(self):
+        data = self.value.to_bytes(5, "big")
+        if (data[0] + data[1] + data[2] + data[3]) & 0xff != data[4]:
+            self.errors += 1
+            return
+        humidity = ((data[0] << 8) | data[1]) / 10
+        temperature = (((data[2] & 0x7f) << 8) | data[3]) / 10
+        if data[2] & 0x80:
+            temperature = -temperature
+        self.frames.append((humidity, temperature))
+
+#
+# Feed the durations of a Pulses stream to a set of decoders:
+# Pulses instance, list of decoders
+# start() starts the stream like Pulses.start_stream(). poll() takes the
+# new durations and returns the completed frames as (name, frame) tuples,
+# with name being the NAME of the decoder. A gap longer than bit_timeout
+# appears as a long duration, which ends or resets a frame. So bit_timeout
+# should be a little longer than the longest symbol of the protocols.
+#
+class StreamDecoder:
+    def __init__(self, pulses_obj, decoders):
+        self.pulses = pulses_obj
+        self.decoders = decoders
+
+    def start(self, ring, start_timeout=100_000, bit_timeout=100_000):
+        level = self.pulses.start_stream(ring, start_timeout, bit_timeout)
+        for decoder in self.decoders:
+            decoder.start(level)
+        return level
+
+    def poll(self):
+        frames = []
+        while True:
+            chunk = self.pulses.read_stream()
+            if len(chunk) == 0:
+                break
+            for decoder in self.decoders:
+                for frame in decoder.feed(chunk):
+                    frames.append((decoder.NAME, frame))
+        return frames
+
+    def stop(self):
+        self.pulses.stop_stream()
@@ -17,35 +17,218 @@ import rp2
 import rp2_util
 import time
 import array
+import uctypes
+import asyncio
+try:
+    import _thread
+except ImportError:
+    _thread = None  # no second core
 
 GET_WORD_SIZE = const(32)
-PUT_WORD_SIZE = const(32)
+
+#
+# Convert the count down values of sm_get_pulses into durations, in place:
+# buffer, number of items, bit_timeout + compensation for handling time,
+# item size in bytes. For 8 and 16 bit items the DMA stored the lower
+# bits of the count down value, and the result is correct modulo 2**8 or
+# 2**16, which is sufficient if the buffer items can hold the bit_timeout.
+#
+@micropython.viper
+def _scale_durations(buffer, n:int, base:int, size:int):
+    if size == 1:
+        buf8 = ptr8(buffer)
+        for i in range(n):
+            buf8[i] = base - buf8[i]
+    elif size == 2:
+        buf16 = ptr16(buffer)
+        for i in range(n):
+            buf16[i] = base - buf16[i]
+    else:
+        buf32 = ptr32(buffer)
+        for i in range(n):
+            buf32[i] = base - buf32[i]
+
+#
+# The size of the items of a buffer in bytes
+#
+def _itemsize(buffer):
+    return len(bytes(memoryview(buffer)[:1]))
+
+#
+# Convert a buffer filled by sm_get_pulses into durations, in place.
+# The first value takes longer than the others.
+#
+def _scale_capture(buffer, bit_timeout):
+    size = _itemsize(buffer)
+    _scale_durations(buffer, 1 if len(buffer) else 0, bit_timeout + 7, size)
+    if len(buffer) > 1:
+        _scale_durations(memoryview(buffer)[1:], len(buffer) - 1, bit_timeout + 3, size)
+
+#
+# Compensate the handling time of sm_put_pulses in place:
+# buffer, number of items, item size in bytes
+#
+@micropython.viper
+def _compensate_put(buffer, n:int, size:int):
+    if size == 1:
+        buf8 = ptr8(buffer)
+        for i in range(n):
+            if buf8[i] > 7:
+                buf8[i] -= 7
+            else:
+                buf8[i] = 0
+    elif size == 2:
+        buf16 = ptr16(buffer)
+        for i in range(n):
+            if buf16[i] > 7:
+                buf16[i] -= 7
+            else:
+                buf16[i] = 0
+    else:
+        buf32 = ptr32(buffer)
+        for i in range(n):
+            if uint(buf32[i]) > 7:
+                buf32[i] -= 7
+            else:
+                buf32[i] = 0
+
+#
+# The PIO program for sending pulses, made for the word size of the DMA
+# transfers. The bus replicates 8 and 16 bit writes over the 32 bit TX
+# FIFO register, so the program takes word_size bits of each entry, and
+# the pull threshold tells sm_dma_put() the transfer size. The programs
+# are kept, such that instances with the same word size share them.
+#
+_put_programs = {}
+
+def _put_program(word_size):
+    if word_size not in _put_programs:
+        @rp2.asm_pio(
+            out_init=rp2.PIO.OUT_HIGH ,
+            out_shiftdir=rp2.PIO.SHIFT_RIGHT,
+            autopull=False,
+            pull_thresh=word_size
+        )
+        def sm_put_pulses():
+            set(pindirs, 1)         # set the Pin to output
+            pull()                  # get the number of pulses
+            mov(y, osr)
+            pull()                  # get start level
+            mov(isr, osr)           # save to isr
+            jmp("check_done")       # check pulse count
+
+    # This is the main loop issueing the pulses
+            label("pulse_loop")
+            pull()                  # get the duration
+            out(x, word_size)
+            mov(osr, isr)           # restore bit level from isr
+            mov(isr, invert(isr))   # and toggle isr
+            jmp(x_dec, "set_pin")   # test pulse length
+            jmp("check_done")       # if zero, next pulse
+
+            label("set_pin")        # now set the pin value
+            out(pins, 1)
+
+            label("count")          # wait x ticks
+            jmp(x_dec, "count")
+
+            label("check_done")     # check if more to do
+            jmp(y_dec, "pulse_loop") # and start over
+
+            label("end")
+            irq(noblock, rel(0))    # wave finished!
+            label("halt")           # do not pull the words left in the
+            jmp("halt")             # TX FIFO by put_pulses_loop()
+
+        _put_programs[word_size] = sm_put_pulses
+    return _put_programs[word_size]
 
 
 class Pulses:
-    def __init__(self, get_pin=None, put_pin=None, sm_freq=1_000_000):
+    # The state machines and the DMA channels are claimed at the first
+    # use of the methods for getting or putting pulses, such that an
+    # instance does not touch the hardware until it is used.
+    def __init__(self, get_pin=None, put_pin=None, sm_freq=1_000_000,
+                 get_sm=None, put_sm=None, word_size=32):
+        if get_pin is not None and (sm_freq * 2) > machine.freq():
+            raise ValueError("frequency too high")
+        if put_pin is not None and sm_freq > machine.freq():
+            raise ValueError("frequency too high")
+        if word_size not in (8, 16, 32):
+            raise ValueError("word size must be 8, 16 or 32")
+        self.get_pin = get_pin
+        self.put_pin = put_pin
+        self.sm_freq = sm_freq
+
         self.get_done = False
-        self.sm_get_nr = 0
-        if get_pin is not None:
-            if (sm_freq * 2) > machine.freq():
-                raise (ValueError, "frequency too high")
-            self.sm_get = rp2.StateMachine(self.sm_get_nr, self.sm_get_pulses,
-                freq=sm_freq * 2, jmp_pin=get_pin, in_base=get_pin,
-                set_base=get_pin)
-            self.sm_get.irq(self.irq_finished)
-        else:
-            self.sm_get = None
+        self.get_flag = asyncio.ThreadSafeFlag()
+        self.get_sm = get_sm  # the state machine number asked for
+        self.sm_get_nr = None
+        self.sm_get = None
+        self.dma_get_chan = None
+        self.dma_get_chan2 = None  # for the start state
+        self.get_start = bytearray(4)
+        self.ring = None
+        self.get_stalled = False  # the state machine waited for the DMA
 
         self.put_done = False
-        self.sm_put_nr = 4
-        if put_pin is not None:
-            if (sm_freq) > machine.freq():
-                raise (ValueError, "frequency too high")
-            self.sm_put = rp2.StateMachine(self.sm_put_nr, self.sm_put_pulses,
-                freq=sm_freq, out_base=put_pin)
-            self.sm_put.irq(self.irq_finished)
-        else:
-            self.sm_put = None
+        self.put_flag = asyncio.ThreadSafeFlag()
+        self.put_sm = put_sm
+        self.sm_put_nr = None
+        self.sm_put = None
+        self.put_word_size = word_size
+        self.sm_put_pulses = _put_program(word_size)
+        self.dma_put_chan = None
+        self.dma_put_chan2 = None  # for put_pulses_stream and put_pulses_loop
+        self.loop_addr = None  # read by the control channel
+        self.loop_buffer = None
+        self.put_stalled = False  # the stream did not keep up
+
+    # Claim the state machine and the DMA channels for getting pulses,
+    # unless done before
+    def _get_setup(self):
+        if self.sm_get is not None:
+            return
+        if self.get_pin is None:
+            raise ValueError("get_pulses is not enabled")
+        self.sm_get_nr = rp2_util.sm_claim(self.sm_get_pulses, sm=self.get_sm)
+        self.sm_get = rp2.StateMachine(self.sm_get_nr, self.sm_get_pulses,
+            freq=self.sm_freq * 2, jmp_pin=self.get_pin, in_base=self.get_pin,
+            set_base=self.get_pin)
+        self.sm_get.irq(self.irq_finished)
+        self.dma_get_chan = rp2_util.dma_claim()
+        self.dma_get_chan2 = rp2_util.dma_claim()
+
+    # The same for putting pulses
+    def _put_setup(self):
+        if self.sm_put is not None:
+            return
+        if self.put_pin is None:
+            raise ValueError("put_pulses is not enabled")
+        self.sm_put_nr = rp2_util.sm_claim(self.sm_put_pulses, sm=self.put_sm)
+        self.sm_put = rp2.StateMachine(self.sm_put_nr, self.sm_put_pulses,
+            freq=self.sm_freq, out_base=self.put_pin)
+        self.sm_put.irq(self.irq_finished)
+        self.dma_put_chan = rp2_util.dma_claim()
+        self.dma_put_chan2 = rp2_util.dma_claim()
+
+    # Return the state machines and the DMA channels. They are claimed
+    # again at the next use.
+    def deinit(self):
+        self.stop_stream()
+        self.stop_loop()
+        for sm, sm_nr in ((self.sm_get, self.sm_get_nr), (self.sm_put, self.sm_put_nr)):
+            if sm is not None:
+                sm.irq(None)
+                rp2_util.sm_release(sm_nr)
+        self.sm_get = self.sm_put = None
+        self.sm_get_nr = self.sm_put_nr = None
+        for chan in (self.dma_get_chan, self.dma_get_chan2,
+                     self.dma_put_chan, self.dma_put_chan2):
+            if chan is not None:
+                rp2_util.dma_release(chan)
+        self.dma_get_chan = self.dma_get_chan2 = None
+        self.dma_put_chan = self.dma_put_chan2 = None
 
     @staticmethod
     @rp2.asm_pio(
@@ -114,111 +297,696 @@ class Pulses:
         label("end")
         irq(noblock, rel(0))        # get finished!
 
-    @staticmethod
-    @rp2.asm_pio(
-        out_init=rp2.PIO.OUT_HIGH ,
-        out_shiftdir=rp2.PIO.SHIFT_RIGHT,
-        autopull=False,
-        pull_thresh=PUT_WORD_SIZE
-    )
-    def sm_put_pulses():
-        set(pindirs, 1)         # set the Pin to output
-        pull()                  # get the number of pulses
-        mov(y, osr)
-        pull()                  # get start level
-        mov(isr, osr)           # save to isr
-        jmp("check_done")       # check pulse count
-
-# This is the main loop issueing the pulses
-        label("pulse_loop")
-        pull()                  # get the duration
-        out(x, PUT_WORD_SIZE)
-        mov(osr, isr)           # restore bit level from isr
-        mov(isr, invert(isr))   # and toggle isr
-        jmp(x_dec, "set_pin")   # test pulse length
-        jmp("check_done")       # if zero, next pulse
-
-        label("set_pin")        # now set the pin value
-        out(pins, 1)
-
-        label("count")          # wait x ticks
-        jmp(x_dec, "count")
-
-        label("check_done")     # check if more to do
-        jmp(y_dec, "pulse_loop") # and start over
-
-        label("end")
-        irq(noblock, rel(0))    # wave finished!
-
     def irq_finished(self, sm):
         if sm == self.sm_put:  # put irq?
+            self.stop_loop()  # the pulse count of put_pulses_loop is done
             self.put_done = True
+            self.put_flag.set()
         else:
             self.get_done = True
+            self.get_flag.set()
 
     def get_pulses(self, buffer, start_timeout=100_000, bit_timeout=100_000):
-        if self.sm_get is None:
-            raise(ValueError, "get_pulses is not enabled")
+        self._start_get(buffer, start_timeout, bit_timeout)
+        while self.get_done is False:  # wait for the state machine
+            pass
+        return self._finish_get(buffer, bit_timeout)
+
+    # Like get_pulses(), but waits for the end of the capture without
+    # blocking other tasks. It is woken by the IRQ of the state machine.
+    async def get_pulses_async(self, buffer, start_timeout=100_000, bit_timeout=100_000):
+        self._start_get(buffer, start_timeout, bit_timeout)
+        await self.get_flag.wait()
+        return self._finish_get(buffer, bit_timeout)
+
+    def _start_get(self, buffer, start_timeout, bit_timeout):
+        self._get_setup()
         self.get_done = False
+        self.get_flag.clear()
         self.sm_get.restart()
+        # the push threshold tells the DMA the transfer size
+        rp2_util.sm_push_thresh(self.sm_get_nr, _itemsize(buffer) * 8)
+        # The first DMA channel gets the start state and starts the second
+        # one for the pulses, such that the state machine never waits.
+        self.get_start[0] = 0
+        rp2_util.sm_dma_get_setup(self.dma_get_chan2, self.sm_get_nr, self.get_start, 1)
+        if len(buffer) > 0:
+            rp2_util.sm_dma_get_setup(self.dma_get_chan, self.sm_get_nr, buffer, len(buffer))
+            rp2_util.dma_chain_to(self.dma_get_chan2, self.dma_get_chan)
+        rp2_util.dma_trigger(self.dma_get_chan2)
+        rp2_util.dma_stats_begin(self.dma_get_chan)
         self.sm_get.put(start_timeout)  # set the start timeout
         self.sm_get.put(len(buffer))  # set number of pulses
         self.sm_get.put(bit_timeout)  # set the bit timeout
-
+        rp2_util.sm_fdebug_clear(self.sm_get_nr, rp2_util.SM_FDEBUG_ALL)  # clear the stall flags
         self.sm_get.active(1)
-        start_state = self.sm_get.get()  # get the start state
-        # rp2_util.sm_dma_get(0, 0, buffer, len(buffer))
-        # while (rp2_util.sm_dma_count(0)) > 0:
-            # pass
-        self.sm_get.get(buffer)  # get data
+
+    # Wait for the DMA and return the start level. With scale=False, the
+    # count down values are left in the buffer for _scale_capture().
+    def _finish_get(self, buffer, bit_timeout, scale=True):
+        # the DMA may still be moving the last values
+        while rp2_util.dma_busy(self.dma_get_chan2) or rp2_util.dma_busy(self.dma_get_chan):
+            pass
         self.sm_get.active(0)
-        buffer[0] = bit_timeout - buffer[0] + 7  # scale the first value
-        for i in range(1, len(buffer)):  # scale the other values
-            buffer[i] = bit_timeout - buffer[i] + 3
-        return start_state
+        rp2_util.dma_stats_end(self.dma_get_chan)
+        # the state machine stalls at the pull() after the end, which is
+        # not counted. A stall at push() delays the timing of the pulse.
+        rp2_util.sm_fdebug_clear(self.sm_get_nr, rp2_util.SM_FDEBUG_TXSTALL)
+        self.get_stalled = bool(rp2_util.sm_fdebug(self.sm_get_nr) & rp2_util.SM_FDEBUG_RXSTALL)
+        if scale:
+            _scale_capture(buffer, bit_timeout)
+        return self.get_start[0]
+
+    # Stop a capture started by _start_get(), which did not finish
+    def _stop_get(self):
+        self.sm_get.active(0)
+        rp2_util.dma_abort(self.dma_get_chan2)
+        rp2_util.dma_abort(self.dma_get_chan)
+        # drop the parameters left in the TX FIFO, when the capture waits
+        # for the start, and the values in the RX FIFO
+        rp2_util.sm_fifo_join(self.sm_get_nr, 2)
+        rp2_util.sm_fifo_join(self.sm_get_nr, 0)
 
     def put_pulses(self, buffer, start_level=1):
-        if self.sm_put is None:
-            raise(ValueError, "put_pulses is not enabled")
+        self._start_put(buffer, start_level)
+        while self.put_done is False:  # and wait for getting is done
+            time.sleep_ms(1)
+
+        self.sm_put.active(0)
+        rp2_util.dma_stats_end(self.dma_put_chan)
+
+    # Like put_pulses(), but waits for the end of the pulse train without
+    # blocking other tasks. It is woken by the IRQ of the state machine.
+    async def put_pulses_async(self, buffer, start_level=1):
+        self._start_put(buffer, start_level)
+        await self.put_flag.wait()
+        self.sm_put.active(0)
+        rp2_util.dma_stats_end(self.dma_put_chan)
+
+    def _start_put(self, buffer, start_level):
+        self._put_setup()
+        self.stop_loop()
+        size = self._put_itemsize(buffer)
         self.put_done = False
-        print(buffer)
+        self.put_flag.clear()
         # compensate handling time
-        for i in range(len(buffer)):
-            buffer[i] = max(0, buffer[i] - 7)
+        _compensate_put(buffer, len(buffer), size)
         self.sm_put.restart()
         self.sm_put.active(1)
         self.sm_put.put(len(buffer))   # tell the size
         self.sm_put.put(start_level != 0) # tell the start level
         # self.sm_put.put(buffer)        # send the pulse train
-        rp2_util.sm_dma_put(0, 4, buffer, len(buffer))
-        while self.put_done is False:  # and wait for getting is done
-            time.sleep_ms(1)
+        rp2_util.sm_dma_put(self.dma_put_chan, self.sm_put_nr, buffer, len(buffer))
+        rp2_util.dma_stats_begin(self.dma_put_chan)
+
+    # The item size of a buffer for sending in bytes, which must match the
+    # word size of the instance
+    def _put_itemsize(self, buffer):
+        size = _itemsize(buffer) if len(buffer) else self.put_word_size // 8
+        if size * 8 != self.put_word_size:
+            raise ValueError("buffer does not match the word size")
+        return size
+
+    # Send a pulse train of unlimited length, supplied piecewise.
+    # buffer is an array of the word size of the instance, e.g. of type
+    # "I" for 32 bit, which is split into two halves. While
+    # one half is sent by one DMA channel, the other half is refilled and
+    # its channel is chained to the first one. source is either a callable,
+    # which gets a memoryview of the half to be filled and returns the
+    # number of values filled in, or an iterable of pulse durations.
+    # The pulse train ends when a half is not filled completely.
+    def put_pulses_stream(self, source, buffer, start_level=1):
+        self._put_setup()
+        self.stop_loop()
+        itemsize = self._put_itemsize(buffer)
+        if callable(source):
+            fill = source
+        else:
+            source = iter(source)
+            fill = lambda half: self._fill_from(source, half)
+        size = len(buffer) // 2
+        halves = (memoryview(buffer)[:size], memoryview(buffer)[size:2 * size])
+        chans = (self.dma_put_chan, self.dma_put_chan2)
+        counts = [fill(halves[0]), 0]
+        if counts[0] == 0:
+            return
+        if counts[0] == size:
+            counts[1] = fill(halves[1])
+        for i in range(2):
+            _compensate_put(halves[i], counts[i], itemsize)
+
+        self.put_done = False
+        self.sm_put.restart()
+        self.sm_put.put(0xffffffff)   # tell the size: almost endless
+        self.sm_put.put(start_level != 0) # tell the start level
+        # Set up both channels. The state machine is not active yet, so the
+        # first channel stops when the TX FIFO is full. A half is chained
+        # only after it has been filled, such that a late refill does not
+        # restart a channel with stale data.
+        rp2_util.sm_dma_put_setup(chans[0], self.sm_put_nr, halves[0], counts[0])
+        if counts[1] > 0:
+            rp2_util.sm_dma_put_setup(chans[1], self.sm_put_nr, halves[1], counts[1])
+            rp2_util.dma_chain_to(chans[0], chans[1])
+        rp2_util.dma_trigger(chans[0])
+        for i in range(2):
+            if counts[i] > 0:
+                rp2_util.dma_stats_begin(chans[i])
+        rp2_util.sm_fdebug_clear(self.sm_put_nr, rp2_util.SM_FDEBUG_ALL)  # clear the stall flags
+        self.put_stalled = False
+        self.sm_put.active(1)
 
+        last = counts[1] < size
+        current = 0
+        while not last:
+            other = 1 - current
+            while rp2_util.dma_busy(chans[current]):
+                pass
+            rp2_util.dma_stats_end(chans[current])
+            # the state machine must not wait for data until the last half
+            if rp2_util.sm_fdebug(self.sm_put_nr) & rp2_util.SM_FDEBUG_TXSTALL:
+                self.put_stalled = True
+            # the other half is sent now, do not chain back yet
+            rp2_util.dma_chain_to(chans[other], chans[other])
+            count = fill(halves[current])
+            last = count < size
+            if count > 0:
+                _compensate_put(halves[current], count, itemsize)
+                rp2_util.dma_rearm_read(chans[current], halves[current], count)
+                rp2_util.dma_stats_begin(chans[current])
+                if last:  # end the chain after this half
+                    rp2_util.dma_chain_to(chans[current], chans[current])
+                rp2_util.dma_chain_to(chans[other], chans[current])
+                # If the other half was finished before the chain was set,
+                # this half was never started, and its read address is
+                # still at its start. Otherwise it runs or has run.
+                if not rp2_util.dma_busy(chans[other]) and \
+                        not rp2_util.dma_busy(chans[current]) and \
+                        rp2_util.dma_read_addr(chans[current]) == uctypes.addressof(halves[current]):
+                    self.sm_put.active(0)
+                    self.put_stalled = True
+                    raise RuntimeError("put_pulses_stream underrun")
+            current = other
+
+        # wait until the DMA is finished and the last pulse is sent,
+        # which is when the state machine stalls at the pull()
+        while rp2_util.dma_busy(chans[0]) or rp2_util.dma_busy(chans[1]):
+            pass
+        for chan in chans:
+            rp2_util.dma_stats_end(chan)
+        rp2_util.sm_fdebug_clear(self.sm_put_nr, rp2_util.SM_FDEBUG_ALL)  # clear earlier stalls
+        while not rp2_util.sm_fdebug_clear(self.sm_put_nr, rp2_util.SM_FDEBUG_TXSTALL):
+            pass
         self.sm_put.active(0)
 
+    @staticmethod
+    def _fill_from(source, half):
+        count = 0
+        if len(half) > 0:
+            for value in source:
+                half[count] = value
+                count += 1
+                if count == len(half):
+                    break
+        return count
+
+    # Send the pulse train of buffer repeat times, or with repeat=0 until
+    # stop_loop() is called. The DMA channel sending the buffer is
+    # restarted by the second channel each time it is done, such that the
+    # repetitions follow without a gap and without the CPU. The state
+    # machine stops after len(buffer) * repeat pulses, and its IRQ aborts
+    # the DMA channels. The total number of pulses is limited to 2**32-1
+    # in both modes. The method returns at once. The end is signalled like for
+    # put_pulses() by put_done and put_flag. The durations are compensated
+    # in place, like put_pulses() does. With an odd number of durations,
+    # the levels are inverted at every other repetition.
+    def put_pulses_loop(self, buffer, repeat=0, start_level=1):
+        self._put_setup()
+        if len(buffer) == 0:
+            raise ValueError("empty buffer")
+        size = self._put_itemsize(buffer)
+        count = len(buffer) * repeat
+        if count > 0xffffffff:
+            raise ValueError("too many pulses")
+        self.stop_loop()
+        _compensate_put(buffer, len(buffer), size)
+        self.loop_addr = array.array("I", [uctypes.addressof(buffer)])
+        if repeat == 0:
+            count = 0xffffffff  # almost endless
+        self.loop_buffer = buffer
+
+        self.put_done = False
+        self.put_flag.clear()
+        self.sm_put.restart()
+        self.sm_put.put(count)   # tell the total number of pulses
+        self.sm_put.put(start_level != 0) # tell the start level
+        rp2_util.sm_dma_put_setup(self.dma_put_chan, self.sm_put_nr, buffer, len(buffer))
+        rp2_util.dma_reload_read(self.dma_put_chan, self.dma_put_chan2, self.loop_addr, 0)
+        rp2_util.dma_trigger(self.dma_put_chan)
+        self.sm_put.active(1)
+
+    # Stop the pulse train of put_pulses_loop(). The output stays at the
+    # level of the pulse being sent.
+    def stop_loop(self):
+        if self.loop_buffer is not None:
+            self.sm_put.active(0)
+            # break the loop before aborting the channels
+            rp2_util.dma_chain_to(self.dma_put_chan, self.dma_put_chan)
+            rp2_util.dma_abort(self.dma_put_chan2)
+            rp2_util.dma_abort(self.dma_put_chan)
+            # drop the durations left in the TX FIFO by toggling the join
+            rp2_util.sm_fifo_join(self.sm_put_nr, 2)
+            rp2_util.sm_fifo_join(self.sm_put_nr, 0)
+            self.loop_buffer = self.loop_addr = None
+
+    # Continuous capture of pulses into a ring buffer, which must be
+    # a buffer returned by rp2_util.dma_ring_buffer().
+    # The state machine keeps timing pulses and the DMA keeps wrapping
+    # around the buffer, until stop_stream() is called. The second DMA
+    # channel restarts the ring channel after each 2**32 - 1 pulses.
+    def start_stream(self, ring, start_timeout=100_000, bit_timeout=100_000):
+        self._get_setup()
+        self.stop_stream()
+        self.get_done = False
+        self.sm_get.restart()
+        rp2_util.sm_push_thresh(self.sm_get_nr, _itemsize(ring) * 8)
+        self.sm_get.put(start_timeout)  # set the start timeout
+        self.sm_get.put(0xffffffff)  # set number of pulses: almost endless
+        self.sm_get.put(bit_timeout)  # set the bit timeout
+
+        self.sm_get.active(1)
+        start_state = self.sm_get.get()  # get the start state
+        rp2_util.sm_dma_get_ring(self.dma_get_chan, self.sm_get_nr, ring, len(ring))
+        rp2_util.dma_ring_rearm(self.dma_get_chan, self.dma_get_chan2)
+        rp2_util.dma_stats_begin(self.dma_get_chan)
+        rp2_util.sm_fdebug_clear(self.sm_get_nr, rp2_util.SM_FDEBUG_ALL)  # clear the stall of get()
+        self.get_stalled = False
+        self.ring = ring
+        self.ring_addr = uctypes.addressof(ring)
+        self.ring_size = _itemsize(ring)
+        self.ring_read = 0
+        self.ring_first = True
+        self.ring_timeout = bit_timeout
+        self.ring_pulses = 0  # the pulse count at the last refill
+        return start_state
+
+    # Return the durations which arrived since the last call as memoryview
+    # into the ring. The values are valid until the DMA wraps around and
+    # overwrites them. After a wrap, the data up to the end of the ring is
+    # returned, and the next call returns the part at the start.
+    def read_stream(self):
+        if self.ring is None:
+            raise ValueError("no stream started")
+        # The state machine counts the pulses down from 0xffffffff and
+        # ends at 0. So its counter is set to that value again, when half
+        # of it is used. The instruction takes a cycle of the state machine,
+        # which makes the pulse being timed half a tick longer.
+        pulses = (0xffffffff - (rp2_util.dma_transfer_count(self.dma_get_chan) & 0xffffffff)) % 0xffffffff
+        if (pulses - self.ring_pulses) % 0xffffffff >= 0x80000000:
+            self.sm_get.exec("mov(y, invert(null))")
+            self.ring_pulses = pulses
+        write = (rp2_util.dma_write_addr(self.dma_get_chan) - self.ring_addr) // self.ring_size
+        if write >= self.ring_read:
+            chunk = self.ring[self.ring_read:write]
+            self.ring_read = write
+        else:
+            chunk = self.ring[self.ring_read:]
+            self.ring_read = 0
+        if self.ring_first and len(chunk) > 0:
+            _scale_durations(chunk, 1, self.ring_timeout + 7, self.ring_size)
+            _scale_durations(chunk[1:], len(chunk) - 1, self.ring_timeout + 3, self.ring_size)
+            self.ring_first = False  # the first value takes longer
+        else:
+            _scale_durations(chunk, len(chunk), self.ring_timeout + 3, self.ring_size)
+        return chunk
+
+    def stop_stream(self):
+        if self.ring is not None:
+            self.sm_get.active(0)
+            rp2_util.dma_stats_end(self.dma_get_chan)
+            self.get_stalled = bool(rp2_util.sm_fdebug(self.sm_get_nr) & rp2_util.SM_FDEBUG_RXSTALL)
+            rp2_util.dma_ring_stop(self.dma_get_chan, self.dma_get_chan2)
+            self.ring = None
+
+
+#
+# Time the pulses at several pins with a common time base. A state
+# machine with the program of Pulses.get_pulses() is claimed per pin,
+# all on the same PIO. They are set up with a start timeout of 0 and
+# started in the same cycle by one write to the CTRL register of the
+# PIO. So each capture starts at that moment, and its first duration is
+# the time from the start to the first edge at its pin. The sums of the
+# durations of each buffer are then the times of the edges, which line
+# up across the pins.
+#
+class MultiPulses:
+    def __init__(self, pins, sm_freq=1_000_000, pio=None):
+        if not 0 < len(pins) <= 4:
+            raise ValueError("1 to 4 pins")
+        if (sm_freq * 2) > machine.freq():
+            raise ValueError("frequency too high")
+        self.sm_nr = []
+        for p in (0, 1) if pio is None else (pio,):
+            try:
+                for _ in pins:
+                    self.sm_nr.append(rp2_util.sm_claim(Pulses.sm_get_pulses, pio=p))
+                self.pio = p
+                break
+            except RuntimeError:
+                for nr in self.sm_nr:
+                    rp2_util.sm_release(nr)
+                self.sm_nr = []
+        if not self.sm_nr:
+            raise RuntimeError("not enough free state machines on a PIO")
+        self.mask = 0
+        self.sm = []
+        self.dma_chan = []
+        self.dma_chan2 = []  # for the start states
+        for nr, pin in zip(self.sm_nr, pins):
+            self.sm.append(rp2.StateMachine(nr, Pulses.sm_get_pulses,
+                freq=sm_freq * 2, jmp_pin=pin, in_base=pin, set_base=pin))
+            self.mask |= 1 << (nr % 4)
+            self.dma_chan.append(rp2_util.dma_claim())
+            self.dma_chan2.append(rp2_util.dma_claim())
+        self.starts = [bytearray(4) for _ in pins]
+
+    # Return the state machines and the DMA channels
+    def deinit(self):
+        for nr in self.sm_nr:
+            rp2_util.sm_release(nr)
+        for chan in self.dma_chan + self.dma_chan2:
+            rp2_util.dma_release(chan)
+        self.sm_nr = self.sm = self.dma_chan = self.dma_chan2 = []
+
+    # Time the pulses at all pins, starting at once. buffers is a list
+    # with a buffer per pin, as for Pulses.get_pulses(), which may differ
+    # in type and length. Each is filled, so a pin with less pulses ends
+    # with durations of bit_timeout. Returns the list of start levels.
+    def get_pulses(self, buffers, bit_timeout=100_000):
+        if len(buffers) != len(self.sm):
+            raise ValueError("one buffer per pin")
+        for i, buffer in enumerate(buffers):
+            if len(buffer) == 0:
+                raise ValueError("empty buffer")
+            sm_nr = self.sm_nr[i]
+            self.sm[i].active(0)
+            self.sm[i].restart()
+            rp2_util.sm_push_thresh(sm_nr, _itemsize(buffer) * 8)
+            self.starts[i][0] = 0
+            rp2_util.sm_dma_get_setup(self.dma_chan2[i], sm_nr, self.starts[i], 1)
+            rp2_util.sm_dma_get_setup(self.dma_chan[i], sm_nr, buffer, len(buffer))
+            rp2_util.dma_chain_to(self.dma_chan2[i], self.dma_chan[i])
+            rp2_util.dma_trigger(self.dma_chan2[i])
+            self.sm[i].put(0)  # no start timeout: start at once
+            self.sm[i].put(len(buffer))  # set number of pulses
+            self.sm[i].put(bit_timeout)  # set the bit timeout
+        rp2_util.sm_enable_mask(self.pio, self.mask, 1)
+
+        # wait until all DMA transfers are done
+        for i in range(len(buffers)):
+            while rp2_util.dma_busy(self.dma_chan2[i]) or rp2_util.dma_busy(self.dma_chan[i]):
+                pass
+        rp2_util.sm_enable_mask(self.pio, self.mask, 0)
+        for buffer in buffers:
+            # the first value is timed from the start and takes as
+            # long as the first one of get_pulses()
+            _scale_capture(buffer, bit_timeout)
+        return [start[0] for start in self.starts]
+
+#
+# Record the time of each edge at a pin with a free running counter.
+# The state machine counts down x in loops of 2 cycles while it waits
+# for the next edge, and pushes x together with the new level at each
+# edge. When x reaches 0, it is set to 2**31 - 1 again, and the time is
+# pushed with the unchanged level as heartbeat. So the counter values of
+# two consecutive words differ by less than the range of the counter,
+# and read() adds them up to the absolute time without ambiguity. The
+# cycles, which are not counted while an edge is reported, are constant
+# and added by read() as well. The words are stored by the DMA into a
+# ring buffer, as for Pulses.start_stream().
+#
+class Timestamps:
+    RANGE = 0x80000000  # of the counter
+    RISE_CYCLES = 4  # the cycles not counted for a rising edge
+    OTHER_CYCLES = 5  # for a falling edge and a heartbeat
+
+    @staticmethod
+    @rp2.asm_pio(
+        in_shiftdir=rp2.PIO.SHIFT_LEFT,
+        autopull=False,
+        autopush=False,
+        push_thresh=32
+    )
+    def sm_timestamps():
+        pull()                      # get the start value of the counter
+        mov(y, osr)
+        mov(x, y)
+        mov(osr, invert(null))      # ones, for shifting in a 1
+        jmp(pin, "rise")            # report the start level
+
+        label("fall")
+        in_(x, 31)                  # the time
+        in_(null, 1)                # and level 0
+        push(block)
+        label("low")                # wait for a rising edge
+        jmp(pin, "rise")
+        jmp(x_dec, "low")
+        mov(x, y)                   # counter wrapped: heartbeat
+        jmp("fall")
+
+        label("rise")
+        in_(x, 31)                  # the time
+        in_(osr, 1)                 # and level 1
+        push(block)
+        label("high")               # wait for a falling edge
+        jmp(pin, "high_dec")
+        jmp("fall")
+        label("high_dec")
+        jmp(x_dec, "high")
+        mov(x, y)                   # counter wrapped: heartbeat
+        jmp("rise")
+
+    # pin: machine.Pin, defined as input; sm_freq: the frequency of the
+    # state machine, which is the unit of the times. An edge is seen
+    # within 2 cycles, and up to 5 cycles late while the state machine
+    # reports the previous edge or a heartbeat.
+    def __init__(self, pin, sm_freq=1_000_000, sm=None):
+        if sm_freq > machine.freq():
+            raise ValueError("frequency too high")
+        self.sm_nr = rp2_util.sm_claim(self.sm_timestamps, sm=sm)
+        self.sm = rp2.StateMachine(self.sm_nr, self.sm_timestamps,
+            freq=sm_freq, jmp_pin=pin, in_base=pin)
+        self.dma_chan = rp2_util.dma_claim()
+        self.dma_chan2 = rp2_util.dma_claim()  # restarts the ring channel
+        self.ring = None
+        self.stalled = False  # the state machine waited for the DMA
+
+    # Return the state machine and the DMA channels
+    def deinit(self):
+        self.stop()
+        rp2_util.sm_release(self.sm_nr)
+        rp2_util.dma_release(self.dma_chan)
+        rp2_util.dma_release(self.dma_chan2)
+        self.sm = None
+
+    # Start recording into ring, an array of type "I" returned by
+    # rp2_util.dma_ring_buffer(). The time counts from the start.
+    def start(self, ring):
+        self.stop()
+        self.sm.restart()
+        rp2_util.sm_dma_get_ring(self.dma_chan, self.sm_nr, ring, len(ring))
+        rp2_util.dma_ring_rearm(self.dma_chan, self.dma_chan2)
+        self.ring = ring
+        self.ring_addr = uctypes.addressof(ring)
+        self.ring_read = 0
+        self.time = 0
+        self.count = None  # the counter value of the last word
+        self.level = None
+        rp2_util.sm_fdebug_clear(self.sm_nr, rp2_util.SM_FDEBUG_ALL)  # clear the stall flags
+        self.sm.put(self.RANGE - 1)
+        self.sm.active(1)
+
+    # Return the edges, which arrived since the last call, as list of
+    # (time, level) tuples, with time in cycles of sm_freq since the
+    # start. The first tuple tells the level at the start. read() must
+    # be called before the DMA wraps around the ring.
+    def read(self):
+        if self.ring is None:
+            raise ValueError("not started")
+        write = (rp2_util.dma_write_addr(self.dma_chan) - self.ring_addr) // 4
+        ring = self.ring
+        size = len(ring)
+        edges = []
+        while self.ring_read != write:
+            word = ring[self.ring_read]
+            self.ring_read = (self.ring_read + 1) % size
+            count = word >> 1
+            level = word & 1
+            if self.level is None:
+                edges.append((0, level))
+            elif level == self.level:  # heartbeat
+                self.time += 2 * (self.count + 1) + self.OTHER_CYCLES
+            else:
+                self.time += 2 * (self.count - count)
+                if level:
+                    self.time += self.RISE_CYCLES
+                    edges.append((self.time, 1))
+                else:
+                    self.time += self.OTHER_CYCLES
+                    # the pin is sampled one cycle later for a fall
+                    edges.append((self.time - 1, 0))
+            self.count = count
+            self.level = level
+        return edges
+
+    def stop(self):
+        if self.ring is not None:
+            self.sm.active(0)
+            self.stalled = bool(rp2_util.sm_fdebug(self.sm_nr) & rp2_util.SM_FDEBUG_RXSTALL)
+            rp2_util.dma_ring_stop(self.dma_chan, self.dma_chan2)
+            self.ring = None
 
 #
-# Instantiate the class
+# A queue for handing items from one core to the other without a lock.
+# One side only calls put() and the other side only get(). Each index
+# is written by one side only, and a slot is filled before the index is
+# advanced, such that the other side never sees a partial item.
 #
+class _Handoff:
+    def __init__(self, size):
+        self.slots = [None] * (size + 1)
+        self.index = array.array("I", (0, 0))  # put, get
+
+    def put(self, item):
+        index = self.index
+        nxt = (index[0] + 1) % len(self.slots)
+        if nxt == index[1]:
+            return False  # full
+        self.slots[index[0]] = item
+        index[0] = nxt
+        return True
+
+    def get(self):
+        index = self.index
+        if index[1] == index[0]:
+            return None
+        item = self.slots[index[1]]
+        self.slots[index[1]] = None
+        index[1] = (index[1] + 1) % len(self.slots)
+        return item
 
-pulses = Pulses(machine.Pin(10, machine.Pin.IN), machine.Pin(11, machine.Pin.OUT), sm_freq=1_000_000)
+#
+# Capture pulses continuously with a set of buffers and post-process
+# them on the second core. Core 0 only arms the capture with a free
+# buffer and hands the filled one over to a thread on core 1, which
+# converts the values into durations and calls decode(start_level,
+# buffer). The results come back through a second queue.
+# Pulses instance, list of buffers, decode function or None,
+# start_timeout and bit_timeout as for get_pulses()
+#
+class PulseWorker:
+    def __init__(self, pulses_obj, buffers, decode=None,
+                 start_timeout=100_000, bit_timeout=100_000):
+        if _thread is None:
+            raise RuntimeError("_thread is not available")
+        if pulses_obj.get_pin is None:
+            raise ValueError("get_pulses is not enabled")
+        self.pulses = pulses_obj
+        self.decode = decode
+        self.start_timeout = start_timeout
+        self.bit_timeout = bit_timeout
+        self.free = list(buffers)
+        self.returned = []  # buffers handed out by the last poll()
+        self.todo = _Handoff(len(buffers))  # to core 1
+        self.done = _Handoff(len(buffers))  # back to core 0
+        self.buffer = None  # the buffer of the running capture
+        self.running = False
+        self.stopped = True
+
+    # Start the thread on core 1 and the first capture
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.stopped = False
+        _thread.start_new_thread(self._run, ())
+        self._arm()
+
+    # Called on core 0: hand over a finished capture, start the next one
+    # and return the results as list of (start_level, buffer, result)
+    # tuples. The buffers are used again after the next call of poll().
+    def poll(self):
+        self.free.extend(self.returned)
+        self.returned = []
+        if self.buffer is not None and self.pulses.get_done:
+            level = self.pulses._finish_get(self.buffer, self.bit_timeout, False)
+            self.todo.put((self.buffer, level))
+            self.buffer = None
+        self._arm()
+        results = []
+        while True:
+            item = self.done.get()
+            if item is None:
+                break
+            results.append(item)
+            self.returned.append(item[1])
+        return results
+
+    # Stop the thread and a running capture
+    def stop(self):
+        self.running = False
+        while not self.stopped:
+            time.sleep_ms(1)
+        if self.buffer is not None:
+            self.pulses._stop_get()
+            self.free.append(self.buffer)
+            self.buffer = None
+
+    def _arm(self):
+        if self.buffer is None and self.free:
+            self.buffer = self.free.pop(0)
+            self.pulses._start_get(self.buffer, self.start_timeout, self.bit_timeout)
+
+    # The thread on core 1. stopped is set as well, if decode() raises
+    # an exception, such that stop() does not wait forever.
+    def _run(self):
+        try:
+            while self.running:
+                item = self.todo.get()
+                if item is None:
+                    time.sleep_ms(1)
+                    continue
+                buffer, level = item
+                _scale_capture(buffer, self.bit_timeout)
+                result = None
+                if self.decode is not None:
+                    result = self.decode(level, buffer)
+                self.done.put((level, buffer, result))
+        finally:
+            self.stopped = True
 
 #
-# two test functions
+# two test functions, using an instance at GPIO10 and GPIO11, which is
+# created at the first call, such that importing the module does not
+# claim the state machines and the DMA channels
 #
-def get(samples=10, start_timeout=100_000, bit_timeout=100_000):
+pulses = None
+
+def _demo():
     global pulses
+    if pulses is None:
+        pulses = Pulses(machine.Pin(10, machine.Pin.IN), machine.Pin(11, machine.Pin.OUT), sm_freq=1_000_000)
+    return pulses
+
+def get(samples=10, start_timeout=100_000, bit_timeout=100_000):
+    pulses = _demo()
     ar = array.array("I", bytearray(samples * 4))
     start = pulses.get_pulses(ar, start_timeout, bit_timeout)
     print("Start state: ", start)
     print(pulses.get_done, ar)
 
 def put(pattern="10 20 30 40", start=1):
-    global pulses
+    pulses = _demo()
     v = [int(i) for i in pattern.strip().split()]
     ar = array.array("I", v)
     pulses.put_pulses(ar, start)
     print(pulses.put_done)
-
-get()
-put()
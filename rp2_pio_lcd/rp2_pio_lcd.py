@@ -3,37 +3,95 @@
 from lcd_api import LcdApi
 from machine import Pin
 from utime import sleep_ms, sleep_us
+import array
 import rp2
+import rp2_util
+
+
+# Find the next run of changed cells of the framebuffer between start and
+# end, and mark it as shown. A single unchanged cell inside a run is
+# included, since rewriting it costs the same as a new address command.
+# Returns the start of the run * 256 + its length, or 0 if nothing changed.
+@micropython.viper
+def _next_run(fb:ptr8, shown:ptr8, start:int, end:int) -> int:
+    while start < end and fb[start] == shown[start]:
+        start += 1
+    if start >= end:
+        return 0
+    stop = start + 1
+    while stop < end:
+        if fb[stop] != shown[stop]:
+            stop += 1
+        elif stop + 1 < end and fb[stop + 1] != shown[stop + 1]:
+            stop += 2
+        else:
+            break
+    for i in range(start, stop):
+        shown[i] = fb[i]
+    return (start << 8) | (stop - start)
+
+# Pack n data bytes from src as FIFO words into words, see PIOLcd._word().
+# mode is 1 for 4 bit, + 2 for the busy flag programs with 32 bit words.
+@micropython.viper
+def _pack_data(words, src:ptr8, n:int, mode:int):
+    w16 = ptr16(words)
+    w32 = ptr32(words)
+    for i in range(n):
+        value = src[i]
+        if mode == 0:
+            w16[i] = 0x8000 | value << 7
+        elif mode == 1:
+            w16[i] = 0x8400 | (value & 0xf0) << 7 | (value & 0x0f) << 6
+        elif mode == 2:
+            w32[i] = (1 << 31) | value << 23 | 0xff << 7
+        else:
+            w32[i] = (1 << 31) | value << 23 | 0x0f << 15
+
 
 class PIOLcd(LcdApi):
     """Implements a HD44780 character LCD connected via ESP32 GPIO pins."""
 
     def __init__(self, rs_pin, enable_pin=None, data_port=None, fourbit=True,
                  rw_pin=None, backlight_pin=None,
-                 num_lines=2, num_columns=16):
+                 num_lines=2, num_columns=16, busy_flag=False):
         """Constructs the PIOLcd object. The xx_pin arguments must be machine.Pin
         objects. data_port is the number of the lowest order GPIO pin for data, which must
         be consecutive. fourbit tells, whether the display is connected in 4-bit or 8-bit mode.
         enable_pin is the GPIO number of the enable pin.
-        The rw pin isn't used by this library, but if you specify it, then
-        it will be set low.
+        The rw pin is only used with busy_flag=True, and must then be the GPIO
+        following rs_pin. Otherwise, if you specify it, then it will be set low.
         """
         self.rs_pin = rs_pin
         self.rw_pin = rw_pin
         self.backlight_pin = backlight_pin
         self._4bit = fourbit
-        self.rs_pin.init(Pin.OUT)
-        self.rs_pin.value(0)
-        if self.rw_pin:
+        self.busy_flag = busy_flag
+        if busy_flag and rw_pin is None:
+            raise ValueError("busy_flag needs rw_pin")
+        if self.rw_pin and not busy_flag:
             self.rw_pin.init(Pin.OUT)
             self.rw_pin.value(0)
         if self.backlight_pin is not None:
             self.backlight_pin.init(Pin.OUT)
             self.backlight_pin.value(0)
 
-        # activate the four bit state machine in single nibble mode
-        self.sm = rp2.StateMachine(0, self._4bit_write, freq=1000000,
-                        sideset_base=enable_pin, out_base=data_port, pull_thresh=4)
+        # RS, and with busy_flag RW, are driven by the state machine as set
+        # pins. The pull threshold is the size of a FIFO word, which is
+        # smaller during the initialization, since the four bit state
+        # machine starts in single nibble mode.
+        if self._4bit:
+            program = self._4bit_busy if busy_flag else self._4bit_write
+            init_thresh, thresh = 5, (17 if busy_flag else 10)
+        else:
+            program = self._8bit_busy if busy_flag else self._8bit_write
+            init_thresh, thresh = 9, (25 if busy_flag else 9)
+        self.word_shift = 0 if busy_flag else 16
+        self.sm_nr = rp2_util.sm_claim(program)
+        self.sm = rp2.StateMachine(self.sm_nr, program, freq=1000000,
+                        sideset_base=enable_pin, out_base=data_port,
+                        set_base=rs_pin, in_base=data_port, pull_thresh=init_thresh)
+        if busy_flag:
+            self.sm.exec("set(y, 0)")  # no busy flag during the initialization
         self.sm.active(1)
 
         sleep_ms(20)   # Allow LCD time to powerup
@@ -50,55 +108,245 @@ class PIOLcd(LcdApi):
         self.hal_write_init_nibble(cmd)
         sleep_ms(1)
 
-        if self._4bit is True:
-            # switch to dual níbble mode mode by overriding pull_thresh
-            self.sm.active(0)
-            self.sm = rp2.StateMachine(0, self._4bit_write, freq=1000000,
-                            sideset_base=enable_pin, out_base=data_port, pull_thresh=8)
-            self.sm.active(1)
-        else:
-            # switch the state machine to 8 bit
+        if thresh != init_thresh or busy_flag:
             self.sm.active(0)
-            self.sm = rp2.StateMachine(0, self._8bit_write, freq=1000000,
-                            sideset_base=enable_pin, out_base=data_tbase)
-            self.sm.active(1)
+        if thresh != init_thresh:
+            # switch to dual nibble mode by changing pull_thresh in place,
+            # and drop the rest of the last init word from the OSR
+            rp2_util.sm_pull_thresh(self.sm_nr, thresh)
+            self.sm.restart()
+        if busy_flag:
+            # from now on the state machine waits for the busy flag
+            self.sm.exec("set(y, 1)")
+        self.sm.active(1)
+        self.dma_chan = rp2_util.dma_claim()
 
+        # the framebuffer, the cells as shown on the LCD, and the FIFO
+        # words for show(), which are at most an address command and a
+        # character per cell
+        self.fb = bytearray(b" " * (num_lines * num_columns))
+        self.fb_shown = bytearray(self.fb)
+        if busy_flag:
+            self.fb_words = array.array("I", bytearray(8 * len(self.fb)))
+        else:
+            self.fb_words = array.array("H", bytearray(4 * len(self.fb)))
         LcdApi.__init__(self, num_lines, num_columns)
         if num_lines > 1:
             cmd |= self.LCD_FUNCTION_2LINES
         self.hal_write_command(cmd)
 
-    # PIO code for 8 bit output
+    def deinit(self):
+        """Stops the state machine and returns it and the DMA channel to rp2_util."""
+        rp2_util.sm_release(self.sm_nr)
+        rp2_util.dma_release(self.dma_chan)
+
+    def text(self, string, x, y):
+        """Writes string into the framebuffer at column x of line y.
+        Text beyond the end of the line is cut off. The LCD is updated by show().
+        """
+        cols = self.num_columns
+        if not (0 <= y < self.num_lines) or x >= cols:
+            return
+        start = y * cols + x
+        for char in string[:cols - x]:
+            self.fb[start] = ord(char)
+            start += 1
+
+    def fill(self, char=" "):
+        """Fills the framebuffer with char."""
+        for i in range(len(self.fb)):
+            self.fb[i] = ord(char)
+
+    def show(self):
+        """Writes the cells of the framebuffer, which changed since the last
+        show(), to the LCD. Each run of changed cells takes one set DDRAM address
+        command followed by the characters. Commands and characters are sent
+        together by one DMA transfer.
+        """
+        self._wait_dma()
+        words = self.fb_words
+        n = 0
+        cols = self.num_columns
+        for y in range(self.num_lines):
+            pos = y * cols
+            end = pos + cols
+            while True:
+                run = _next_run(self.fb, self.fb_shown, pos, end)
+                if run == 0:
+                    break
+                pos = run >> 8
+                length = run & 0xff
+                words[n] = self._word(self.LCD_DDRAM | self._ddram_addr(pos - y * cols, y), 0)
+                _pack_data(memoryview(words)[n + 1:], memoryview(self.fb_shown)[pos:],
+                           length, self._4bit + 2 * self.busy_flag)
+                n += length + 1
+                pos += length
+        if n:
+            rp2_util.sm_dma_put(self.dma_chan, self.sm_nr, words, n)
+
+    def clear(self):
+        """Clears the LCD and the framebuffer."""
+        LcdApi.clear(self)
+        self.fill()
+        for i in range(len(self.fb_shown)):
+            self.fb_shown[i] = 0x20
+
+    def _ddram_addr(self, x, y):
+        # the same mapping as in LcdApi.move_to()
+        addr = x & 0x3f
+        if y & 1:
+            addr += 0x40
+        if y & 2:
+            addr += self.num_columns
+        return addr
+
+    def _word(self, value, rs):
+        # The FIFO word for a byte: the RS flag followed by the value, left
+        # aligned in 16 bit. In 4 bit mode, each nibble gets the RS flag.
+        # The busy flag programs take 32 bit words with the RS flag, the
+        # value and the directions of the data pins for reading the busy
+        # flag and for writing again.
+        if self.busy_flag:
+            if self._4bit:
+                return rs << 31 | value << 23 | 0x0f << 15
+            return rs << 31 | value << 23 | 0xff << 7
+        if self._4bit:
+            return rs << 15 | (value & 0xf0) << 7 | rs << 10 | (value & 0x0f) << 6
+        return rs << 15 | value << 7
+
+    def _wait_dma(self):
+        # words put by the CPU must not mix with the ones of a DMA transfer
+        while rp2_util.dma_busy(self.dma_chan):
+            pass
+
+    # PIO code for 8 bit output. Each FIFO word holds the RS flag and the
+    # byte. The delays keep the execution time of ~40 µs of the LCD
+    # between bytes, such that they can be sent by DMA.
     @rp2.asm_pio(
         sideset_init=(rp2.PIO.OUT_LOW,),
         out_init=(rp2.PIO.OUT_LOW,) * 8,
+        set_init=rp2.PIO.OUT_LOW,
         out_shiftdir=rp2.PIO.SHIFT_LEFT,
         autopull=True,
-        pull_thresh=8)
+        pull_thresh=9)
     def _8bit_write():
         # fmt: off
+        out(x, 1)               .side(0)        # the RS flag
+        jmp(not_x, "command")   .side(0)
+        set(pins, 1)            .side(0)
+        jmp("write")            .side(0)
+        label("command")
+        set(pins, 0)            .side(0) [1]
+        label("write")
         out(pins, 8)            .side(1)
-        nop()                   .side(0)
+        nop()                   .side(0) [15]
+        nop()                   .side(0) [15]
+        nop()                   .side(0) [5]
         # fmt: on
 
-    # PIO code for 4 bit output
+    # PIO code for 4 bit output. Each nibble is preceded by the RS flag,
+    # and the delays are split over 2 nibbles per byte.
     @rp2.asm_pio(
         sideset_init=(rp2.PIO.OUT_LOW,),
         out_init=(rp2.PIO.OUT_LOW,) * 4,
+        set_init=rp2.PIO.OUT_LOW,
         out_shiftdir=rp2.PIO.SHIFT_LEFT,
         autopull=True,
-        pull_thresh=4)
+        pull_thresh=10)
     def _4bit_write():
         # fmt: off
+        out(x, 1)               .side(0)        # the RS flag
+        jmp(not_x, "command")   .side(0)
+        set(pins, 1)            .side(0)
+        jmp("write")            .side(0)
+        label("command")
+        set(pins, 0)            .side(0) [1]
+        label("write")
+        out(pins, 4)            .side(1)
+        nop()                   .side(0) [15]
+        nop()                   .side(0) [1]
+        # fmt: on
+
+    # PIO code for 8 bit output, which waits for the busy flag of the LCD
+    # after each byte once y is 1. RW is the pin following RS. A FIFO word
+    # holds the RS flag, the byte and the directions of the data pins.
+    @rp2.asm_pio(
+        sideset_init=(rp2.PIO.OUT_LOW,),
+        out_init=(rp2.PIO.OUT_LOW,) * 8,
+        set_init=(rp2.PIO.OUT_LOW,) * 2,
+        out_shiftdir=rp2.PIO.SHIFT_LEFT,
+        in_shiftdir=rp2.PIO.SHIFT_RIGHT,
+        autopull=True,
+        pull_thresh=25)
+    def _8bit_busy():
+        # fmt: off
+        label("next")
+        out(x, 1)               .side(0)        # the RS flag
+        jmp(not_x, "command")   .side(0)
+        set(pins, 1)            .side(0)        # RS = 1, RW = 0
+        jmp("write")            .side(0)
+        label("command")
+        set(pins, 0)            .side(0) [1]
+        label("write")
+        out(pins, 8)            .side(1)
+        nop()                   .side(0)
+        jmp(not_y, "next")      .side(0)        # no busy flag yet
+        out(pindirs, 8)         .side(0)        # release the data pins
+        set(pins, 2)            .side(0)        # RS = 0, RW = 1
+        label("busy")
+        nop()                   .side(1)
+        in_(pins, 8)            .side(1)        # D7 is the busy flag
+        in_(null, 31)           .side(0)
+        mov(x, isr)             .side(0)
+        jmp(x_dec, "busy")      .side(0) [1]
+        set(pins, 0)            .side(0)        # RW = 0 before driving the pins
+        out(pindirs, 8)         .side(0)
+        # fmt: on
+
+    # PIO code for 4 bit output with the busy flag. Both nibbles are sent
+    # from one FIFO word once y is 1, and the busy flag is read with two
+    # E pulses.
+    @rp2.asm_pio(
+        sideset_init=(rp2.PIO.OUT_LOW,),
+        out_init=(rp2.PIO.OUT_LOW,) * 4,
+        set_init=(rp2.PIO.OUT_LOW,) * 2,
+        out_shiftdir=rp2.PIO.SHIFT_LEFT,
+        in_shiftdir=rp2.PIO.SHIFT_RIGHT,
+        autopull=True,
+        pull_thresh=17)
+    def _4bit_busy():
+        # fmt: off
+        label("next")
+        out(x, 1)               .side(0)        # the RS flag
+        jmp(not_x, "command")   .side(0)
+        set(pins, 1)            .side(0)        # RS = 1, RW = 0
+        jmp("write")            .side(0)
+        label("command")
+        set(pins, 0)            .side(0) [1]
+        label("write")
+        out(pins, 4)            .side(1)
+        nop()                   .side(0)
+        jmp(not_y, "next")      .side(0)        # single nibbles, no busy flag yet
         out(pins, 4)            .side(1)
         nop()                   .side(0)
+        out(pindirs, 4)         .side(0)        # release the data pins
+        set(pins, 2)            .side(0)        # RS = 0, RW = 1
+        label("busy")
+        nop()                   .side(1)
+        in_(pins, 4)            .side(1)        # D7 is the busy flag
+        in_(null, 31)           .side(0)
+        mov(x, isr)             .side(0)
+        nop()                   .side(1) [1]    # the low nibble is not used
+        jmp(x_dec, "busy")      .side(0)
+        set(pins, 0)            .side(0)        # RW = 0 before driving the pins
+        out(pindirs, 4)         .side(0)
         # fmt: on
 
     def hal_write_init_nibble(self, nibble):
         """Writes an initialization nibble to the LCD.
         This particular function is only used during initialization.
         """
-        self.sm.put(nibble, 24)
+        self.sm.put(self._word(nibble, 0), self.word_shift)
 
     def hal_backlight_on(self):
         """Allows the hal layer to turn the backlight on."""
@@ -114,21 +362,15 @@ class PIOLcd(LcdApi):
         """Writes a command to the LCD.
         Data is latched on the falling edge of E.
         """
-        self.rs_pin.value(0)
-        self.hal_write_8bits(cmd)
-        if cmd <= 3:
+        self._wait_dma()
+        self.sm.put(self._word(cmd, 0), self.word_shift)
+        if cmd <= 3 and not self.busy_flag:
             # The home and clear commands require a worst
             # case delay of 4.1 msec
             sleep_ms(5)
 
     def hal_write_data(self, data):
         """Write data to the LCD."""
-        self.rs_pin.value(1)
-        self.hal_write_8bits( data)
-
-    def hal_write_8bits(self, value):
-        """Writes 8 bits of data to the LCD."""
-        if self.rw_pin:
-            self.rw_pin.value(0)
-        self.sm.put(value, 24)
+        self._wait_dma()
+        self.sm.put(self._word(data, 1), self.word_shift)
 
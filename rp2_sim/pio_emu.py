@@ -0,0 +1,799 @@
+#
+# Instruction level emulation of the RP2040 PIO for the host simulation
+#
+# This extends rp2_sim.py by
+# - rp2.asm_pio(), assembling PIO programs the same way as the rp2 module
+#   of MicroPython, into the same program format,
+# - an executor, which runs the programs cycle by cycle on the simulated
+#   state machines, with FIFOs, autopush/autopull, side-set, delays,
+#   wrapping, IRQ flags and the 2 cycle input synchronizer,
+# - the GPIO pins, which can be driven from synthetic waveforms and
+#   whose output transitions are recorded,
+# - machine.Pin and the asyncio.ThreadSafeFlag of MicroPython, so that
+#   modules like pulses.py run unchanged on the host.
+#
+# Usage:
+#
+#   import pio_emu
+#   sim = pio_emu.install()
+#   sim.gpio.drive(10, [(0, 1), (1000, 0), (3000, 1)])  # cycles, level
+#   import pulses
+#
+
+import array
+import bisect
+import sys
+import types
+
+import rp2_sim
+
+NUM_GPIO = 30
+
+
+class PIOASMError(Exception):
+    pass
+
+
+#
+# The assembler, following the rp2 module of MicroPython
+#
+
+_PROG_DATA = 0
+_PROG_OFFSET_PIO0 = 1
+_PROG_OFFSET_PIO1 = 2
+_PROG_EXECCTRL = 3
+_PROG_SHIFTCTRL = 4
+_PROG_OUT_PINS = 5
+_PROG_SET_PINS = 6
+_PROG_SIDESET_PINS = 7
+
+
+class PIOASMEmit:
+    def __init__(self, *, out_init=None, set_init=None, sideset_init=None,
+                 in_shiftdir=0, out_shiftdir=0, autopush=False, autopull=False,
+                 push_thresh=32, pull_thresh=32, fifo_join=0):
+        self.labels = {}
+        execctrl = 0
+        shiftctrl = (fifo_join << 30 | (pull_thresh & 0x1f) << 25 |
+                     (push_thresh & 0x1f) << 20 | out_shiftdir << 19 |
+                     in_shiftdir << 18 | autopull << 17 | autopush << 16)
+        self.prog = [array.array("H"), -1, -1, execctrl, shiftctrl,
+                     out_init, set_init, sideset_init]
+        self.wrap_used = False
+        if sideset_init is None:
+            self.sideset_count = 0
+        elif isinstance(sideset_init, int):
+            self.sideset_count = 1
+        else:
+            self.sideset_count = len(sideset_init)
+
+    def start_pass(self, pass_):
+        if pass_ == 1:
+            if not self.wrap_used and self.num_instr:
+                self.wrap()
+            self.delay_max = 31
+            if self.sideset_count:
+                self.sideset_opt = self.num_sideset != self.num_instr
+                if self.sideset_opt:
+                    self.prog[_PROG_EXECCTRL] |= 1 << 30
+                    self.sideset_count += 1
+                self.delay_max >>= self.sideset_count
+        self.pass_ = pass_
+        self.num_instr = 0
+        self.num_sideset = 0
+
+    def __getitem__(self, key):
+        return self.delay(key)
+
+    def delay(self, delay):
+        if self.pass_ > 0:
+            if delay > self.delay_max:
+                raise PIOASMError("delay too large")
+            self.prog[_PROG_DATA][-1] |= delay << 8
+        return self
+
+    def side(self, value):
+        self.num_sideset += 1
+        if self.pass_ > 0:
+            if self.sideset_count == 0:
+                raise PIOASMError("no sideset")
+            elif value >= (1 << self.sideset_count):
+                raise PIOASMError("sideset too large")
+            set_bit = 13 - self.sideset_count
+            self.prog[_PROG_DATA][-1] |= self.sideset_opt << 12 | value << set_bit
+        return self
+
+    def wrap_target(self):
+        self.prog[_PROG_EXECCTRL] = (self.prog[_PROG_EXECCTRL] & ~(0x1f << 7)) | self.num_instr << 7
+
+    def wrap(self):
+        if not self.num_instr:
+            raise PIOASMError("wrap at start of program")
+        self.prog[_PROG_EXECCTRL] = (self.prog[_PROG_EXECCTRL] & ~(0x1f << 12)) | (self.num_instr - 1) << 12
+        self.wrap_used = True
+
+    def label(self, label):
+        if self.pass_ == 0:
+            if label in self.labels:
+                raise PIOASMError("duplicate label {}".format(label))
+            self.labels[label] = self.num_instr
+
+    def word(self, instr, label=None):
+        if label is None or self.pass_ == 0:
+            label = 0
+        else:
+            if label not in self.labels:
+                raise PIOASMError("unknown label {}".format(label))
+            label = self.labels[label]
+        if self.pass_ > 0:
+            self.prog[_PROG_DATA].append(instr | label)
+        self.num_instr += 1
+        return self
+
+    def nop(self):
+        return self.word(0xa042)
+
+    def jmp(self, cond, label=None):
+        if label is None:
+            label = cond
+            cond = 0  # always
+        return self.word(0x0000 | cond << 5, label)
+
+    def wait(self, polarity, src, index):
+        if src == 6:
+            src = 1  # "pin"
+        elif src != 0:
+            src = 2  # "irq"
+        return self.word(0x2000 | polarity << 7 | src << 5 | index)
+
+    def in_(self, src, data):
+        if not 0 < data <= 32:
+            raise PIOASMError("invalid bit count {}".format(data))
+        return self.word(0x4000 | src << 5 | data & 0x1f)
+
+    def out(self, dest, data):
+        if dest == 8:
+            dest = 7  # exec
+        if not 0 < data <= 32:
+            raise PIOASMError("invalid bit count {}".format(data))
+        return self.word(0x6000 | dest << 5 | data & 0x1f)
+
+    def push(self, value=0, value2=0):
+        value |= value2
+        if not value & 1:
+            value |= 0x20  # block by default
+        return self.word(0x8000 | (value & 0x60))
+
+    def pull(self, value=0, value2=0):
+        value |= value2
+        if not value & 1:
+            value |= 0x20  # block by default
+        return self.word(0x8080 | (value & 0x60))
+
+    def mov(self, dest, src):
+        if dest == 8:
+            dest = 4  # exec
+        return self.word(0xa000 | dest << 5 | src)
+
+    def irq(self, mod, index=None):
+        if index is None:
+            index = mod
+            mod = 0  # no modifiers
+        return self.word(0xc000 | (mod & 0x60) | index)
+
+    def set(self, dest, data):
+        return self.word(0xe000 | dest << 5 | data)
+
+
+_pio_funcs = {
+    # source constant for wait
+    "gpio": 0,
+    # source/dest constants for in_, out, mov, set
+    "pins": 0, "x": 1, "y": 2, "null": 3, "pindirs": 4, "pc": 5,
+    "status": 5, "isr": 6, "osr": 7, "exec": 8,
+    # operation functions for mov's src
+    "invert": lambda x: x | 0x08,
+    "reverse": lambda x: x | 0x10,
+    # jmp condition constants
+    "not_x": 1, "x_dec": 2, "not_y": 3, "y_dec": 4, "x_not_y": 5,
+    "pin": 6, "not_osre": 7,
+    # constants for push, pull
+    "noblock": 0x01, "block": 0x21, "iffull": 0x40, "ifempty": 0x40,
+    # constants and modifiers for irq
+    "clear": 0x40,
+    "rel": lambda x: x | 0x10,
+}
+
+
+def asm_pio(**kw):
+    emit = PIOASMEmit(**kw)
+
+    def dec(f):
+        # module globals stay visible, as names defined with const() are
+        # inlined by the MicroPython compiler
+        gl = dict(f.__globals__)
+        gl.update(_pio_funcs)
+        for name in ("wrap_target", "wrap", "label", "word", "nop", "jmp",
+                     "wait", "in_", "out", "push", "pull", "mov", "irq", "set"):
+            gl[name] = getattr(emit, name)
+        gl["__builtins__"] = __builtins__
+        prog = types.FunctionType(f.__code__, gl, f.__name__, f.__defaults__, f.__closure__)
+        emit.start_pass(0)
+        prog()
+        emit.start_pass(1)
+        prog()
+        return emit.prog
+
+    return dec
+
+
+#
+# GPIO pins
+#
+
+class GPIO:
+    def __init__(self, sim):
+        self.sim = sim
+        self.sio_out = 0
+        self.sio_oe = 0
+        self.pio_out = [0, 0]
+        self.pio_oe = [0, 0]
+        self.func = [None] * NUM_GPIO  # None: SIO, 0/1: PIO0/PIO1
+        self.pull = [None] * NUM_GPIO
+        self.waves = {}  # pin: (times, levels)
+        self.traces = {}  # pin: [(time, level)]
+        self.levels = 0
+
+    def drive(self, pin, waveform):
+        # waveform: list of (cycle, level) pairs or a constant level
+        if isinstance(waveform, int):
+            waveform = [(0, waveform)]
+        waveform = sorted(waveform)
+        self.waves[pin] = ([t for t, _ in waveform], [l for _, l in waveform])
+
+    def trace(self, pin):
+        return self.traces.setdefault(pin, [])
+
+    def level_at(self, pin, when):
+        # the level of a traced pin at an earlier time
+        trace = self.traces[pin]
+        i = bisect.bisect_right(trace, (when, 2)) - 1
+        return trace[i][1] if i >= 0 else trace[0][1]
+
+    def _external(self, pin, now):
+        wave = self.waves.get(pin)
+        if wave is None:
+            return 1 if self.pull[pin] == "up" else 0
+        i = bisect.bisect_right(wave[0], now) - 1
+        return wave[1][i] if i >= 0 else wave[1][0]
+
+    def level(self, pin, now=None):
+        if now is None:
+            now = self.sim.now
+        func = self.func[pin]
+        if func is None:
+            if (self.sio_oe >> pin) & 1:
+                return (self.sio_out >> pin) & 1
+        elif (self.pio_oe[func] >> pin) & 1:
+            return (self.pio_out[func] >> pin) & 1
+        return self._external(pin, now)
+
+    def synced(self, pin, bypass):
+        # the input synchronizer delays by 2 system clock cycles
+        return self.level(pin, self.sim.now - (0 if bypass else 2))
+
+    def changed(self):
+        # record the output transitions
+        now = self.sim.now
+        for pin, trace in self.traces.items():
+            level = self.level(pin, now)
+            if not trace or trace[-1][1] != level:
+                trace.append((now, level))
+
+
+#
+# The state machine executor
+#
+
+def _bitrev(value):
+    return int("{:032b}".format(value)[::-1], 2)
+
+
+class Executor:
+    def __init__(self, sm, sim):
+        self.sm = sm
+        self.sim = sim
+        self.restart()
+        self.x = 0
+        self.y = 0
+
+    def restart(self):
+        self.isr = 0
+        self.isr_count = 0
+        self.osr = 0
+        self.osr_count = 32  # empty
+        self.delay = 0
+        self.stalled = None  # instruction waiting to complete
+        self.side_done = False
+
+    # configuration, as set in the registers
+    def _field(self, reg, shift, bits):
+        return (reg >> shift) & ((1 << bits) - 1)
+
+    def pin_in(self, count=32):
+        sm = self.sm
+        base = self._field(sm.pinctrl, 15, 5)
+        bypass = self.sm.pio.sync_bypass
+        value = 0
+        for i in range(count):
+            pin = (base + i) % 32
+            if pin < NUM_GPIO:
+                value |= self.sim.gpio.synced(pin, (bypass >> pin) & 1) << i
+        return value
+
+    def write_pins(self, base, count, value, dirs=False):
+        gpio = self.sim.gpio
+        p = self.sm.pio.index
+        for i in range(count):
+            pin = (base + i) % 32
+            if pin >= NUM_GPIO:
+                continue
+            bit = (value >> i) & 1
+            if dirs:
+                gpio.pio_oe[p] = (gpio.pio_oe[p] & ~(1 << pin)) | (bit << pin)
+            else:
+                gpio.pio_out[p] = (gpio.pio_out[p] & ~(1 << pin)) | (bit << pin)
+        gpio.changed()
+
+    def out_pins(self, value, dirs=False):
+        pinctrl = self.sm.pinctrl
+        self.write_pins(self._field(pinctrl, 0, 5), self._field(pinctrl, 20, 6), value, dirs)
+
+    def set_pins(self, value, dirs=False):
+        pinctrl = self.sm.pinctrl
+        self.write_pins(self._field(pinctrl, 5, 5), self._field(pinctrl, 26, 3), value, dirs)
+
+    def side_set(self, instr):
+        sm = self.sm
+        count = self._field(sm.pinctrl, 29, 3)
+        if count == 0:
+            return
+        opt = (sm.execctrl >> 30) & 1
+        field = (instr >> 8) & 0x1f
+        value = field >> (5 - count)
+        if opt:
+            if not value & (1 << (count - 1)):
+                return
+            count -= 1
+            value &= (1 << count) - 1
+        self.write_pins(self._field(sm.pinctrl, 10, 5), count, value,
+                        (sm.execctrl >> 29) & 1)
+
+    def delay_cycles(self, instr):
+        count = self._field(self.sm.pinctrl, 29, 3)
+        return ((instr >> 8) & 0x1f) & ((1 << (5 - count)) - 1)
+
+    def shiftctrl(self):
+        sc = self.sm.shiftctrl
+        push_thresh = self._field(sc, 20, 5) or 32
+        pull_thresh = self._field(sc, 25, 5) or 32
+        return ((sc >> 16) & 1, (sc >> 17) & 1, (sc >> 18) & 1, (sc >> 19) & 1,
+                push_thresh, pull_thresh)
+
+    def status(self):
+        sm = self.sm
+        level = len(sm.rx) if (sm.execctrl >> 4) & 1 else len(sm.tx)
+        return 0xffffffff if level < (sm.execctrl & 0xf) else 0
+
+    def _irq_index(self, index):
+        if index & 0x10:
+            return (index & 0x4) | ((index + self.sm.index) & 0x3)
+        return index & 0x7
+
+    # FIFO helpers of the state machine
+    def _push(self, block):
+        sm = self.sm
+        if len(sm.rx) >= sm.rx_depth():
+            sm.pio.fdebug |= 1 << sm.index  # RXSTALL
+            if block:
+                return False
+        else:
+            sm.rx.append(self.isr)
+        self.isr = 0
+        self.isr_count = 0
+        return True
+
+    def _pull(self, block):
+        sm = self.sm
+        if not sm.tx:
+            if block:
+                sm.pio.fdebug |= 1 << (24 + sm.index)  # TXSTALL
+                return False
+            self.osr = self.x
+        else:
+            self.osr = sm.tx.popleft()
+        self.osr_count = 0
+        return True
+
+    def cycle(self):
+        # one clock cycle of the state machine
+        if self.delay:
+            self.delay -= 1
+            return
+        sm = self.sm
+        if self.stalled is not None:
+            instr = self.stalled
+            from_exec = self.stalled_exec
+        else:
+            instr = sm.pio.instr_mem[sm.pc]
+            from_exec = False
+            self.side_done = False
+        self.execute(instr, from_exec)
+
+    def execute(self, instr, from_exec=False):
+        sm = self.sm
+        if not self.side_done:
+            self.side_set(instr)
+            self.side_done = True
+        autopush, autopull, in_dir, out_dir, push_thresh, pull_thresh = self.shiftctrl()
+        # background refill of the OSR with autopull
+        if autopull and self.osr_count >= pull_thresh and sm.tx:
+            self.osr = sm.tx.popleft()
+            self.osr_count = 0
+        op = instr >> 13
+        jump = None
+        stall = False
+        if op == 0:  # JMP
+            cond = (instr >> 5) & 7
+            if cond == 0:
+                take = True
+            elif cond == 1:
+                take = self.x == 0
+            elif cond == 2:
+                take = self.x != 0
+                self.x = (self.x - 1) & 0xffffffff
+            elif cond == 3:
+                take = self.y == 0
+            elif cond == 4:
+                take = self.y != 0
+                self.y = (self.y - 1) & 0xffffffff
+            elif cond == 5:
+                take = self.x != self.y
+            elif cond == 6:
+                pin = self._field(sm.execctrl, 24, 5)
+                take = self.sim.gpio.synced(pin, (sm.pio.sync_bypass >> pin) & 1) == 1
+            else:
+                take = self.osr_count < pull_thresh
+            if take:
+                jump = instr & 0x1f
+        elif op == 1:  # WAIT
+            polarity = (instr >> 7) & 1
+            src = (instr >> 5) & 3
+            index = instr & 0x1f
+            if src == 0:
+                level = self.sim.gpio.synced(index, (sm.pio.sync_bypass >> index) & 1)
+            elif src == 1:
+                level = (self.pin_in() >> index) & 1
+            else:
+                flag = self._irq_index(index)
+                level = (sm.pio.irq >> flag) & 1
+                if level and polarity:
+                    sm.pio.irq &= ~(1 << flag)
+            stall = level != polarity
+        elif op == 2:  # IN
+            src = (instr >> 5) & 7
+            count = instr & 0x1f or 32
+            if autopush and self.isr_count >= push_thresh:
+                if not self._push(True):
+                    stall = True
+            if not stall:
+                data = (self.pin_in(), self.x, self.y, 0, 0, 0, self.isr, self.osr)[src]
+                data &= (1 << count) - 1
+                if in_dir:  # shift right
+                    self.isr = ((self.isr >> count) | (data << (32 - count))) & 0xffffffff if count < 32 else data
+                else:
+                    self.isr = ((self.isr << count) | data) & 0xffffffff if count < 32 else data
+                self.isr_count = min(32, self.isr_count + count)
+                if autopush and self.isr_count >= push_thresh:
+                    self._push(False) if len(sm.rx) < sm.rx_depth() else None
+        elif op == 3:  # OUT
+            dest = (instr >> 5) & 7
+            count = instr & 0x1f or 32
+            if autopull and self.osr_count >= pull_thresh:
+                if not self._pull(True):
+                    stall = True
+            if not stall:
+                mask = (1 << count) - 1
+                if out_dir:  # shift right
+                    data = self.osr & mask
+                    self.osr = self.osr >> count if count < 32 else 0
+                else:
+                    data = (self.osr >> (32 - count)) & mask
+                    self.osr = (self.osr << count) & 0xffffffff if count < 32 else 0
+                self.osr_count = min(32, self.osr_count + count)
+                if dest == 0:
+                    self.out_pins(data)
+                elif dest == 1:
+                    self.x = data
+                elif dest == 2:
+                    self.y = data
+                elif dest == 4:
+                    self.out_pins(data, dirs=True)
+                elif dest == 5:
+                    jump = data & 0x1f
+                elif dest == 6:
+                    self.isr = data
+                    self.isr_count = count
+                elif dest == 7:
+                    self.stalled = None
+                    return self.execute(data & 0xffff, True)
+        elif op == 4:  # PUSH / PULL
+            if_flag = (instr >> 6) & 1
+            block = (instr >> 5) & 1
+            if instr & 0x80:  # PULL
+                if autopull and self.osr_count < pull_thresh:
+                    pass  # no-op with a full OSR
+                elif if_flag and self.osr_count < pull_thresh:
+                    pass
+                elif not self._pull(block):
+                    stall = True
+            else:
+                if if_flag and self.isr_count < push_thresh:
+                    pass
+                elif not self._push(block):
+                    stall = True
+        elif op == 5:  # MOV
+            dest = (instr >> 5) & 7
+            operation = (instr >> 3) & 3
+            src = instr & 7
+            data = (self.pin_in(), self.x, self.y, 0, 0, self.status(),
+                    self.isr, self.osr)[src]
+            if operation == 1:
+                data = ~data & 0xffffffff
+            elif operation == 2:
+                data = _bitrev(data)
+            if dest == 0:
+                self.out_pins(data)
+            elif dest == 1:
+                self.x = data
+            elif dest == 2:
+                self.y = data
+            elif dest == 4:
+                self.stalled = None
+                return self.execute(data & 0xffff, True)
+            elif dest == 5:
+                jump = data & 0x1f
+            elif dest == 6:
+                self.isr = data
+                self.isr_count = 0
+            elif dest == 7:
+                self.osr = data
+                self.osr_count = 0
+        elif op == 6:  # IRQ
+            clear = (instr >> 6) & 1
+            wait = (instr >> 5) & 1
+            flag = self._irq_index(instr & 0x1f)
+            if self.stalled is not None:  # waiting for the flag to be cleared
+                stall = (sm.pio.irq >> flag) & 1
+            elif clear:
+                sm.pio.irq &= ~(1 << flag)
+            else:
+                sm.pio.irq |= 1 << flag
+                self.sim.pio_irq(sm.pio, flag)
+                stall = wait and (sm.pio.irq >> flag) & 1
+        else:  # SET
+            dest = (instr >> 5) & 7
+            data = instr & 0x1f
+            if dest == 0:
+                self.set_pins(data)
+            elif dest == 1:
+                self.x = data
+            elif dest == 2:
+                self.y = data
+            elif dest == 4:
+                self.set_pins(data, dirs=True)
+
+        if stall:
+            self.stalled = instr
+            self.stalled_exec = from_exec
+            return
+        self.stalled = None
+        self.delay = self.delay_cycles(instr)
+        if from_exec and jump is None:
+            return
+        if jump is not None:
+            sm.pc = jump
+        elif sm.pc == self._field(sm.execctrl, 12, 5):
+            sm.pc = self._field(sm.execctrl, 7, 5)
+        else:
+            sm.pc = (sm.pc + 1) % 32
+
+
+#
+# The simulation with executing state machines
+#
+
+class EmuSim(rp2_sim.Sim):
+    def __init__(self):
+        super().__init__()
+        self.gpio = GPIO(self)
+        for pio in self.pio:
+            for sm in pio.sm:
+                sm.executor = Executor(sm, self)
+                sm.exec_cycle = sm.executor.cycle
+
+    def sm_restart(self, sm):
+        super().sm_restart(sm)
+        sm.executor.restart()
+
+    def sm_exec(self, sm, instr):
+        sm.executor.stalled = None
+        sm.executor.side_done = False
+        sm.executor.execute(instr, True)
+
+    def sm_init_pins(self, sm, bases, program):
+        # initialise the pins, like asm_pio_init_gpio()
+        gpio = self.gpio
+        p = sm.pio.index
+        for name, init in (("out", program[_PROG_OUT_PINS]),
+                           ("set", program[_PROG_SET_PINS]),
+                           ("sideset", program[_PROG_SIDESET_PINS])):
+            if bases[name] is None:
+                continue
+            for i, state in enumerate(_pin_inits(init)):
+                pin = bases[name] + i
+                gpio.func[pin] = p
+                bit = 1 << pin
+                if state >= rp2_sim.PIO.OUT_LOW:
+                    gpio.pio_oe[p] |= bit
+                else:
+                    gpio.pio_oe[p] &= ~bit
+                if state & 1:
+                    gpio.pio_out[p] |= bit
+                else:
+                    gpio.pio_out[p] &= ~bit
+        gpio.changed()
+
+
+def _pin_inits(init):
+    if init is None:
+        return ()
+    return (init,) if isinstance(init, int) else tuple(init)
+
+
+#
+# The rp2 module
+#
+
+class StateMachine(rp2_sim.StateMachine):
+    def exec(self, instr):
+        if isinstance(instr, str):
+            instr = asm_pio_encode(instr, rp2_sim._pin_count(self.prog[_PROG_SIDESET_PINS]))
+        _sim().sm_exec(self.sm, instr)
+
+
+def asm_pio_encode(instr, sideset_count, sideset_opt=False):
+    emit = PIOASMEmit()
+    emit.sideset_count = sideset_count
+    gl = dict(_pio_funcs)
+    for name in ("wrap_target", "wrap", "label", "word", "nop", "jmp",
+                 "wait", "in_", "out", "push", "pull", "mov", "irq", "set"):
+        gl[name] = getattr(emit, name)
+    emit.start_pass(0)
+    emit.num_instr = 0
+    emit.pass_ = 1
+    emit.delay_max = 31 >> sideset_count
+    emit.sideset_opt = sideset_opt
+    exec(instr, gl)
+    return emit.prog[_PROG_DATA][0]
+
+
+#
+# The machine module
+#
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    ALT = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, *, value=None):
+        self.id = rp2_sim._pin_id(id)
+        self.init(mode, pull, value=value)
+
+    def init(self, mode=-1, pull=-1, *, value=None):
+        gpio = _sim().gpio
+        bit = 1 << self.id
+        if value is not None:
+            gpio.sio_out = (gpio.sio_out & ~bit) | (bool(value) << self.id)
+        if mode in (Pin.IN, Pin.OUT):
+            gpio.func[self.id] = None
+            if mode == Pin.OUT:
+                gpio.sio_oe |= bit
+            else:
+                gpio.sio_oe &= ~bit
+        if pull == Pin.PULL_UP:
+            gpio.pull[self.id] = "up"
+        elif pull == Pin.PULL_DOWN:
+            gpio.pull[self.id] = "down"
+        gpio.changed()
+
+    def value(self, value=None):
+        gpio = _sim().gpio
+        if value is None:
+            return gpio.level(self.id)
+        gpio.sio_out = (gpio.sio_out & ~(1 << self.id)) | (bool(value) << self.id)
+        gpio.changed()
+        return None
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    high = on
+    low = off
+
+    def __repr__(self):
+        return "Pin({})".format(self.id)
+
+
+def _sim():
+    return rp2_sim.SIM
+
+
+#
+# The MicroPython specific parts of asyncio, on top of the one of CPython
+#
+
+class ThreadSafeFlag:
+    def __init__(self):
+        self.state = False
+
+    def set(self):
+        self.state = True
+
+    def clear(self):
+        self.state = False
+
+    async def wait(self):
+        import asyncio
+        while not self.state:
+            _sim().run(1000)  # let the virtual time advance while waiting
+            await asyncio.sleep(0)
+        self.state = False
+
+
+async def _sleep_ms(ms):
+    import asyncio
+    sim = _sim()
+    end = sim.now + ms * sim.freq // 1000
+    while sim.now < end:
+        sim.run(min(1000, end - sim.now))
+        await asyncio.sleep(0)
+
+
+def install(sim=None):
+    # Install the host simulation with executing state machines, and
+    # add rp2.asm_pio() and machine.Pin.
+    sim = rp2_sim.install(sim if sim is not None else EmuSim())
+    rp2 = sys.modules["rp2"]
+    rp2.StateMachine = StateMachine
+    rp2.asm_pio = asm_pio
+    rp2.asm_pio_encode = asm_pio_encode
+    rp2.PIOASMError = PIOASMError
+    sys.modules["machine"].Pin = Pin
+
+    import asyncio
+    asyncio.ThreadSafeFlag = ThreadSafeFlag
+    asyncio.sleep_ms = _sleep_ms
+    return sim
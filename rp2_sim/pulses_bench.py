@@ -0,0 +1,128 @@
+#
+# Timing benchmark of the PIO programs of pulses.py, run on the host with
+# the PIO emulation of pio_emu.py.
+#
+# For a set of sm_freq values it reports:
+# - the error of get_pulses() and put_pulses() in ticks, as the range of
+#   measured minus true duration for a mix of pulse lengths,
+# - the shortest pulse, which is still timed or sent with an error of at
+#   most one tick. For get_pulses() that is reported for the first pulse
+#   and for the following ones, since the first one takes longer,
+# - the resulting maximum edge rate.
+#
+# The input waveforms are generated at the system clock resolution and
+# the output is recorded at every transition, so no logic analyzer is
+# needed. Usage:
+#
+#   python3 rp2_sim/pulses_bench.py [sm_freq ...]
+#
+
+import array
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pio_emu
+
+GET_PIN = 10
+PUT_PIN = 11
+FREQS = (1_000_000, 5_000_000, 25_000_000, 62_500_000)
+WIDTHS = (12, 20, 33, 50, 75, 100, 150, 200)  # in ticks
+MARGIN = 20_000  # cycles between calling get_pulses() and the first edge
+MAX_WIDTH = 16  # the width at which the scan for the shortest pulse starts
+
+sim = pio_emu.install()
+sim.gpio.trace(PUT_PIN)
+
+import machine
+import pulses
+
+
+def get_error(p, tick, widths):
+    # Drive widths at the get pin and return the errors in ticks. The
+    # first edge starts the capture, the last width just ends the one
+    # before.
+    t = sim.now + MARGIN
+    wave = [(0, 0)]
+    level = 0
+    for w in widths:
+        level ^= 1
+        wave.append((t, level))
+        t += w * tick
+    wave.append((t, level ^ 1))
+    sim.gpio.drive(GET_PIN, wave)
+    buffer = array.array("I", bytearray(4 * (len(widths) - 1)))
+    p.get_pulses(buffer, 1_000_000, 10 * max(widths))
+    return [got - w for got, w in zip(buffer, widths)]
+
+
+def put_error(p, tick, widths):
+    # Send widths framed by two long pulses and return the errors in
+    # ticks, or None if pulses are missing.
+    trace = sim.gpio.trace(PUT_PIN)
+    start = len(trace)
+    buffer = array.array("I", (50,) + tuple(widths) + (50,))
+    p.put_pulses(buffer, trace[-1][1] ^ 1 if trace else 1)
+    edges = [t for t, _ in trace[start:]]
+    if len(edges) != len(widths) + 2:
+        return None
+    return [(b - a) / tick - w for a, b, w in zip(edges[1:], edges[2:], widths)]
+
+
+def _ok(errors):
+    return errors is not None and all(abs(e) <= 1 for e in errors)
+
+
+def shortest(test):
+    # the shortest width, for which test(width) and all longer ones pass
+    result = None
+    for w in range(MAX_WIDTH, 0, -1):
+        if not _ok(test(w)):
+            break
+        result = w
+    return result
+
+
+def _range(errors):
+    if errors is None:
+        return "pulses lost"
+    return "{:+.2f} .. {:+.2f}".format(min(errors), max(errors))
+
+
+def _ticks(width):
+    return "-" if width is None else "{} ticks".format(width)
+
+
+def _rate(sm_freq, width):
+    if width is None:
+        return "-"
+    rate = sm_freq / width
+    if rate >= 1_000_000:
+        return "{:.2f} MHz".format(rate / 1_000_000)
+    return "{:.1f} kHz".format(rate / 1000)
+
+
+def bench(sm_freq):
+    tick = machine.freq() // sm_freq
+    p = pulses.Pulses(machine.Pin(GET_PIN, machine.Pin.IN),
+                      machine.Pin(PUT_PIN, machine.Pin.OUT), sm_freq=sm_freq)
+    try:
+        get_err = get_error(p, tick, WIDTHS)
+        get_first = shortest(lambda w: get_error(p, tick, (w, 20, 20))[:1])
+        get_min = shortest(lambda w: get_error(p, tick, (20,) + (w,) * 8)[1:])
+        put_err = put_error(p, tick, WIDTHS)
+        put_min = shortest(lambda w: put_error(p, tick, (w,) * 8))
+    finally:
+        p.deinit()
+    print("sm_freq {:,} Hz, tick {} cycles".format(sm_freq, tick))
+    print("  get_pulses error     {} ticks".format(_range(get_err)))
+    print("  shortest pulse       first {}, others {}".format(_ticks(get_first), _ticks(get_min)))
+    print("  maximum edge rate    {}".format(_rate(sm_freq, get_min)))
+    print("  put_pulses error     {} ticks".format(_range(put_err)))
+    print("  shortest pulse       {}".format(_ticks(put_min)))
+    print("  maximum edge rate    {}".format(_rate(sm_freq, put_min)))
+
+
+if __name__ == "__main__":
+    for freq in [int(f) for f in sys.argv[1:]] or FREQS:
+        bench(freq)
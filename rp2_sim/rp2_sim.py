@@ -0,0 +1,1097 @@
+#
+# Host side simulation of the RP2040 registers used by rp2_util.py
+#
+# rp2_util.py accesses the hardware through viper ptr32 pointers at
+# PIO0_BASE, PIO1_BASE, DMA_BASE and UART0_BASE/UART1_BASE. Under CPython
+# the names micropython, const, ptr8, ptr16, ptr32 and uint do not exist.
+# install() provides them as builtins, backed by a simulated register
+# file, so that rp2_util.py and the modules using it can be imported and
+# run unchanged on a Linux host.
+#
+# Simulated are:
+# - RAM: every buffer handed to the DMA or to uint()/ptr32() gets a
+#   stable 32 bit address, and reads/writes go to the Python object.
+# - PIO0/PIO1: CTRL, FSTAT, FDEBUG, FLEVEL, TXFx/RXFx, IRQ, INSTR_MEM and
+#   the per SM CLKDIV, EXECCTRL, SHIFTCTRL (including FIFO join), ADDR,
+#   INSTR and PINCTRL registers. The state machines do not execute code.
+#   Data is exchanged with the FIFOs through the SimSM objects.
+# - DMA: the 12 channels with all four register aliases, chaining, ring
+#   wrapping, TREQ pacing, MULTI_CHAN_TRIGGER, CHAN_ABORT, INTR/INTE0,
+#   the debug TRANS_COUNT reload register and the sniffer with all its
+#   CRC and checksum modes.
+# - UART0/UART1: DR, FR, IMSC and DMACR with a paced transmitter and a
+#   receive queue fed by the host.
+#
+# install() provides as well the modules rp2 and machine, with
+# rp2.PIO.add_program()/remove_program() loading the instruction memory,
+# rp2.StateMachine setting up the SM registers and dispatching the PIO
+# IRQ to its handler, and machine.freq(), mem8, mem16 and mem32.
+#
+# Time is virtual. It advances by sim.run(cycles), by time.sleep_ms()/
+# sleep_us(), by a few cycles for every register access and by
+# LINE_CYCLES for every line of Python code executed in the modules of
+# the repository, so that polling loops on the target make progress on
+# the host as well.
+#
+
+import builtins
+import ctypes
+import os
+import sys
+import time
+import types
+from collections import deque
+
+SYS_FREQ = 125_000_000
+ACCESS_CYCLES = 8  # bus cycles charged per register access of the CPU
+LINE_CYCLES = 200  # cycles charged per executed line of Python code
+
+PIO0_BASE = 0x50200000
+PIO1_BASE = 0x50300000
+DMA_BASE = 0x50000000
+UART0_BASE = 0x40034000
+UART1_BASE = 0x40038000
+RAM_BASE = 0x20000000
+
+DMA_CHANNELS = 12
+TREQ_PERMANENT = 0x3f
+
+
+class Py_buffer(ctypes.Structure):
+    _fields_ = [("buf", ctypes.c_void_p), ("obj", ctypes.py_object),
+                ("len", ctypes.c_ssize_t), ("itemsize", ctypes.c_ssize_t),
+                ("readonly", ctypes.c_int), ("ndim", ctypes.c_int),
+                ("format", ctypes.c_char_p), ("shape", ctypes.c_void_p),
+                ("strides", ctypes.c_void_p), ("suboffsets", ctypes.c_void_p),
+                ("internal", ctypes.c_void_p)]
+
+
+def _host_range(obj):
+    # host address and length of the memory behind a buffer object
+    view = Py_buffer()
+    ctypes.pythonapi.PyObject_GetBuffer(ctypes.py_object(obj), ctypes.byref(view), 0)
+    try:
+        return view.buf, view.len
+    finally:
+        ctypes.pythonapi.PyBuffer_Release(ctypes.byref(view))
+
+
+class Ram:
+    # Maps Python buffers into a 32 bit address space. The address of
+    # a buffer keeps its alignment modulo 8, and slices of memoryviews
+    # resolve into the range of the object they were taken from.
+
+    _ctypes = {1: ctypes.c_uint8, 2: ctypes.c_uint16, 4: ctypes.c_uint32}
+
+    def __init__(self):
+        self.regions = []  # [sim address, host address, length, object]
+        self.top = RAM_BASE
+
+    def addressof(self, obj):
+        host, length = _host_range(obj)
+        for sim, base, size, _ in self.regions:
+            if base <= host and host + length <= base + size:
+                return sim + host - base
+        owner = obj.obj if isinstance(obj, memoryview) else obj
+        base, size = _host_range(owner)
+        sim = ((self.top + 7) & ~7) + (base & 7)
+        self.regions.append((sim, base, size, owner))
+        self.top = sim + size + 8
+        return sim + host - base
+
+    def _host(self, addr, size):
+        for sim, base, length, _ in self.regions:
+            if sim <= addr and addr + size <= sim + length:
+                return base + addr - sim
+        raise MemoryError("access to unmapped address 0x%08x" % addr)
+
+    def contains(self, addr):
+        return RAM_BASE <= addr < self.top
+
+    def read(self, addr, size):
+        return self._ctypes[size].from_address(self._host(addr, size)).value
+
+    def write(self, addr, size, value):
+        self._ctypes[size].from_address(self._host(addr, size)).value = value
+
+
+class SimSM:
+    # One state machine: FIFOs and configuration registers.
+
+    def __init__(self, pio, index):
+        self.pio = pio
+        self.index = index
+        self.tx = deque()
+        self.rx = deque()
+        self.pc = 0
+        self.exec_cycle = None  # hook for an instruction executor
+        self.next_tick = 0.0
+        self.reset()
+
+    def reset(self):
+        self.clkdiv = 0x00010000
+        self.execctrl = 0x0001f000
+        self.shiftctrl = 0x000c0000
+        self.pinctrl = 0x14000000
+        self.tx.clear()
+        self.rx.clear()
+
+    @property
+    def nr(self):
+        return self.pio.index * 4 + self.index
+
+    @property
+    def enabled(self):
+        return (self.pio.ctrl >> self.index) & 1
+
+    def tx_depth(self):
+        if self.shiftctrl & (1 << 31):
+            return 0
+        return 8 if self.shiftctrl & (1 << 30) else 4
+
+    def rx_depth(self):
+        if self.shiftctrl & (1 << 30):
+            return 0
+        return 8 if self.shiftctrl & (1 << 31) else 4
+
+    def divider(self):
+        div = (self.clkdiv >> 16) + ((self.clkdiv >> 8) & 0xff) / 256
+        return div if div >= 1 else 65536
+
+    # FIFO access from the system side
+    def tx_push(self, value):
+        if len(self.tx) >= self.tx_depth():
+            self.pio.fdebug |= 1 << (16 + self.index)  # TXOVER
+            return False
+        self.tx.append(value & 0xffffffff)
+        return True
+
+    def rx_pop(self):
+        if not self.rx:
+            self.pio.fdebug |= 1 << (8 + self.index)  # RXUNDER
+            return 0
+        return self.rx.popleft()
+
+    # FIFO access from the state machine side, used by the host code
+    # standing in for the PIO program
+    def push(self, value):
+        if len(self.rx) >= self.rx_depth():
+            return False
+        self.rx.append(value & 0xffffffff)
+        return True
+
+    def pull(self):
+        return self.tx.popleft() if self.tx else None
+
+
+class SimPIO:
+    def __init__(self, sim, index, base):
+        self.sim = sim
+        self.index = index
+        self.base = base
+        self.ctrl = 0
+        self.fdebug = 0
+        self.irq = 0
+        self.sync_bypass = 0
+        self.instr_mem = [0] * 32
+        self.sm = [SimSM(self, i) for i in range(4)]
+
+    def read(self, offset):
+        if offset == 0x000:
+            return self.ctrl & 0xf
+        if offset == 0x004:  # FSTAT
+            value = 0
+            for i, sm in enumerate(self.sm):
+                value |= (len(sm.rx) >= sm.rx_depth()) << i
+                value |= (not sm.rx) << (8 + i)
+                value |= (len(sm.tx) >= sm.tx_depth()) << (16 + i)
+                value |= (not sm.tx) << (24 + i)
+            return value
+        if offset == 0x008:
+            return self.fdebug
+        if offset == 0x00c:  # FLEVEL
+            value = 0
+            for i, sm in enumerate(self.sm):
+                value |= (len(sm.tx) & 0xf) << (8 * i)
+                value |= (len(sm.rx) & 0xf) << (8 * i + 4)
+            return value
+        if 0x020 <= offset < 0x030:
+            return self.sm[(offset - 0x020) // 4].rx_pop()
+        if offset == 0x030:
+            return self.irq
+        if offset == 0x038:
+            return self.sync_bypass
+        if 0x048 <= offset < 0x0c8:
+            return self.instr_mem[(offset - 0x048) // 4]
+        if 0x0c8 <= offset < 0x128:
+            sm = self.sm[(offset - 0x0c8) // 0x18]
+            reg = (offset - 0x0c8) % 0x18
+            if reg == 0x00:
+                return sm.clkdiv
+            if reg == 0x04:
+                return sm.execctrl
+            if reg == 0x08:
+                return sm.shiftctrl
+            if reg == 0x0c:
+                return sm.pc
+            if reg == 0x14:
+                return sm.pinctrl
+        return 0
+
+    def write(self, offset, value):
+        if offset == 0x000:  # CTRL
+            for i, sm in enumerate(self.sm):
+                if value & (1 << (4 + i)):
+                    self.sim.sm_restart(sm)
+                if value & (1 << (8 + i)):
+                    sm.next_tick = self.sim.now
+                if (value >> i) & 1 and not sm.enabled:
+                    sm.next_tick = self.sim.now
+            self.ctrl = value & 0xf
+        elif offset == 0x008:  # FDEBUG, write 1 to clear
+            self.fdebug &= ~value
+        elif 0x010 <= offset < 0x020:
+            self.sm[(offset - 0x010) // 4].tx_push(value)
+        elif offset == 0x030:  # IRQ, write 1 to clear
+            self.irq &= ~value
+        elif offset == 0x034:  # IRQ_FORCE
+            self.irq |= value & 0xff
+            for flag in range(8):
+                if value & (1 << flag):
+                    self.sim.pio_irq(self, flag)
+        elif offset == 0x038:
+            self.sync_bypass = value
+        elif 0x048 <= offset < 0x0c8:
+            self.instr_mem[(offset - 0x048) // 4] = value & 0xffff
+        elif 0x0c8 <= offset < 0x128:
+            sm = self.sm[(offset - 0x0c8) // 0x18]
+            reg = (offset - 0x0c8) % 0x18
+            if reg == 0x00:
+                sm.clkdiv = value & 0xffffff00
+            elif reg == 0x04:
+                sm.execctrl = (sm.execctrl & 0x80000000) | (value & 0x7fffffff)
+            elif reg == 0x08:
+                if (value ^ sm.shiftctrl) & 0xc0000000:
+                    sm.tx.clear()  # changing the join flushes the FIFOs
+                    sm.rx.clear()
+                sm.shiftctrl = value & 0xffff0000
+            elif reg == 0x10:
+                self.sim.sm_exec(sm, value & 0xffff)
+            elif reg == 0x14:
+                sm.pinctrl = value
+
+
+class DmaChannel:
+    def __init__(self, dma, index):
+        self.dma = dma
+        self.index = index
+        self.read_addr = 0
+        self.write_addr = 0
+        self.reload = 0
+        self.count = 0
+        self.ctrl = 0
+        self.busy = False
+
+    def ctrl_value(self):
+        return (self.ctrl & ~(1 << 24)) | (self.busy << 24)
+
+    def data_size(self):
+        return 1 << ((self.ctrl >> 2) & 3)
+
+    def treq(self):
+        return (self.ctrl >> 15) & 0x3f
+
+    def chain_to(self):
+        return (self.ctrl >> 11) & 0xf
+
+    def trigger(self):
+        if not self.ctrl & 1:  # EN cleared: ignore the trigger
+            return
+        self.count = self.reload
+        self.busy = self.count > 0
+        if not self.busy:
+            self.dma.finish(self)
+
+    def _advance(self, addr, incr, ring):
+        size = self.data_size()
+        if not incr:
+            return addr
+        ring_size = (self.ctrl >> 6) & 0xf
+        if ring and ring_size:
+            mask = (1 << ring_size) - 1
+            return (addr & ~mask) | ((addr + size) & mask)
+        return (addr + size) & 0xffffffff
+
+    def transfer(self):
+        sim = self.dma.sim
+        size = self.data_size()
+        value = sim.bus_read(self.read_addr, size)
+        sim.bus_write(self.write_addr, size, value)
+        if self.dma.sniff_ctrl & 1 and self.ctrl & (1 << 23) and \
+                (self.dma.sniff_ctrl >> 1) & 0xf == self.index:
+            self.dma.sniff(value, size)
+        ring_sel = (self.ctrl >> 10) & 1
+        self.read_addr = self._advance(self.read_addr, (self.ctrl >> 4) & 1, not ring_sel)
+        self.write_addr = self._advance(self.write_addr, (self.ctrl >> 5) & 1, ring_sel)
+        self.count -= 1
+        self.dma.moved[self.index] += size
+        if self.count == 0:
+            self.busy = False
+            self.dma.finish(self)
+
+
+# CRC of the bits of value, MSB first, without reflection
+def _crc(crc, value, nbits, poly, width):
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    for i in range(nbits - 1, -1, -1):
+        feedback = bool(crc & top) ^ ((value >> i) & 1)
+        crc = (crc << 1) & mask
+        if feedback:
+            crc ^= poly
+    return crc
+
+
+class SimDMA:
+    def __init__(self, sim):
+        self.sim = sim
+        self.ch = [DmaChannel(self, i) for i in range(DMA_CHANNELS)]
+        self.intr = 0
+        self.inte0 = 0
+        self.sniff_ctrl = 0
+        self.sniff_data = 0
+        self.moved = [0] * DMA_CHANNELS  # byte counters, for benchmarks
+        self.next = 0  # round robin pointer
+        self.irq_handler = None  # called with the INTS0 mask
+
+    def finish(self, ch):
+        if not ch.ctrl & (1 << 21):  # not IRQ_QUIET
+            self.raise_irq(ch.index)
+        target = ch.chain_to()
+        if target != ch.index:
+            self.ch[target].trigger()
+
+    def raise_irq(self, index):
+        self.intr |= 1 << index
+        if self.irq_handler is not None and self.inte0 & (1 << index):
+            self.irq_handler(self.intr & self.inte0)
+
+    def sniff(self, value, size):
+        ctrl = self.sniff_ctrl
+        calc = (ctrl >> 5) & 0xf
+        nbits = 8 * size
+        value &= (1 << nbits) - 1
+        if ctrl & (1 << 9):  # BSWAP
+            value = int.from_bytes(value.to_bytes(size, "little"), "big")
+        if calc in (1, 3):  # bit reversed data
+            value = int("{:0{}b}".format(value, nbits)[::-1], 2)
+        if calc in (0, 1):
+            self.sniff_data = _crc(self.sniff_data, value, nbits, 0x04c11db7, 32)
+        elif calc in (2, 3):
+            self.sniff_data = (self.sniff_data & 0xffff0000) | \
+                _crc(self.sniff_data & 0xffff, value, nbits, 0x1021, 16)
+        elif calc == 0xe:  # XOR reduction: the parity of all data
+            self.sniff_data ^= bin(value).count("1") & 1
+        elif calc == 0xf:  # 32 bit sum
+            self.sniff_data = (self.sniff_data + value) & 0xffffffff
+
+    def sniff_result(self):
+        value = self.sniff_data
+        if self.sniff_ctrl & (1 << 10):  # OUT_REV
+            value = int("{:032b}".format(value)[::-1], 2)
+        if self.sniff_ctrl & (1 << 11):  # OUT_INV
+            value ^= 0xffffffff
+        return value
+
+    def read(self, offset):
+        if offset < 0x400:
+            ch = self.ch[offset // 0x40]
+            reg = (offset % 0x40) // 4
+            return (ch.read_addr, ch.write_addr, ch.count, ch.ctrl_value(),
+                    ch.ctrl_value(), ch.read_addr, ch.write_addr, ch.count,
+                    ch.ctrl_value(), ch.count, ch.read_addr, ch.write_addr,
+                    ch.ctrl_value(), ch.write_addr, ch.count, ch.read_addr)[reg]
+        if offset == 0x400:
+            return self.intr
+        if offset == 0x404:
+            return self.inte0
+        if offset == 0x40c:
+            return self.intr & self.inte0
+        if offset == 0x434:
+            return self.sniff_ctrl
+        if offset == 0x438:
+            return self.sniff_result()
+        if offset == 0x444:
+            return 0  # aborts complete immediately
+        if offset == 0x448:
+            return DMA_CHANNELS
+        if 0x800 <= offset < 0x800 + 0x40 * DMA_CHANNELS and offset % 0x40 == 4:
+            return self.ch[(offset - 0x800) // 0x40].reload  # CHx_DBG_TCR
+        return 0
+
+    def write(self, offset, value):
+        if offset < 0x400:
+            ch = self.ch[offset // 0x40]
+            reg = (offset % 0x40) // 4
+            # (register, trigger) per alias slot
+            name = ("read", "write", "count", "ctrl",
+                    "ctrl", "read", "write", "count",
+                    "ctrl", "count", "read", "write",
+                    "ctrl", "write", "count", "read")[reg]
+            if name == "read":
+                ch.read_addr = value
+            elif name == "write":
+                ch.write_addr = value
+            elif name == "count":
+                ch.reload = value
+                if not ch.busy:
+                    ch.count = value
+            else:
+                ch.ctrl = value & ~(1 << 24)
+                if not value & 1:
+                    ch.busy = False
+            if reg % 4 == 3:  # the trigger registers of each alias
+                if value == 0:  # null trigger
+                    if ch.ctrl & (1 << 21):
+                        self.raise_irq(ch.index)
+                else:
+                    ch.trigger()
+        elif offset == 0x400:
+            self.intr &= ~value
+        elif offset == 0x404:
+            self.inte0 = value & 0xffff
+        elif offset == 0x40c:
+            self.intr &= ~value
+        elif offset == 0x430:  # MULTI_CHAN_TRIGGER
+            for i in range(DMA_CHANNELS):
+                if value & (1 << i):
+                    self.ch[i].trigger()
+        elif offset == 0x434:
+            self.sniff_ctrl = value & 0xfff
+        elif offset == 0x438:
+            self.sniff_data = value
+        elif offset == 0x444:  # CHAN_ABORT
+            for i in range(DMA_CHANNELS):
+                if value & (1 << i):
+                    self.ch[i].busy = False
+                    self.ch[i].count = 0
+
+    def dreq(self, treq):
+        if treq == TREQ_PERMANENT:
+            return True
+        sim = self.sim
+        if treq < 16:
+            sm = sim.pio[treq // 8].sm[treq % 4]
+            if treq % 8 < 4:
+                return len(sm.tx) < sm.tx_depth()
+            return len(sm.rx) > 0
+        if 20 <= treq <= 23:
+            uart = sim.uart[(treq - 20) // 2]
+            return uart.tx_ready() if treq % 2 == 0 else uart.rx_ready()
+        return False
+
+    def step(self):
+        # perform at most one transfer, channels served round robin
+        for i in range(DMA_CHANNELS):
+            ch = self.ch[(self.next + i) % DMA_CHANNELS]
+            if ch.busy and ch.ctrl & 1 and self.dreq(ch.treq()):
+                ch.transfer()
+                self.next = (ch.index + 1) % DMA_CHANNELS
+                return True
+        return False
+
+
+class SimUART:
+    def __init__(self, sim, index):
+        self.sim = sim
+        self.index = index
+        self.rx = deque()
+        self.tx = deque()
+        self.sent = bytearray()
+        self.dmacr = 0x3  # enabled by the firmware's uart_init()
+        self.imsc = 0x50  # the receive interrupts used by machine.UART
+        self.byte_cycles = SYS_FREQ * 10 // 115200
+        self.next_tick = None
+
+    def feed(self, data):
+        self.rx.extend(data)
+
+    def rx_ready(self):
+        return bool(self.rx) and self.dmacr & 1
+
+    def tx_ready(self):
+        return len(self.tx) < 32 and self.dmacr & 2
+
+    def read(self, offset):
+        if offset == 0x000:
+            return self.rx.popleft() if self.rx else 0
+        if offset == 0x018:  # FR
+            return ((not self.tx) << 7 | (len(self.rx) >= 32) << 6 |
+                    (len(self.tx) >= 32) << 5 | (not self.rx) << 4 |
+                    bool(self.tx) << 3)
+        if offset == 0x038:
+            return self.imsc
+        if offset == 0x048:
+            return self.dmacr
+        return 0
+
+    def write(self, offset, value):
+        if offset == 0x000:
+            if len(self.tx) < 32:
+                self.tx.append(value & 0xff)
+                if self.next_tick is None:
+                    self.next_tick = self.sim.now + self.byte_cycles
+        elif offset == 0x038:
+            self.imsc = value & 0x7ff
+        elif offset == 0x048:
+            self.dmacr = value & 0x7
+
+    def tick(self):
+        self.sent.append(self.tx.popleft())
+        self.next_tick = self.sim.now + self.byte_cycles if self.tx else None
+
+
+class Ptr:
+    # stands in for the viper ptr8, ptr16 and ptr32 types
+    def __init__(self, sim, addr, size):
+        self.sim = sim
+        self.addr = addr & 0xffffffff
+        self.size = size
+
+    def __getitem__(self, index):
+        return self.sim.cpu_read(self.addr + index * self.size, self.size)
+
+    def __setitem__(self, index, value):
+        self.sim.cpu_write(self.addr + index * self.size, self.size, value)
+
+    def __int__(self):
+        return self.addr
+
+
+class Sim:
+    def __init__(self):
+        self.now = 0  # virtual time in system clock cycles
+        self.freq = SYS_FREQ
+        self.ram = Ram()
+        self.pio = [SimPIO(self, 0, PIO0_BASE), SimPIO(self, 1, PIO1_BASE)]
+        self.dma = SimDMA(self)
+        self.uart = [SimUART(self, 0), SimUART(self, 1)]
+        self.native = 0  # > 0 while viper code runs
+        self.scheduled = []  # IRQ handlers waiting to be run
+        self.in_handler = False
+        self.line_cycles = LINE_CYCLES
+
+    # helpers for the state machines
+    def sm(self, nr):
+        return self.pio[nr // 4].sm[nr % 4]
+
+    def sm_restart(self, sm):
+        sm.next_tick = self.now
+
+    def sm_exec(self, sm, instr):
+        if instr & 0xe000 == 0:  # unconditional jmp, as used by sm_restart()
+            sm.pc = instr & 0x1f
+
+    def sm_init_pins(self, sm, bases, program):
+        pass  # hook for setting up the pins of a state machine
+
+    def pio_irq(self, pio, flag):
+        # flags 0..3 raise the IRQ of the StateMachine objects. Like in the
+        # firmware, the flag is cleared and the handler is scheduled.
+        handler = _irq_handlers.get((pio.index, flag))
+        if handler is not None:
+            pio.irq &= ~(1 << flag)
+            self.scheduled.append(handler)
+
+    # address decoding
+    def _device(self, addr):
+        for pio in self.pio:
+            if pio.base <= addr < pio.base + 0x1000:
+                return pio, addr - pio.base
+        if DMA_BASE <= addr < DMA_BASE + 0x1000:
+            return self.dma, addr - DMA_BASE
+        for uart, base in ((self.uart[0], UART0_BASE), (self.uart[1], UART1_BASE)):
+            if base <= addr < base + 0x1000:
+                return uart, addr - base
+        return None, addr
+
+    def bus_read(self, addr, size):
+        if self.ram.contains(addr):
+            return self.ram.read(addr, size)
+        device, offset = self._device(addr)
+        if device is None:
+            raise MemoryError("read from unmapped address 0x%08x" % addr)
+        # narrow reads of a peripheral return the addressed byte lane
+        value = device.read(offset & ~3)
+        return (value >> (8 * (offset & 3))) & ((1 << (8 * size)) - 1)
+
+    def bus_write(self, addr, size, value):
+        value &= (1 << (8 * size)) - 1
+        if self.ram.contains(addr):
+            return self.ram.write(addr, size, value)
+        device, offset = self._device(addr)
+        if device is None:
+            raise MemoryError("write to unmapped address 0x%08x" % addr)
+        # narrow writes to a peripheral are replicated over the bus
+        if size == 1:
+            value *= 0x01010101
+        elif size == 2:
+            value *= 0x00010001
+        device.write(offset & ~3, value)
+
+    def cpu_read(self, addr, size):
+        value = self.bus_read(addr, size)
+        if not self.ram.contains(addr):
+            self.run(ACCESS_CYCLES)
+        return value
+
+    def cpu_write(self, addr, size, value):
+        self.bus_write(addr, size, value & 0xffffffff)
+        if not self.ram.contains(addr):
+            self.run(ACCESS_CYCLES)
+
+    # the virtual clock
+    def _tickers(self):
+        for pio in self.pio:
+            for sm in pio.sm:
+                if sm.enabled and sm.exec_cycle is not None:
+                    yield sm.next_tick, sm
+        for uart in self.uart:
+            if uart.next_tick is not None:
+                yield uart.next_tick, uart
+
+    def run(self, cycles):
+        self._run(cycles)
+        # run the scheduled IRQ handlers, like micropython.schedule()
+        if not self.in_handler:
+            self.in_handler = True
+            try:
+                while self.scheduled:
+                    self.scheduled.pop(0)()
+            finally:
+                self.in_handler = False
+
+    def _run(self, cycles):
+        end = self.now + cycles
+        while True:
+            if self.dma.step():
+                self.now += 1
+            pending = [(t, dev) for t, dev in self._tickers() if t <= self.now]
+            if pending:
+                for _, dev in sorted(pending, key=lambda x: x[0]):
+                    if isinstance(dev, SimSM):
+                        dev.exec_cycle()
+                        dev.next_tick += dev.divider()
+                    else:
+                        dev.tick()
+                continue
+            if self.now >= end:
+                break
+            if any(ch.busy and ch.ctrl & 1 and self.dma.dreq(ch.treq()) for ch in self.dma.ch):
+                continue
+            upcoming = [t for t, _ in self._tickers()]
+            self.now = min([end] + [int(t) + 1 if t > int(t) else int(t) for t in upcoming])
+        self.now = max(self.now, end)
+
+    def run_until(self, condition, timeout_cycles=SYS_FREQ):
+        end = self.now + timeout_cycles
+        while not condition():
+            if self.now >= end:
+                raise TimeoutError("condition not met in simulation")
+            self.run(100)
+
+    def ticks_us(self):
+        return int(self.now * 1_000_000 // self.freq)
+
+    # the viper casts
+    def uint(self, value):
+        if isinstance(value, Ptr):
+            return value.addr
+        if isinstance(value, (int, bool)):
+            return int(value) & 0xffffffff
+        return self.ram.addressof(value)
+
+    def ptr(self, size):
+        def make(value):
+            if isinstance(value, Ptr):
+                return Ptr(self, value.addr, size)
+            if isinstance(value, (int, bool)):
+                return Ptr(self, int(value), size)
+            addr = self.ram.addressof(value)
+            return Ptr(self, addr, size)
+        return make
+
+    def sleep_us(self, us):
+        self.run(max(1, int(us * self.freq // 1_000_000)))
+
+
+#
+# The rp2 and machine modules, at the level of the registers
+#
+
+_PROG_DATA = 0
+_PROG_OFFSET_PIO0 = 1
+_PROG_EXECCTRL = 3
+_PROG_SHIFTCTRL = 4
+_PROG_OUT_PINS = 5
+_PROG_SET_PINS = 6
+_PROG_SIDESET_PINS = 7
+
+_irq_handlers = {}  # (pio, flag): function
+
+
+def _pin_id(pin):
+    if pin is None or isinstance(pin, int):
+        return pin
+    return pin.id
+
+
+def _pin_count(init):
+    if init is None:
+        return 0
+    return 1 if isinstance(init, int) else len(init)
+
+
+class PIO:
+    IN_LOW = 0
+    IN_HIGH = 1
+    OUT_LOW = 2
+    OUT_HIGH = 3
+    SHIFT_LEFT = 0
+    SHIFT_RIGHT = 1
+    JOIN_NONE = 0
+    JOIN_TX = 1
+    JOIN_RX = 2
+    IRQ_SM0 = 0x100
+    IRQ_SM1 = 0x200
+    IRQ_SM2 = 0x400
+    IRQ_SM3 = 0x800
+
+    _used = [0, 0]  # instruction memory in use, per PIO
+    _programs = [{}, {}]  # id(program data): (program, offset, length)
+
+    def __init__(self, id):
+        if id not in (0, 1):
+            raise ValueError("invalid PIO")
+        self.id = id
+        self.pio = SIM.pio[id]
+
+    def add_program(self, prog):
+        # load like pio_add_program() of the SDK, at the highest free offset
+        data = prog[_PROG_DATA]
+        mask = (1 << len(data)) - 1
+        for offset in range(32 - len(data), -1, -1):
+            if not PIO._used[self.id] & (mask << offset):
+                break
+        else:
+            raise OSError(12, "ENOMEM")  # no space in the instruction memory
+        for i, instr in enumerate(data):
+            if instr & 0xe000 == 0:  # relocate the jmp targets
+                instr += offset
+            self.pio.instr_mem[offset + i] = instr
+        PIO._used[self.id] |= mask << offset
+        PIO._programs[self.id][id(data)] = (prog, offset, len(data))
+        prog[_PROG_OFFSET_PIO0 + self.id] = offset
+
+    def remove_program(self, prog=None):
+        programs = PIO._programs[self.id]
+        if prog is None:
+            entries = list(programs.values())
+        else:
+            entry = programs.get(id(prog[_PROG_DATA]))
+            entries = [entry] if entry is not None else []
+        for program, offset, length in entries:
+            PIO._used[self.id] &= ~(((1 << length) - 1) << offset)
+            program[_PROG_OFFSET_PIO0 + self.id] = -1
+            del programs[id(program[_PROG_DATA])]
+
+    def state_machine(self, id, program=None, *args, **kw):
+        return StateMachine(self.id * 4 + id, program, *args, **kw)
+
+
+class StateMachine:
+    _instances = {}
+
+    def __new__(cls, id, program=None, *args, **kw):
+        if not 0 <= id < 8:
+            raise ValueError("invalid StateMachine")
+        obj = cls._instances.get(id)
+        if obj is None:
+            obj = super().__new__(cls)
+            obj.id = id
+            obj.prog = None
+            obj.offset = 0
+            cls._instances[id] = obj
+        return obj
+
+    def __init__(self, id, program=None, *args, **kw):
+        if program is not None:
+            self.init(program, *args, **kw)
+
+    @property
+    def sm(self):
+        return SIM.sm(self.id)
+
+    def init(self, program, freq=-1, *, in_base=None, out_base=None,
+             set_base=None, jmp_pin=None, sideset_base=None,
+             in_shiftdir=None, out_shiftdir=None, push_thresh=None,
+             pull_thresh=None):
+        # set up the registers like rp2_state_machine_init_helper()
+        sim = SIM
+        pio = PIO(self.id // 4)
+        sm = self.sm
+        if freq == -1:
+            clkdiv = 1 << 16
+        else:
+            div_int = sim.freq // freq
+            if not 1 <= div_int <= 65535:
+                raise ValueError("freq out of range")
+            div_frac = (sim.freq % freq) * 256 // freq
+            clkdiv = div_int << 16 | div_frac << 8
+        pio.pio.ctrl &= ~(1 << sm.index)
+        if program[_PROG_OFFSET_PIO0 + pio.id] < 0:
+            pio.add_program(program)
+        offset = program[_PROG_OFFSET_PIO0 + pio.id]
+        self.prog = program
+        self.offset = offset
+
+        execctrl = program[_PROG_EXECCTRL]
+        wrap_target = ((execctrl >> 7) & 0x1f) + offset
+        wrap = ((execctrl >> 12) & 0x1f) + offset
+        execctrl = (execctrl & ~(0x3ff << 7)) | wrap_target << 7 | wrap << 12
+        if jmp_pin is not None:
+            execctrl = (execctrl & ~(0x1f << 24)) | _pin_id(jmp_pin) << 24
+        shiftctrl = program[_PROG_SHIFTCTRL]
+        if in_shiftdir is not None:
+            shiftctrl = (shiftctrl & ~(1 << 18)) | in_shiftdir << 18
+        if out_shiftdir is not None:
+            shiftctrl = (shiftctrl & ~(1 << 19)) | out_shiftdir << 19
+        if push_thresh is not None:
+            shiftctrl = (shiftctrl & ~(0x1f << 20)) | (push_thresh & 0x1f) << 20
+        if pull_thresh is not None:
+            shiftctrl = (shiftctrl & ~(0x1f << 25)) | (pull_thresh & 0x1f) << 25
+
+        out_count = _pin_count(program[_PROG_OUT_PINS])
+        set_count = _pin_count(program[_PROG_SET_PINS])
+        side_count = _pin_count(program[_PROG_SIDESET_PINS])
+        pinctrl = (side_count + ((execctrl >> 30) & 1)) << 29 | set_count << 26 | out_count << 20
+        bases = {"out": out_base, "set": set_base, "sideset": sideset_base, "in": in_base}
+        for name, shift in (("out", 0), ("set", 5), ("sideset", 10), ("in", 15)):
+            if bases[name] is not None:
+                bases[name] = _pin_id(bases[name])
+                pinctrl |= bases[name] << shift
+
+        sm.clkdiv = clkdiv
+        sm.execctrl = execctrl
+        sm.shiftctrl = shiftctrl
+        sm.pinctrl = pinctrl
+        sm.tx.clear()
+        sm.rx.clear()
+        pio.pio.fdebug &= ~(0x01010101 << sm.index)
+        sim.sm_init_pins(sm, bases, program)
+        sim.sm_restart(sm)
+        sim.sm_exec(sm, offset)  # jmp to the start of the program
+
+    def active(self, value=None):
+        pio = self.sm.pio
+        if value is None:
+            return bool(pio.ctrl & (1 << self.sm.index))
+        if value:
+            if not pio.ctrl & (1 << self.sm.index):
+                self.sm.next_tick = SIM.now
+            pio.ctrl |= 1 << self.sm.index
+        else:
+            pio.ctrl &= ~(1 << self.sm.index)
+        SIM.run(ACCESS_CYCLES)
+        return None
+
+    def restart(self):
+        SIM.sm_restart(self.sm)
+        SIM.sm_exec(self.sm, self.offset)
+
+    def exec(self, instr):
+        SIM.sm_exec(self.sm, instr)
+
+    def get(self, buf=None, shift=0):
+        sm = self.sm
+        if buf is None:
+            SIM.run_until(lambda: sm.rx, 1 << 40)
+            SIM.run(ACCESS_CYCLES)
+            return sm.rx.popleft() >> shift
+        for i in range(len(buf)):
+            SIM.run_until(lambda: sm.rx, 1 << 40)
+            SIM.run(ACCESS_CYCLES)
+            buf[i] = sm.rx.popleft() >> shift
+        return None
+
+    def put(self, value, shift=0):
+        sm = self.sm
+        values = [value] if isinstance(value, int) else value
+        for v in values:
+            SIM.run_until(lambda: len(sm.tx) < sm.tx_depth(), 1 << 40)
+            sm.tx.append((v << shift) & 0xffffffff)
+            SIM.run(ACCESS_CYCLES)
+
+    def rx_fifo(self):
+        return len(self.sm.rx)
+
+    def tx_fifo(self):
+        return len(self.sm.tx)
+
+    def irq(self, handler=None, trigger=0 | 1, hard=False):
+        key = (self.id // 4, self.id % 4)
+        if handler is None:
+            _irq_handlers.pop(key, None)
+        else:
+            _irq_handlers[key] = lambda: handler(self)
+
+
+class _Mem:
+    # machine.mem8, mem16 and mem32
+    def __init__(self, size):
+        self.size = size
+
+    def __getitem__(self, addr):
+        return SIM.cpu_read(addr, self.size)
+
+    def __setitem__(self, addr, value):
+        SIM.cpu_write(addr, self.size, value)
+
+
+def _freq(value=None):
+    if value is None:
+        return SIM.freq
+    SIM.freq = value
+    return None
+
+
+#
+# Installing the simulation into the Python runtime
+#
+
+SIM = None
+
+
+def _to_int32(value):
+    return ((value & 0xffffffff) ^ 0x80000000) - 0x80000000
+
+
+def _viper(sim):
+    # Replacement for @micropython.viper and @micropython.native.
+    # Arguments annotated as ptr8/ptr16/ptr32 are turned into pointers
+    # and results annotated as int or uint are truncated to 32 bit,
+    # like the native code emitter does.
+    import functools
+    import inspect
+
+    def decorator(func):
+        sig = inspect.signature(func)
+        sizes = {}
+        for name, param in sig.parameters.items():
+            for size, ptr in ((1, builtins.ptr8), (2, builtins.ptr16), (4, builtins.ptr32)):
+                if param.annotation is ptr:
+                    sizes[name] = size
+        result = sig.return_annotation
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            if sizes:
+                args = list(args)
+                for i, name in enumerate(sig.parameters):
+                    if name in sizes and i < len(args):
+                        args[i] = sim.ptr(sizes[name])(args[i])
+            sim.native += 1
+            try:
+                value = func(*args)
+            finally:
+                sim.native -= 1
+            if isinstance(value, int) and not isinstance(value, bool):
+                if result is builtins.uint:
+                    value &= 0xffffffff
+                elif result is int:
+                    value = _to_int32(value)
+            return value
+        return wrapper
+    return decorator
+
+
+def _tracer(sim, root):
+    # Charge line_cycles for every line of Python code executed in the
+    # modules of the repository, so that polling loops, which do not
+    # access registers, let the virtual time advance as well.
+    def local(frame, event, arg):
+        if event == "line" and not sim.native:
+            sim.run(sim.line_cycles)
+        return local
+
+    own = os.path.dirname(os.path.abspath(__file__))
+
+    def trace(frame, event, arg):
+        name = frame.f_code.co_filename
+        if name.startswith(root) and not name.startswith(own):
+            return local
+        return None
+    return trace
+
+
+def _ticks_diff(a, b):
+    return a - b
+
+
+def install(sim=None):
+    # Provide the MicroPython specific names and modules, backed by sim.
+    global SIM
+    SIM = sim = sim if sim is not None else Sim()
+    builtins.const = lambda value: value
+    builtins.uint = sim.uint
+    builtins.ptr8 = sim.ptr(1)
+    builtins.ptr16 = sim.ptr(2)
+    builtins.ptr32 = sim.ptr(4)
+
+    micropython = types.ModuleType("micropython")
+    micropython.const = builtins.const
+    micropython.viper = _viper(sim)
+    micropython.native = lambda func: func
+    micropython.schedule = lambda func, arg: func(arg)
+    micropython.alloc_emergency_exception_buf = lambda size: None
+    builtins.micropython = micropython
+    sys.modules["micropython"] = micropython
+
+    StateMachine._instances.clear()
+    _irq_handlers.clear()
+    PIO._used[:] = [0, 0]
+    PIO._programs[:] = [{}, {}]
+    rp2 = types.ModuleType("rp2")
+    rp2.PIO = PIO
+    rp2.StateMachine = StateMachine
+    sys.modules["rp2"] = rp2
+
+    machine = types.ModuleType("machine")
+    machine.freq = _freq
+    machine.mem8 = _Mem(1)
+    machine.mem16 = _Mem(2)
+    machine.mem32 = _Mem(4)
+    sys.modules["machine"] = machine
+
+    uctypes = types.ModuleType("uctypes")
+    uctypes.addressof = sim.uint
+    sys.modules["uctypes"] = uctypes
+
+    time.sleep_ms = lambda ms: sim.sleep_us(ms * 1000)
+    time.sleep_us = sim.sleep_us
+    time.ticks_us = sim.ticks_us
+    time.ticks_ms = lambda: sim.ticks_us() // 1000
+    time.ticks_cpu = lambda: sim.now
+    time.ticks_diff = _ticks_diff
+    time.ticks_add = lambda a, b: a + b
+    sys.modules["utime"] = time
+
+    # make the modules of the repository importable
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if os.path.isdir(path) and not name.startswith(".") and path not in sys.path:
+            sys.path.append(path)
+    if sim.line_cycles:
+        sys.settrace(_tracer(sim, root))
+    return sim
@@ -2,12 +2,19 @@
 # set set of small functions supporting the use of the PIO
 #
 
+import array
+import time
+import uctypes
+import rp2
+_DMA = getattr(rp2, "DMA", None)  # the channel allocator of the firmware
+
 PIO0_BASE = const(0x50200000)
 PIO1_BASE = const(0x50300000)
 
 # register indices into the array of 32 bit registers
 PIO_CTRL = const(0)
 PIO_FSTAT = const(1)
+PIO_FDEBUG = const(2)
 PIO_FLEVEL = const(3)
 SM_REG_BASE = const(0x32)  # start of the SM state tables
 # register offsets into the per-SM state table
@@ -25,6 +32,12 @@ SM_FIFO_RXEMPTY = const(0x00000100)
 SM_FIFO_TXFULL  = const(0x00010000)
 SM_FIFO_TXEMPTY = const(0x01000000)
 
+SM_FDEBUG_RXSTALL = const(0x00000001)
+SM_FDEBUG_RXUNDER = const(0x00000100)
+SM_FDEBUG_TXOVER  = const(0x00010000)
+SM_FDEBUG_TXSTALL = const(0x01000000)
+SM_FDEBUG_ALL     = const(0x01010101)
+
 
 @micropython.viper
 def sm_restart(sm: int, program) -> uint:
@@ -71,6 +84,44 @@ def sm_fifo_status(sm: int) -> int:
     sm %= 4
     return (pio[PIO_FSTAT] >> sm) & 0x01010101
 
+#
+# Counters of the FDEBUG events, 4 per state machine in the order
+# RXSTALL, RXUNDER, TXOVER, TXSTALL. They are counted by sm_fdebug(),
+# once per call which finds the flag set. sm_fdebug_clear() clears the
+# flags given by mask without counting them, e.g. those of a stall which
+# is expected.
+#
+_sm_events = array.array("I", bytearray(4 * 8 * 4))
+
+@micropython.viper
+def sm_fdebug(sm: int) -> int:
+    events = ptr32(_sm_events)
+    index = sm * 4
+    if sm < 4:   # PIO 0
+        pio = ptr32(uint(PIO0_BASE))
+    else:  # PIO1
+        pio = ptr32(uint(PIO1_BASE))
+    sm %= 4
+    flags = (pio[PIO_FDEBUG] >> sm) & 0x01010101
+    pio[PIO_FDEBUG] = flags << sm  # clear the flags, which were set
+    i = 0
+    while i < 4:
+        if flags & (1 << (8 * i)):
+            events[index + i] += 1
+        i += 1
+    return flags
+
+@micropython.viper
+def sm_fdebug_clear(sm: int, mask: int) -> int:
+    if sm < 4:   # PIO 0
+        pio = ptr32(uint(PIO0_BASE))
+    else:  # PIO1
+        pio = ptr32(uint(PIO1_BASE))
+    sm %= 4
+    flags = (pio[PIO_FDEBUG] >> sm) & mask & 0x01010101
+    pio[PIO_FDEBUG] = flags << sm
+    return flags
+
 @micropython.viper
 def sm_fifo_join(sm: int, action: int):
     if sm < 4:   # PIO 0
@@ -87,6 +138,133 @@ def sm_fifo_join(sm: int, action: int):
     elif action == 2:  # join TX
         pio[smx] = (((pio[smx] >> 16) & 0x3fff) | (1 << 14)) << 16
 
+#
+# Tell whether a state machine is enabled
+#
+@micropython.viper
+def sm_is_active(sm: int) -> int:
+    if sm < 4:   # PIO 0
+        pio = ptr32(uint(PIO0_BASE))
+    else:  # PIO1
+        pio = ptr32(uint(PIO1_BASE))
+    sm %= 4
+    return (pio[PIO_CTRL] >> sm) & 1
+
+#
+# Enable or disable several state machines of a PIO with one write to
+# the CTRL register: PIO number, mask of the state machines, enable
+# When enabling, the clock dividers of the state machines are restarted
+# as well, such that they start in the same cycle and run in lockstep.
+#
+@micropython.viper
+def sm_enable_mask(pio_nr: int, mask: int, enable: int):
+    if pio_nr == 0:   # PIO 0
+        pio = ptr32(uint(PIO0_BASE))
+    else:  # PIO1
+        pio = ptr32(uint(PIO1_BASE))
+    mask &= 0xf
+    if enable:
+        pio[PIO_CTRL] = pio[PIO_CTRL] | mask | (mask << 8)  # CLKDIV_RESTART
+    else:
+        pio[PIO_CTRL] = pio[PIO_CTRL] & ~mask
+
+#
+# The manager of the state machines and the instruction memory.
+# sm_claim() returns the number of a free state machine on a PIO, into
+# which the program is loaded, and sm_release() returns it. Identical
+# programs share one copy in the instruction memory, which is removed
+# when the last state machine using it is released.
+#
+_sm_claimed = {}  # state machine number: instructions of its program
+_pio_programs = ({}, {})  # per PIO: instructions: [program, users, aliases]
+
+def _sm_free(pio):
+    for sm in range(pio * 4, pio * 4 + 4):
+        if sm not in _sm_claimed and not sm_is_active(sm):
+            return sm
+    return -1
+
+def sm_claim(program, pio=None, sm=None):
+    key = bytes(program[0])
+    if sm is not None:
+        if sm in _sm_claimed or not 0 <= sm < 8:
+            raise ValueError("state machine not available")
+        candidates = (sm // 4,)
+    elif pio is not None:
+        candidates = (pio,)
+    elif key in _pio_programs[1] and key not in _pio_programs[0]:
+        candidates = (1, 0)  # the program is loaded already at PIO1
+    else:
+        candidates = (0, 1)
+    for p in candidates:
+        nr = _sm_free(p) if sm is None else sm
+        if nr < 0:
+            continue
+        entry = _pio_programs[p].get(key)
+        if entry is None:
+            if program[1 + p] < 0:
+                try:
+                    rp2.PIO(p).add_program(program)
+                except OSError:
+                    continue  # no space left in the instruction memory
+            entry = _pio_programs[p][key] = [program, 0, []]
+        elif program is not entry[0] and program[1 + p] < 0:
+            program[1 + p] = entry[0][1 + p]  # use the loaded copy
+            entry[2].append(program)
+        entry[1] += 1
+        _sm_claimed[nr] = key
+        return nr
+    raise RuntimeError("no free state machine")
+
+def sm_release(sm):
+    if sm not in _sm_claimed:
+        raise ValueError("state machine not claimed")
+    rp2.StateMachine(sm).active(0)
+    p = sm // 4
+    key = _sm_claimed.pop(sm)
+    entry = _pio_programs[p][key]
+    entry[1] -= 1
+    if entry[1] == 0:
+        rp2.PIO(p).remove_program(entry[0])
+        for program in entry[2]:
+            program[1 + p] = -1
+        del _pio_programs[p][key]
+
+#
+# The number of instruction memory slots used by the programs
+# loaded with sm_claim(): PIO number
+#
+def pio_slots_used(pio):
+    return sum([len(entry[0][0]) for entry in _pio_programs[pio].values()])
+
+#
+# Set the push threshold, which tells sm_dma_get() the transfer size:
+# State machine number, number of bits (32 is stored as 0)
+#
+@micropython.viper
+def sm_push_thresh(sm: int, nbits: int):
+    if sm < 4:   # PIO 0
+        pio = ptr32(uint(PIO0_BASE))
+    else:  # PIO1
+        pio = ptr32(uint(PIO1_BASE))
+    sm %= 4
+    smx = SM_REG_BASE + sm * SMx_SIZE + SMx_SHIFTCTRL
+    pio[smx] = (pio[smx] & ~(0x1f << 20)) | ((nbits & 0x1f) << 20)
+
+#
+# Set the pull threshold, e.g. to change the size of the words taken by
+# autopull: State machine number, number of bits (32 is stored as 0)
+#
+@micropython.viper
+def sm_pull_thresh(sm: int, nbits: int):
+    if sm < 4:   # PIO 0
+        pio = ptr32(uint(PIO0_BASE))
+    else:  # PIO1
+        pio = ptr32(uint(PIO1_BASE))
+    sm %= 4
+    smx = SM_REG_BASE + sm * SMx_SIZE + SMx_SHIFTCTRL
+    pio[smx] = (pio[smx] & ~(0x1f << 25)) | ((nbits & 0x1f) << 25)
+
 #
 # PIO register byte address offsets
 #
@@ -109,14 +287,21 @@ WRITE_ADDR = const(1)
 TRANS_COUNT = const(2)
 CTRL_TRIG = const(3)
 CTRL_ALIAS = const(4)
+TRANS_COUNT_TRIG = const(7)  # alias 1
 TRANS_COUNT_ALIAS = const(9)
+WRITE_ADDR_TRIG = const(11)  # alias 2
+READ_ADDR_TRIG = const(15)  # alias 3
+MULTI_CHAN_TRIGGER = const(0x10c)  # Address offset / 4
 CHAN_ABORT = const(0x111)  # Address offset / 4
+SNIFF_CTRL = const(0x10d)  # Address offset / 4
+SNIFF_DATA = const(0x10e)  # Address offset / 4
+DMA_CHANNELS = const(12)
 BUSY = const(1 << 24)
 #
 # Template for assembling the DMA control word
+# CHAIN_TO is set to the channel itself, which disables chaining
 #
 IRQ_QUIET = const(1)  # do not generate an interrupt
-CHAIN_TO = const(0)  # do not chain
 RING_SEL = const(0)
 RING_SIZE = const(0)  # no wrapping
 HIGH_PRIORITY = const(1)
@@ -148,7 +333,8 @@ def sm_dma_get(chan:int, sm:int, dst:ptr32, nword:int) -> int:
 
     INCR_WRITE = 1  # 1 for increment while writing
     INCR_READ = 0  # 0 for no increment while reading
-    DMA_control_word = ((IRQ_QUIET << 21) | (TREQ_SEL << 15) | (CHAIN_TO << 11) | (RING_SEL << 10) |
+    SNIFF_EN = int(_dma_sniff_select(chan, DATA_SIZE))
+    DMA_control_word = ((SNIFF_EN << 23) | (IRQ_QUIET << 21) | (TREQ_SEL << 15) | (chan << 11) | (RING_SEL << 10) |
                         (RING_SIZE << 6) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
                         (HIGH_PRIORITY << 1) | (EN << 0))
     dma[READ_ADDR] = uint(pio) + PIO_RXF0 + sm * 4
@@ -157,6 +343,106 @@ def sm_dma_get(chan:int, sm:int, dst:ptr32, nword:int) -> int:
     dma[CTRL_TRIG] = DMA_control_word  # and this starts the transfer
     return DMA_control_word
 
+#
+# Set up a transfer from the State machine using DMA, but do not start it:
+# DMA channel, State machine number, buffer, buffer length
+# The transfer is started by dma_trigger() or by a channel chaining to it.
+#
+@micropython.viper
+def sm_dma_get_setup(chan:int, sm:int, dst:ptr32, nword:int) -> int:
+
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    if sm < 4:   # PIO 0
+        pio = ptr32(uint(PIO0_BASE))
+        TREQ_SEL = sm + 4  # range 4-7
+    else:  # PIO1
+        sm %= 4
+        pio = ptr32(uint(PIO1_BASE))
+        TREQ_SEL = sm + 12  # range 12-15
+    smx = SM_REG_BASE + sm * SMx_SIZE + SMx_SHIFTCTRL  # get the push threshold
+    DATA_SIZE = (pio[smx] >> 20) & 0x1f  # to determine the transfer size
+    if DATA_SIZE > 16 or DATA_SIZE == 0:
+        DATA_SIZE = 2  # 32 bit transfer
+    elif DATA_SIZE > 8:
+        DATA_SIZE = 1  # 16 bit transfer
+    else:
+        DATA_SIZE = 0  # 8 bit transfer
+
+    INCR_WRITE = 1  # 1 for increment while writing
+    INCR_READ = 0  # 0 for no increment while reading
+    SNIFF_EN = int(_dma_sniff_select(chan, DATA_SIZE))
+    DMA_control_word = ((SNIFF_EN << 23) | (IRQ_QUIET << 21) | (TREQ_SEL << 15) | (chan << 11) | (RING_SEL << 10) |
+                        (RING_SIZE << 6) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
+                        (HIGH_PRIORITY << 1) | (EN << 0))
+    dma[READ_ADDR] = uint(pio) + PIO_RXF0 + sm * 4
+    dma[WRITE_ADDR] = uint(dst)
+    dma[TRANS_COUNT] = nword
+    dma[CTRL_ALIAS] = DMA_control_word  # this does not start the transfer
+    return DMA_control_word
+
+#
+# Read from the State machine using DMA into a ring buffer:
+# DMA channel, State machine number, buffer, buffer length
+# The write address wraps at the end of the buffer, and the transfer
+# runs until it is aborted, or for 2**32 - 1 items, unless it is kept
+# running with dma_ring_rearm(). The size of the buffer in bytes must be a
+# power of 2 between 2 and 32768 and the buffer must be aligned to
+# that size, like the ones returned by dma_ring_buffer().
+#
+@micropython.viper
+def sm_dma_get_ring(chan:int, sm:int, dst:ptr32, nword:int) -> int:
+
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    if sm < 4:   # PIO 0
+        pio = ptr32(uint(PIO0_BASE))
+        TREQ_SEL = sm + 4  # range 4-7
+    else:  # PIO1
+        sm %= 4
+        pio = ptr32(int(PIO1_BASE))
+        TREQ_SEL = sm + 12  # range 12 - 13
+    smx = SM_REG_BASE + sm * SMx_SIZE + SMx_SHIFTCTRL  # get the push threshold
+    DATA_SIZE = (pio[smx] >> 20) & 0x1f  # to determine the transfer size
+    if DATA_SIZE > 16 or DATA_SIZE == 0:
+        DATA_SIZE = 2  # 32 bit transfer
+    elif DATA_SIZE > 8:
+        DATA_SIZE = 1  # 16 bit transfer
+    else:
+        DATA_SIZE = 0  # 8 bit transfer
+
+    ring_bytes = nword << DATA_SIZE
+    RING_SIZE_BITS = 1
+    while (1 << RING_SIZE_BITS) < ring_bytes:
+        RING_SIZE_BITS += 1
+    if ring_bytes != (1 << RING_SIZE_BITS) or RING_SIZE_BITS > 15:
+        raise ValueError("ring size must be a power of 2")
+    if uint(dst) & uint(ring_bytes - 1):
+        raise ValueError("ring buffer not aligned")
+
+    INCR_WRITE = 1  # 1 for increment while writing
+    INCR_READ = 0  # 0 for no increment while reading
+    RING_SEL_WRITE = 1  # wrap the write address
+    SNIFF_EN = int(_dma_sniff_select(chan, DATA_SIZE))
+    DMA_control_word = ((SNIFF_EN << 23) | (IRQ_QUIET << 21) | (TREQ_SEL << 15) | (chan << 11) | (RING_SEL_WRITE << 10) |
+                        (RING_SIZE_BITS << 6) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
+                        (HIGH_PRIORITY << 1) | (EN << 0))
+    dma[READ_ADDR] = uint(pio) + PIO_RXF0 + sm * 4
+    dma[WRITE_ADDR] = uint(dst)
+    dma[TRANS_COUNT] = -1  # 0xffffffff transfers, almost endless
+    dma[CTRL_TRIG] = DMA_control_word  # and this starts the transfer
+    return DMA_control_word
+
+#
+# Allocate a buffer for a DMA ring: array type code, number of items
+# The buffer is aligned to its size in bytes, which must be a power of 2.
+# It is returned as memoryview of a larger array.
+#
+def dma_ring_buffer(typecode, nword):
+    itemsize = {"b": 1, "B": 1, "h": 2, "H": 2, "i": 4, "I": 4}[typecode]
+    size = nword * itemsize
+    buffer = array.array(typecode, bytearray(2 * size))
+    offset = (-uctypes.addressof(buffer)) & (size - 1)
+    return memoryview(buffer)[offset // itemsize:offset // itemsize + nword]
+
 #
 # Write to the State machine using DMA:
 # DMA channel, State machine number, buffer, buffer length
@@ -183,7 +469,8 @@ def sm_dma_put(chan:int, sm:int, src:ptr32, nword:int) -> int:
 
     INCR_WRITE = 0  # 1 for increment while writing
     INCR_READ = 1  # 0 for no increment while reading
-    DMA_control_word = ((IRQ_QUIET << 21) | (TREQ_SEL << 15) | (CHAIN_TO << 11) | (RING_SEL << 10) |
+    SNIFF_EN = int(_dma_sniff_select(chan, DATA_SIZE))
+    DMA_control_word = ((SNIFF_EN << 23) | (IRQ_QUIET << 21) | (TREQ_SEL << 15) | (chan << 11) | (RING_SEL << 10) |
                         (RING_SIZE << 9) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
                         (HIGH_PRIORITY << 1) | (EN << 0))
     dma[READ_ADDR] = uint(src)
@@ -192,11 +479,54 @@ def sm_dma_put(chan:int, sm:int, src:ptr32, nword:int) -> int:
     dma[CTRL_TRIG] = DMA_control_word  # and this starts the transfer
     return DMA_control_word
 
+#
+# Set up a transfer to the State machine using DMA, but do not start it:
+# DMA channel, State machine number, buffer, buffer length
+# The transfer is started by dma_trigger() or by a channel chaining to it.
+#
+@micropython.viper
+def sm_dma_put_setup(chan:int, sm:int, src:ptr32, nword:int) -> int:
+
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    if sm < 4:   # PIO 0
+        pio = ptr32(uint(PIO0_BASE))
+        TREQ_SEL = sm  # range 0-3
+    else:  # PIO1
+        sm %= 4
+        pio = ptr32(uint(PIO1_BASE))
+        TREQ_SEL = sm + 8  # range 8-11
+    smx = SM_REG_BASE + sm * SMx_SIZE + SMx_SHIFTCTRL  # get the pull threshold
+    DATA_SIZE = (pio[smx] >> 25) & 0x1f  # to determine the transfer size
+    if DATA_SIZE > 16 or DATA_SIZE == 0:
+        DATA_SIZE = 2  # 32 bit transfer
+    elif DATA_SIZE > 8:
+        DATA_SIZE = 1  # 16 bit transfer
+    else:
+        DATA_SIZE = 0  # 8 bit transfer
+
+    INCR_WRITE = 0  # 1 for increment while writing
+    INCR_READ = 1  # 0 for no increment while reading
+    SNIFF_EN = int(_dma_sniff_select(chan, DATA_SIZE))
+    DMA_control_word = ((SNIFF_EN << 23) | (IRQ_QUIET << 21) | (TREQ_SEL << 15) | (chan << 11) | (RING_SEL << 10) |
+                        (RING_SIZE << 6) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
+                        (HIGH_PRIORITY << 1) | (EN << 0))
+    dma[READ_ADDR] = uint(src)
+    dma[WRITE_ADDR] = uint(pio) + PIO_TXF0 + sm * 4
+    dma[TRANS_COUNT] = nword
+    dma[CTRL_ALIAS] = DMA_control_word  # this does not start the transfer
+    return DMA_control_word
+
 #
 # UART registers
 #
 UART0_BASE = const(0x40034000)
 UART1_BASE = const(0x40038000)
+# register indices into the array of 32 bit registers
+UART_DR = const(0)
+UART_FR = const(6)
+UART_IMSC = const(14)
+UART_DMACR = const(18)
+UART_IMSC_RX = const(0x50)  # RXIM and RTIM, the receive interrupts
 
 #
 # Read from UART using DMA:
@@ -215,7 +545,8 @@ def uart_dma_read(chan:int, uart_nr:int, data:ptr32, nword:int) -> int:
     DATA_SIZE = 0  # byte transfer
     INCR_WRITE = 1  # 1 for increment while writing
     INCR_READ = 0  # 0 for no increment while reading
-    DMA_control_word = ((IRQ_QUIET << 21) | (TREQ_SEL << 15) | (CHAIN_TO << 11) | (RING_SEL << 10) |
+    SNIFF_EN = int(_dma_sniff_select(chan, DATA_SIZE))
+    DMA_control_word = ((SNIFF_EN << 23) | (IRQ_QUIET << 21) | (TREQ_SEL << 15) | (chan << 11) | (RING_SEL << 10) |
                         (RING_SIZE << 9) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
                         (HIGH_PRIORITY << 1) | (EN << 0))
     dma[READ_ADDR] = uart_dr
@@ -223,6 +554,307 @@ def uart_dma_read(chan:int, uart_nr:int, data:ptr32, nword:int) -> int:
     dma[TRANS_COUNT] = nword
     dma[CTRL_TRIG] = DMA_control_word  # and this starts the transfer
     return DMA_control_word
+
+#
+# Read from UART using DMA into a ring buffer:
+# DMA channel, UART number, buffer, buffer length
+# Like sm_dma_get_ring(), the transfer runs until it is aborted, and the
+# buffer size must be a power of 2 with the buffer aligned to its size.
+#
+@micropython.viper
+def uart_dma_read_ring(chan:int, uart_nr:int, data:ptr8, nword:int) -> int:
+
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    if uart_nr == 0:   # UART0
+        uart_dr = uint(UART0_BASE)
+        TREQ_SEL = 21
+    else:  # UART1
+        uart_dr = uint(UART1_BASE)
+        TREQ_SEL = 23
+    RING_SIZE_BITS = 1
+    while (1 << RING_SIZE_BITS) < nword:
+        RING_SIZE_BITS += 1
+    if nword != (1 << RING_SIZE_BITS) or RING_SIZE_BITS > 15:
+        raise ValueError("ring size must be a power of 2")
+    if uint(data) & uint(nword - 1):
+        raise ValueError("ring buffer not aligned")
+    DATA_SIZE = 0  # byte transfer
+    INCR_WRITE = 1  # 1 for increment while writing
+    INCR_READ = 0  # 0 for no increment while reading
+    RING_SEL_WRITE = 1  # wrap the write address
+    SNIFF_EN = int(_dma_sniff_select(chan, DATA_SIZE))
+    DMA_control_word = ((SNIFF_EN << 23) | (IRQ_QUIET << 21) | (TREQ_SEL << 15) | (chan << 11) | (RING_SEL_WRITE << 10) |
+                        (RING_SIZE_BITS << 6) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
+                        (HIGH_PRIORITY << 1) | (EN << 0))
+    dma[READ_ADDR] = uart_dr
+    dma[WRITE_ADDR] = uint(data)
+    dma[TRANS_COUNT] = -1  # 0xffffffff transfers, almost endless
+    dma[CTRL_TRIG] = DMA_control_word  # and this starts the transfer
+    return DMA_control_word
+
+#
+# Let the DMA take the received data of a UART: UART number, enable.
+# The receive interrupts are disabled, such that the driver of
+# machine.UART does not take data from the FIFO, and enabled again
+# with enable = 0, which also stops the DMA requests of the UART.
+#
+@micropython.viper
+def uart_dma_rx_enable(uart_nr:int, enable:int):
+    if uart_nr == 0:   # UART0
+        uart = ptr32(uint(UART0_BASE))
+    else:  # UART1
+        uart = ptr32(uint(UART1_BASE))
+    if enable:
+        uart[UART_IMSC] = uart[UART_IMSC] & ~UART_IMSC_RX
+        uart[UART_DMACR] = uart[UART_DMACR] | 1  # RXDMAE
+    else:
+        uart[UART_DMACR] = uart[UART_DMACR] & ~1  # no RX DREQ any more
+        uart[UART_IMSC] = uart[UART_IMSC] | UART_IMSC_RX
+
+#
+# Continuous reception from a UART into a DMA ring buffer: UART number,
+# ring size in bytes, a power of 2. The DMA keeps running until deinit().
+# The number of bytes received is taken from the transfer count of the
+# DMA, and read() returns the new data as memoryview into the ring.
+#
+class UartDmaRx:
+    COUNT = 0xffffffff  # the bytes of a pass of the ring channel
+
+    def __init__(self, uart_nr, size=256):
+        self.uart_nr = uart_nr
+        self.size = size
+        self.ring = dma_ring_buffer("B", size)
+        self.chan = dma_claim()
+        self.ctrl_chan = dma_claim()  # restarts the ring channel
+        self.read_count = 0  # bytes taken from the ring so far, modulo COUNT
+        self.read_pos = 0  # and the position of the next one in the ring
+        self.lost = 0  # bytes overwritten before being read
+        uart_dma_rx_enable(uart_nr, 1)
+        uart_dma_read_ring(self.chan, uart_nr, self.ring, size)
+        dma_ring_rearm(self.chan, self.ctrl_chan)
+
+    def deinit(self):
+        if self.chan is not None:
+            dma_ring_stop(self.chan, self.ctrl_chan)
+            dma_release(self.ctrl_chan)
+            dma_release(self.chan)
+            uart_dma_rx_enable(self.uart_nr, 0)
+            self.chan = self.ctrl_chan = None
+
+    # The number of bytes received since the start, modulo COUNT. The
+    # transfer count runs from COUNT down to 1, and shows 0 for a moment
+    # before the restart, which is the same position as COUNT.
+    def _received(self):
+        return (self.COUNT - (dma_transfer_count(self.chan) & self.COUNT)) % self.COUNT
+
+    # Return the number of bytes waiting. If the DMA overwrote data which
+    # was not read yet, the read position skips to the oldest valid byte.
+    def any(self):
+        waiting = (self._received() - self.read_count) % self.COUNT
+        if waiting > self.size:
+            skip = waiting - self.size
+            self.lost += skip
+            self.read_count = (self.read_count + skip) % self.COUNT
+            self.read_pos = (self.read_pos + skip) % self.size
+            waiting = self.size
+        return waiting
+
+    # Return up to nbytes of the received data as memoryview into the
+    # ring. When the data wraps around at the end of the ring, the part up
+    # to the end is returned, and the next call returns the rest. The data
+    # is valid until the DMA wraps around and overwrites it.
+    def read(self, nbytes=-1):
+        waiting = self.any()
+        if nbytes < 0 or nbytes > waiting:
+            nbytes = waiting
+        start = self.read_pos
+        nbytes = min(nbytes, self.size - start)
+        self.read_count = (self.read_count + nbytes) % self.COUNT
+        self.read_pos = (start + nbytes) % self.size
+        return self.ring[start:start + nbytes]
+
+    # Copy the received data into buf, up to its size, and return the
+    # number of bytes copied.
+    def readinto(self, buf):
+        mv = memoryview(buf)
+        n = 0
+        while n < len(mv):
+            chunk = self.read(len(mv) - n)
+            if not chunk:
+                break
+            mv[n:n + len(chunk)] = chunk
+            n += len(chunk)
+        return n
+
+#
+# Write to UART using DMA:
+# DMA channel, UART number, buffer, buffer length in bytes
+# The transmit DMA request of the UART is enabled as well.
+#
+@micropython.viper
+def uart_dma_write(chan:int, uart_nr:int, data:ptr8, nbytes:int) -> int:
+
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    if uart_nr == 0:   # UART0
+        uart = ptr32(uint(UART0_BASE))
+        TREQ_SEL = 20
+    else:  # UART1
+        uart = ptr32(uint(UART1_BASE))
+        TREQ_SEL = 22
+    DATA_SIZE = 0  # byte transfer
+    INCR_WRITE = 0  # 0 for no increment while writing
+    INCR_READ = 1  # 1 for increment while reading
+    SNIFF_EN = int(_dma_sniff_select(chan, DATA_SIZE))
+    DMA_control_word = ((SNIFF_EN << 23) | (IRQ_QUIET << 21) | (TREQ_SEL << 15) | (chan << 11) | (RING_SEL << 10) |
+                        (RING_SIZE << 9) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
+                        (HIGH_PRIORITY << 1) | (EN << 0))
+    uart[UART_DMACR] = uart[UART_DMACR] | 2  # TXDMAE
+    dma[READ_ADDR] = uint(data)
+    dma[WRITE_ADDR] = uint(uart)
+    dma[TRANS_COUNT] = nbytes
+    dma[CTRL_TRIG] = DMA_control_word  # and this starts the transfer
+    return DMA_control_word
+
+#
+# Write a list of buffers to UART using two DMA channels:
+# DMA channel, control DMA channel, UART number, descriptor list
+# The descriptor list holds pairs of byte count and buffer address and
+# ends with a pair of zeros. The control channel writes each pair into
+# the TRANS_COUNT and READ_ADDR_TRIG registers of the data channel, which
+# starts it. When the data channel is done, it chains back to the control
+# channel for the next pair. The pair of zeros is a null trigger, which
+# ends the chain and raises the interrupt flag of the data channel.
+#
+@micropython.viper
+def uart_dma_write_sg(chan:int, ctrl_chan:int, uart_nr:int, desc:ptr32) -> int:
+
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    ctrl=ptr32(uint(DMA_BASE) + ctrl_chan * 0x40)
+    if uart_nr == 0:   # UART0
+        uart = ptr32(uint(UART0_BASE))
+        TREQ_SEL = 20
+    else:  # UART1
+        uart = ptr32(uint(UART1_BASE))
+        TREQ_SEL = 22
+    DATA_SIZE = 0  # byte transfer
+    INCR_WRITE = 0  # 0 for no increment while writing
+    INCR_READ = 1  # 1 for increment while reading
+    SNIFF_EN = int(_dma_sniff_select(chan, DATA_SIZE))
+    DMA_control_word = ((SNIFF_EN << 23) | (IRQ_QUIET << 21) | (TREQ_SEL << 15) | (ctrl_chan << 11) | (RING_SEL << 10) |
+                        (RING_SIZE << 9) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
+                        (HIGH_PRIORITY << 1) | (EN << 0))
+    uart[UART_DMACR] = uart[UART_DMACR] | 2  # TXDMAE
+    dma[WRITE_ADDR] = uint(uart)
+    dma[CTRL_ALIAS] = DMA_control_word  # set up, but not started
+    # the control channel: two words per descriptor, with the write
+    # address wrapping at 8 bytes over TRANS_COUNT and READ_ADDR_TRIG of
+    # the register alias 3 of the data channel
+    TREQ_PERMANENT = 0x3f
+    DATA_SIZE = 2  # word transfer
+    INCR_WRITE = 1
+    RING_SEL_WRITE = 1
+    RING_SIZE_BITS = 3
+    CTRL_control_word = ((IRQ_QUIET << 21) | (TREQ_PERMANENT << 15) | (ctrl_chan << 11) | (RING_SEL_WRITE << 10) |
+                         (RING_SIZE_BITS << 6) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
+                         (HIGH_PRIORITY << 1) | (EN << 0))
+    ctrl[READ_ADDR] = uint(desc)
+    ctrl[WRITE_ADDR] = uint(dma) + 0x38  # TRANS_COUNT of alias 3
+    ctrl[TRANS_COUNT] = 2
+    ctrl[CTRL_TRIG] = CTRL_control_word  # and this starts the transfer
+    return DMA_control_word
+
+#
+# Tell whether a UART is still sending: UART number
+# The last bytes are still in the FIFO of the UART when the DMA is done.
+#
+@micropython.viper
+def uart_tx_busy(uart_nr:int) -> int:
+    if uart_nr == 0:   # UART0
+        uart = ptr32(uint(UART0_BASE))
+    else:  # UART1
+        uart = ptr32(uint(UART1_BASE))
+    return (uart[UART_FR] >> 3) & 1  # BUSY
+
+#
+# Transmit to a UART with DMA: UART number, maximum number of buffers per
+# DMA run, callback. write() queues a buffer and returns at once. Queued
+# buffers are sent back-to-back with uart_dma_write_sg(). Buffers queued
+# while a run is in progress are sent by the next run, which is started
+# by poll(). poll() is called by the DMA interrupt if the firmware has
+# rp2.DMA, otherwise it has to be called by the application, which
+# flush() does as well. When all buffers are sent, callback is
+# called with the UartDmaTx object as argument. Keep the buffers
+# unchanged until they are sent.
+#
+class UartDmaTx:
+    def __init__(self, uart_nr, queue_len=8, callback=None):
+        self.uart_nr = uart_nr
+        self.queue_len = queue_len
+        self.callback = callback
+        self.desc = array.array("I", bytearray(8 * (queue_len + 1)))
+        self.pending = []  # buffers waiting for the next run
+        self.active = []  # buffers of the current run
+        self.chan = dma_claim()
+        self.ctrl_chan = dma_claim()
+        dma = _dma_claimed[self.chan]
+        if dma is not None:
+            dma.irq(lambda dma: self.poll())
+
+    def deinit(self):
+        if self.chan is not None:
+            dma = _dma_claimed[self.chan]
+            if dma is not None:
+                dma.irq(None)
+            dma_release(self.ctrl_chan)
+            dma_release(self.chan)
+            self.chan = None
+            self.pending = []
+            self.active = []
+
+    def _start(self):
+        batch = self.pending[:self.queue_len]
+        del self.pending[:self.queue_len]
+        desc = self.desc
+        for i, buf in enumerate(batch):
+            desc[2 * i] = len(buf)
+            desc[2 * i + 1] = uctypes.addressof(buf)
+        desc[2 * len(batch)] = 0  # the null trigger
+        desc[2 * len(batch) + 1] = 0
+        # move the read address of the idle control channel away from the
+        # end of the list, such that poll() cannot take the previous run
+        # for this one
+        dma_rearm_read(self.ctrl_chan, desc, 2)
+        self.active = batch
+        uart_dma_write_sg(self.chan, self.ctrl_chan, self.uart_nr, desc)
+
+    # Queue buf for sending. Empty buffers are ignored.
+    def write(self, buf):
+        if len(buf):
+            self.pending.append(buf)
+            if not self.active:
+                self._start()
+
+    # Check for the end of the current run, start the next one or call
+    # the callback. Returns True while buffers are being sent.
+    def poll(self):
+        if self.active:
+            end = uctypes.addressof(self.desc) + 8 * (len(self.active) + 1)
+            if dma_read_addr(self.ctrl_chan) == end and not dma_busy(self.ctrl_chan) \
+                    and not dma_busy(self.chan):
+                self.active = []
+                if self.pending:
+                    self._start()
+                elif self.callback is not None:
+                    self.callback(self)
+        return bool(self.active)
+
+    # Wait until all buffers are sent and the UART is idle.
+    def flush(self):
+        while self.poll():
+            time.sleep_us(100)
+        while uart_tx_busy(self.uart_nr):
+            time.sleep_us(100)
+
 #
 # Get the current transfer count
 #
@@ -246,11 +878,547 @@ def dma_read_addr(chan:uint) -> int:
     dma=ptr32(uint(DMA_BASE) + chan * 0x40)
     return dma[READ_ADDR]
 #
+# Tell whether a transfer is in progress
+#
+@micropython.viper
+def dma_busy(chan:uint) -> int:
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    return (dma[CTRL_TRIG] >> 24) & 1
+
+#
+# Start a transfer, which was set up before
+#
+@micropython.viper
+def dma_trigger(chan:uint):
+    dma=ptr32(uint(DMA_BASE))
+    dma[MULTI_CHAN_TRIGGER] = 1 << chan
+
+#
+# Set the channel to be started when a transfer is finished.
+# Chaining to the channel itself stops chaining.
+#
+@micropython.viper
+def dma_chain_to(chan:uint, chain_to:uint):
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    dma[CTRL_ALIAS] = (dma[CTRL_ALIAS] & ~(0xf << 11)) | (chain_to << 11)
+
+#
+# Set the buffer and length for the next start of a transfer from
+# memory, without starting it: DMA channel, buffer, buffer length
+#
+@micropython.viper
+def dma_rearm_read(chan:uint, src:ptr32, nword:int):
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    dma[READ_ADDR] = uint(src)
+    dma[TRANS_COUNT] = nword
+
+#
+# Let a control channel restart a DMA channel each time its transfer is
+# finished, e.g. for sending a pattern repeatedly:
+# DMA channel, control DMA channel, array of buffer addresses, increment
+# The DMA channel has to be set up before, e.g. with sm_dma_put_setup().
+# It is chained to the control channel, which writes a buffer address
+# to the READ_ADDR_TRIG register of the alias 3 of the DMA channel. That
+# restarts it with the transfer count it was set up with. With incr = 0
+# the first address is used each time, and the loop runs until both
+# channels are aborted. With incr = 1 the control channel steps through
+# the addresses, and an address of 0 is a null trigger, which ends the loop.
+#
+@micropython.viper
+def dma_reload_read(chan:int, ctrl_chan:int, addr:ptr32, incr:int) -> int:
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    ctrl=ptr32(uint(DMA_BASE) + ctrl_chan * 0x40)
+    TREQ_PERMANENT = 0x3f
+    DATA_SIZE = 2  # word transfer
+    INCR_WRITE = 0  # the same register each time
+    INCR_READ = 1 if incr else 0
+    DMA_control_word = ((IRQ_QUIET << 21) | (TREQ_PERMANENT << 15) | (ctrl_chan << 11) | (RING_SEL << 10) |
+                        (RING_SIZE << 9) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
+                        (HIGH_PRIORITY << 1) | (EN << 0))
+    ctrl[READ_ADDR] = uint(addr)
+    ctrl[WRITE_ADDR] = uint(dma) + 0x3c  # READ_ADDR_TRIG of alias 3
+    ctrl[TRANS_COUNT] = 1
+    ctrl[CTRL_ALIAS] = DMA_control_word  # set up, started by chaining
+    dma[CTRL_ALIAS] = (dma[CTRL_ALIAS] & ~(0xf << 11)) | (ctrl_chan << 11)
+    return DMA_control_word
+
+#
+# Keep a ring transfer running without an end: DMA channel of the ring,
+# control DMA channel
+# A ring transfer, as set up by sm_dma_get_ring() or uart_dma_read_ring(),
+# stops after 2**32 - 1 items. Here it is chained to the control channel,
+# which writes that count again to the TRANS_COUNT_TRIG register of the
+# alias 1 of the ring channel. That restarts it at its actual write
+# address. The few items arriving meanwhile wait in the FIFO of the
+# source. The transfer count runs so from 0xffffffff down to 1 again
+# and again. Both channels are stopped with dma_ring_stop().
+#
+_ring_count = array.array("I", (0xffffffff,))
+
+@micropython.viper
+def dma_ring_rearm(chan:int, ctrl_chan:int) -> int:
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    ctrl=ptr32(uint(DMA_BASE) + ctrl_chan * 0x40)
+    count = ptr32(_ring_count)
+    TREQ_PERMANENT = 0x3f
+    DATA_SIZE = 2  # word transfer
+    INCR_WRITE = 0  # the same register each time
+    INCR_READ = 0  # and the same count
+    DMA_control_word = ((IRQ_QUIET << 21) | (TREQ_PERMANENT << 15) | (ctrl_chan << 11) | (RING_SEL << 10) |
+                        (RING_SIZE << 9) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
+                        (HIGH_PRIORITY << 1) | (EN << 0))
+    ctrl[READ_ADDR] = uint(count)
+    ctrl[WRITE_ADDR] = uint(dma) + TRANS_COUNT_TRIG * 4
+    ctrl[TRANS_COUNT] = 1
+    ctrl[CTRL_ALIAS] = DMA_control_word  # set up, started by chaining
+    dma[CTRL_ALIAS] = (dma[CTRL_ALIAS] & ~(0xf << 11)) | (ctrl_chan << 11)
+    return DMA_control_word
+
+#
+# Stop a ring transfer kept running by dma_ring_rearm(): DMA channel of
+# the ring, control DMA channel. The chain is broken first, such that
+# the abort does not restart the ring channel.
+#
+def dma_ring_stop(chan, ctrl_chan):
+    dma_chain_to(chan, chan)
+    dma_abort(ctrl_chan)
+    dma_abort(chan)
+
+#
+# Set up a DMA channel from a table, without starting it:
+# DMA channel, array of read address, write address, transfer count and
+# control word. For transfers, which are not covered by the functions
+# above, e.g. between DMA registers.
+#
+@micropython.viper
+def dma_config(chan:uint, regs:ptr32):
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    dma[READ_ADDR] = regs[0]
+    dma[WRITE_ADDR] = regs[1]
+    dma[TRANS_COUNT] = regs[2]
+    dma[CTRL_ALIAS] = regs[3]  # this does not start the transfer
+
+#
+# Copy memory using DMA: DMA channel, destination, source, number of bytes
+# The transfer size is the largest of 32, 16 and 8 bit, which fits the
+# alignment of both addresses and the number of bytes. The transfer is
+# started at once and runs at the full speed of the DMA.
+#
+@micropython.viper
+def dma_memcpy(chan:uint, dst:ptr8, src:ptr8, nbytes:uint) -> int:
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    align = uint(dst) | uint(src) | nbytes
+    if (align & 3) == 0:
+        DATA_SIZE = 2  # 32 bit transfer
+    elif (align & 1) == 0:
+        DATA_SIZE = 1  # 16 bit transfer
+    else:
+        DATA_SIZE = 0  # 8 bit transfer
+    TREQ_SEL = 0x3f  # permanent request
+    INCR_WRITE = 1  # 1 for increment while writing
+    INCR_READ = 1  # 1 for increment while reading
+    SNIFF_EN = int(_dma_sniff_select(chan, DATA_SIZE))
+    DMA_control_word = ((SNIFF_EN << 23) | (IRQ_QUIET << 21) | (TREQ_SEL << 15) | (chan << 11) | (RING_SEL << 10) |
+                        (RING_SIZE << 6) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
+                        (HIGH_PRIORITY << 1) | (EN << 0))
+    dma[READ_ADDR] = uint(src)
+    dma[WRITE_ADDR] = uint(dst)
+    dma[TRANS_COUNT] = nbytes >> DATA_SIZE
+    dma[CTRL_TRIG] = DMA_control_word  # and this starts the transfer
+    return DMA_control_word
+
+#
+# Fill memory using DMA: DMA channel, destination, pattern, number of bytes
+# pattern is a 32 bit word, which is read again and again. For a fill with
+# 8 or 16 bit values, it must hold the value 4 or 2 times. The transfer
+# size is chosen like for dma_memcpy().
+#
+@micropython.viper
+def dma_memset(chan:uint, dst:ptr8, pattern:ptr32, nbytes:uint) -> int:
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    align = uint(dst) | nbytes
+    if (align & 3) == 0:
+        DATA_SIZE = 2  # 32 bit transfer
+    elif (align & 1) == 0:
+        DATA_SIZE = 1  # 16 bit transfer
+    else:
+        DATA_SIZE = 0  # 8 bit transfer
+    TREQ_SEL = 0x3f  # permanent request
+    INCR_WRITE = 1  # 1 for increment while writing
+    INCR_READ = 0  # 0 for no increment while reading
+    SNIFF_EN = int(_dma_sniff_select(chan, DATA_SIZE))
+    DMA_control_word = ((SNIFF_EN << 23) | (IRQ_QUIET << 21) | (TREQ_SEL << 15) | (chan << 11) | (RING_SEL << 10) |
+                        (RING_SIZE << 6) | (INCR_WRITE << 5) | (INCR_READ << 4) | (DATA_SIZE << 2) |
+                        (HIGH_PRIORITY << 1) | (EN << 0))
+    dma[READ_ADDR] = uint(pattern)
+    dma[WRITE_ADDR] = uint(dst)
+    dma[TRANS_COUNT] = nbytes >> DATA_SIZE
+    dma[CTRL_TRIG] = DMA_control_word  # and this starts the transfer
+    return DMA_control_word
+
+#
+# Write a value to a DMA register, e.g. a trigger register to restart
+# a transfer which was set up before: array of register address and value
+#
+@micropython.viper
+def dma_retrigger(trig:ptr32):
+    reg=ptr32(trig[0])
+    reg[0] = trig[1]
+
+#
+# Get the transfer count, which a channel was started with. It is the
+# value of TRANS_COUNT at the last trigger, kept in the DBG_TCR register.
+#
+@micropython.viper
+def dma_reload_count(chan:uint) -> int:
+    dma=ptr32(uint(DMA_BASE) + 0x800 + chan * 0x40)
+    return dma[1]  # CHx_DBG_TCR
+
+#
+# Get the size of a transfer in bytes: 1, 2 or 4
+#
+@micropython.viper
+def dma_data_size(chan:uint) -> int:
+    dma=ptr32(uint(DMA_BASE) + chan * 0x40)
+    return 1 << ((dma[CTRL_TRIG] >> 2) & 3)
+
+#
+# Counters of the DMA channels, 4 per channel: bytes moved, number of
+# transfers, time of the transfers in µs, and aborts of running transfers.
+# The aborts are counted by dma_abort(), the others by dma_stats_end().
+#
+_dma_stats = array.array("I", bytearray(4 * DMA_CHANNELS * 4))
+_dma_started = [None] * DMA_CHANNELS  # ticks_us() of dma_stats_begin()
+
+#
+# The sniffer of the DMA calculates a CRC or checksum of the data of one
+# channel while it is transferred. The modes are the CALC values of the
+# SNIFF_CTRL register. SNIFF_CRC32 is the CRC-32 of zlib and Ethernet,
+# calculated over the bit reversed data and read back bit reversed and
+# inverted. SNIFF_CRC16 is the CRC-16-CCITT, e.g. of XMODEM with a seed
+# of 0. SNIFF_SUM adds the data items.
+#
+SNIFF_CRC32 = const(0x1)
+SNIFF_CRC16 = const(0x2)
+SNIFF_SUM = const(0xf)
+
+#
+# Enable the sniffer for a channel: DMA channel, mode, seed
+# Call it before setting up the transfer, e.g. with sm_dma_get(), which
+# then sets the SNIFF_EN bit of the channel. A channel, which is set up
+# already, gets the bit as well.
+#
+@micropython.viper
+def dma_sniff_enable(chan:uint, mode:uint, seed:uint):
+    dma=ptr32(uint(DMA_BASE))
+    sniff_ctrl = 1 | (chan << 1) | (mode << 5)
+    if mode == SNIFF_CRC32:
+        sniff_ctrl |= (1 << 10) | (1 << 11)  # OUT_REV, OUT_INV
+    dma[SNIFF_CTRL] = sniff_ctrl
+    dma[SNIFF_DATA] = seed
+    ch=ptr32(uint(DMA_BASE) + chan * 0x40)
+    SNIFF_EN = int(_dma_sniff_select(chan, (ch[CTRL_TRIG] >> 2) & 3))
+    ch[CTRL_ALIAS] = ch[CTRL_TRIG] | (SNIFF_EN << 23)  # this does not start a transfer
+
+@micropython.viper
+def dma_sniff_disable():
+    dma=ptr32(uint(DMA_BASE))
+    dma[SNIFF_CTRL] = 0
+
+#
+# Get the result of the sniffer
+#
+@micropython.viper
+def dma_sniff_result() -> uint:
+    dma=ptr32(uint(DMA_BASE))
+    if ((dma[SNIFF_CTRL] >> 5) & 0xf) == SNIFF_CRC16:
+        return dma[SNIFF_DATA] & 0xffff
+    return uint(dma[SNIFF_DATA])
+
+#
+# Tell whether the sniffer is enabled for a channel, when its control
+# word is assembled: DMA channel, DATA_SIZE of the transfer
+# For the CRC modes with data, which is not bit reversed, the bytes of
+# 16 and 32 bit items are swapped, such that they are taken in memory
+# order, as they are for SNIFF_CRC32.
+#
+@micropython.viper
+def _dma_sniff_select(chan:uint, size:uint) -> int:
+    dma=ptr32(uint(DMA_BASE))
+    sniff_ctrl = dma[SNIFF_CTRL]
+    if (sniff_ctrl & 0x1f) != ((chan << 1) | 1):
+        return 0
+    calc = (sniff_ctrl >> 5) & 0xf
+    if size > 0 and (calc == 0 or calc == 2):
+        dma[SNIFF_CTRL] = sniff_ctrl | (1 << 9)  # BSWAP
+    else:
+        dma[SNIFF_CTRL] = sniff_ctrl & ~(1 << 9)
+    return 1
+
+#
 # Abort an transfer
 #
 @micropython.viper
 def dma_abort(chan:uint):
     dma=ptr32(uint(DMA_BASE))
+    regs=ptr32(uint(DMA_BASE) + chan * 0x40)
+    if regs[CTRL_TRIG] & BUSY:
+        stats = ptr32(_dma_stats)
+        stats[chan * 4 + 3] += 1  # count the aborts of running transfers
     dma[CHAN_ABORT] = 1 << chan
     while dma[CHAN_ABORT]:
         time.sleep_us(10)
+
+#
+# The pool of DMA channels. dma_claim() returns the number of a free
+# channel, dma_release() returns it to the pool. If the firmware provides
+# rp2.DMA, its allocator is used, such that channels claimed by other
+# parts of the firmware are not handed out. Otherwise the pool is kept
+# here, and channels which are busy are skipped as well.
+#
+_dma_claimed = {}  # channel number: rp2.DMA object or None
+
+def dma_claim():
+    if _DMA is not None:
+        try:
+            dma = _DMA()
+        except OSError:
+            raise RuntimeError("no free DMA channel")
+        _dma_claimed[dma.channel] = dma
+        return dma.channel
+    for chan in range(DMA_CHANNELS):
+        if chan not in _dma_claimed and not dma_busy(chan):
+            _dma_claimed[chan] = None
+            return chan
+    raise RuntimeError("no free DMA channel")
+
+def dma_release(chan):
+    if chan not in _dma_claimed:
+        raise ValueError("DMA channel not claimed")
+    dma_abort(chan)
+    dma = _dma_claimed.pop(chan)
+    if dma is not None:
+        dma.close()
+
+#
+# A DMA transfer between a state machine and a buffer, which is set up
+# once and then restarted with a single register write: state machine
+# number, buffer, number of items, direction, IRQ handler
+# The channel, the FIFO address, the TREQ and the transfer size are
+# determined at instantiation. start() writes the buffer address to
+# WRITE_ADDR_TRIG of alias 2 for a get, or READ_ADDR_TRIG of alias 3 for
+# a put. That resets the address and starts the channel with the transfer
+# count it was set up with. If handler is given, IRQ_QUIET is cleared and
+# handler(transfer) is called at the end of each transfer, which needs
+# rp2.DMA of the firmware.
+#
+class DmaTransfer:
+    def __init__(self, sm, buffer, nword=None, put=False, handler=None):
+        if handler is not None and _DMA is None:
+            raise ValueError("an IRQ handler needs rp2.DMA")
+        if nword is None:
+            nword = len(buffer)
+        self.buffer = buffer
+        self.nword = nword
+        self.chan = dma_claim()
+        if put:
+            ctrl = sm_dma_put_setup(self.chan, sm, buffer, nword)
+            trigger = READ_ADDR_TRIG
+        else:
+            ctrl = sm_dma_get_setup(self.chan, sm, buffer, nword)
+            trigger = WRITE_ADDR_TRIG
+        self.trig = array.array("I", (DMA_BASE + self.chan * 0x40 + trigger * 4,
+                                      uctypes.addressof(buffer)))
+        if handler is not None:
+            regs = array.array("I", (dma_read_addr(self.chan), dma_write_addr(self.chan),
+                                     nword, ctrl & ~(IRQ_QUIET << 21)))
+            dma_config(self.chan, regs)
+            _dma_claimed[self.chan].irq(lambda dma: handler(self))
+
+    # Start the transfer from the start of the buffer. The transfer
+    # must not be running.
+    def start(self):
+        dma_retrigger(self.trig)
+
+    def busy(self):
+        return dma_busy(self.chan)
+
+    def wait(self):
+        while dma_busy(self.chan):
+            pass
+
+    # The number of items transferred since the last start
+    def transferred(self):
+        return self.nword - dma_transfer_count(self.chan)
+
+    def abort(self):
+        dma_abort(self.chan)
+
+    # Stop the transfer and return the channel
+    def deinit(self):
+        if self.chan is not None:
+            dma = _dma_claimed[self.chan]
+            if dma is not None:
+                dma.irq(None)
+            dma_release(self.chan)
+            self.chan = None
+
+#
+# Account for a transfer in the DMA counters. dma_stats_begin() is called
+# when the transfer is started, and dma_stats_end() when it is finished,
+# or before it is aborted. The bytes moved are taken from the difference
+# between the start value and the actual value of the transfer count, the
+# time from ticks_us(). So the time includes waiting for the DREQ, and
+# its resolution is that of the calls.
+#
+def dma_stats_begin(chan):
+    _dma_started[chan] = time.ticks_us()
+
+def dma_stats_end(chan):
+    start = _dma_started[chan]
+    if start is None:
+        return
+    _dma_started[chan] = None
+    moved = (dma_reload_count(chan) - dma_transfer_count(chan)) & 0xffffffff
+    index = chan * 4
+    stats = _dma_stats
+    stats[index] = (stats[index] + moved * dma_data_size(chan)) & 0xffffffff
+    stats[index + 1] = (stats[index + 1] + 1) & 0xffffffff
+    stats[index + 2] = (stats[index + 2] + time.ticks_diff(time.ticks_us(), start)) & 0xffffffff
+
+#
+# Return the counters as dict with the keys "sm" and "dma". "sm" maps the
+# state machine number to (rxstall, rxunder, txover, txstall), the number
+# of sm_fdebug() calls which found the flag set. "dma" maps the channel
+# number to (bytes, transfers, time_us, aborts). Only the claimed state
+# machines and channels and those with non-zero counters are included.
+# With clear=True, the counters are cleared after taking the snapshot.
+#
+def stats_snapshot(clear=False):
+    snapshot = {"sm": {}, "dma": {}}
+    for sm in range(8):
+        counts = tuple(_sm_events[sm * 4:sm * 4 + 4])
+        if sm in _sm_claimed or any(counts):
+            snapshot["sm"][sm] = counts
+    for chan in range(DMA_CHANNELS):
+        counts = tuple(_dma_stats[chan * 4:chan * 4 + 4])
+        if chan in _dma_claimed or any(counts):
+            snapshot["dma"][chan] = counts
+    if clear:
+        stats_clear()
+    return snapshot
+
+def stats_clear():
+    for i in range(len(_sm_events)):
+        _sm_events[i] = 0
+    for i in range(len(_dma_stats)):
+        _dma_stats[i] = 0
+
+#
+# Copy and fill memory in the background with a DMA channel. copy() and
+# fill() start the transfer and return at once, so the CPU can continue
+# with other work. busy() tells, whether the transfer is still running,
+# wait() and wait_async() wait for its end. A new transfer waits for the
+# end of the previous one. The buffers are kept until then.
+#
+class DmaMem:
+    def __init__(self):
+        self.chan = dma_claim()
+        self.pattern = array.array("I", (0,))
+        self.buffers = None  # referenced while the DMA uses them
+
+    # Copy nbytes from src to dst, by default the size of src
+    def copy(self, dst, src, nbytes=None):
+        if nbytes is None:
+            nbytes = _nbytes(src)
+        if nbytes > _nbytes(dst) or nbytes > _nbytes(src):
+            raise ValueError("buffer too small")
+        self.wait()
+        self.buffers = (dst, src)
+        dma_memcpy(self.chan, dst, src, nbytes)
+
+    # Fill the first nbytes of dst with value, by default all of it.
+    # value is a value of the items of dst, e.g. a byte for a bytearray
+    # or a 32 bit word for an array of type "I".
+    def fill(self, dst, value=0, nbytes=None):
+        if nbytes is None:
+            nbytes = _nbytes(dst)
+        if nbytes > _nbytes(dst):
+            raise ValueError("buffer too small")
+        self.wait()
+        size = _itemsize(dst)
+        value &= (1 << (8 * size)) - 1
+        if size == 1:
+            value *= 0x01010101
+        elif size == 2:
+            value *= 0x00010001
+        self.pattern[0] = value
+        self.buffers = (dst,)
+        dma_memset(self.chan, dst, self.pattern, nbytes)
+
+    def busy(self):
+        return self.buffers is not None and dma_busy(self.chan)
+
+    def wait(self):
+        while self.busy():
+            pass
+        self.buffers = None
+
+    async def wait_async(self):
+        import asyncio
+        while self.busy():
+            await asyncio.sleep(0)
+        self.buffers = None
+
+    # Stop a transfer and return the channel
+    def deinit(self):
+        if self.chan is not None:
+            dma_release(self.chan)
+            self.chan = None
+            self.buffers = None
+
+#
+# The size of the items of a buffer in bytes, and the size of a buffer
+#
+def _itemsize(buffer):
+    return len(bytes(memoryview(buffer)[:1])) or 1
+
+def _nbytes(buffer):
+    return len(buffer) * _itemsize(buffer)
+
+#
+# Calculate a CRC or checksum of a buffer with the sniffer, by a transfer
+# from the buffer to a dummy word: buffer, mode, seed, DMA channel
+# The item size of buffer is the transfer size, which matters only for
+# SNIFF_SUM. The seed is by default 0xffffffff for SNIFF_CRC32 and 0
+# otherwise. If chan is None, a channel is claimed for the transfer.
+# The sniffer is disabled afterwards.
+#
+_sniff_sink = array.array("I", (0,))
+
+def dma_checksum(buffer, mode=SNIFF_CRC32, seed=None, chan=None):
+    if seed is None:
+        seed = 0xffffffff if mode == SNIFF_CRC32 else 0
+    claimed = chan is None
+    if claimed:
+        chan = dma_claim()
+    try:
+        size = {1: 0, 2: 1, 4: 2}[_itemsize(buffer)]
+        dma_sniff_enable(chan, mode, seed)
+        TREQ_PERMANENT = 0x3f
+        INCR_READ = 1
+        ctrl = ((1 << 23) | (IRQ_QUIET << 21) | (TREQ_PERMANENT << 15) | (chan << 11) |
+                (INCR_READ << 4) | (size << 2) | (HIGH_PRIORITY << 1) | EN)
+        _dma_sniff_select(chan, size)
+        dma_config(chan, array.array("I", (uctypes.addressof(buffer),
+            uctypes.addressof(_sniff_sink), len(buffer), ctrl)))
+        if len(buffer):
+            dma_trigger(chan)
+            while dma_busy(chan):
+                pass
+        result = dma_sniff_result()
+        dma_sniff_disable()
+    finally:
+        if claimed:
+            dma_release(chan)
+    return result